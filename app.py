@@ -1,8 +1,28 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, redirect, url_for, Response
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+import itertools
+import json
+import threading
+import time
 import yt_dlp
 import os
 import logging
+from download_tokens import make_token, verify_token, TokenError
+import archive
+import bandwidth
+import batch
+import fanout
+import manifest
+import media_cache
+import media_proxy
+import playlists
+import previews
+import progress
+import thumbs
+import transcode
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -11,18 +31,48 @@ logger = logging.getLogger(__name__)
 # Directory settings
 base_dir = os.path.abspath(os.path.dirname(__file__))
 
-aapp = Flask(__name__, static_folder=base_dir, template_folder=os.path.join(base_dir, 'templates'))
+app = Flask(__name__, static_folder=base_dir, template_folder=os.path.join(base_dir, 'templates'))
 CORS(app)
+# Render ke load balancer ke peeche asli client IP X-Forwarded-For me aata hai
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get('PROXY_HOPS', 1)))
 
-def get_video_info(url):
+# Extracted info cache: video id -> {'info', 'url', 'expires'}
+# Signed googlevideo URLs expire (usually ~6h), isliye entry utni der hi valid hai
+INFO_CACHE_MAX = int(os.environ.get('INFO_CACHE_MAX', 256))
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', 5 * 3600))
+URL_EXPIRY_MARGIN = 120
+CONVERT_QUEUE_WAIT = int(os.environ.get('CONVERT_QUEUE_WAIT', 20))
+CLIP_MAX_SECONDS = int(os.environ.get('CLIP_MAX_SECONDS', 600))
+# Isse lambi audio pe cover wali file banne ka intezaar bahut lamba hoga, stream karo
+AUDIO_FILE_MAX_SECONDS = int(os.environ.get('AUDIO_FILE_MAX_SECONDS', 1800))
+AUDIO_TARGETS = ('m4a', 'mp3', 'opus')
+_info_cache = OrderedDict()
+_info_lock = threading.Lock()
+
+media_store = media_cache.MediaCache()
+fanout_registry = fanout.FanoutRegistry(media_store)
+thumbnailer = thumbs.Thumbnailer(media_store)
+previewer = previews.PreviewBuilder(media_store)
+playlist_registry = playlists.PlaylistRegistry(media_store, lambda: YoutubeDL(build_ydl_opts()))
+
+
+class YoutubeDL(yt_dlp.YoutubeDL):
+    # cookies.txt sirf padhte hain. yt-dlp close pe use wapas likhta hai, aur parallel
+    # extractions (gthread requests, zip workers) ek doosre ke beech file truncate kar dete the
+    def save_cookies(self):
+        pass
+
+
+def build_ydl_opts():
     # Cookies file path (Render pe block hone se bachne ke liye)
     cookie_path = os.path.join(base_dir, 'cookies.txt')
-    
+
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
         'format': 'best',
-        'extract_flat': False,
+        # Playlist ki entries flat aati hain; har video tabhi resolve hota hai jab khola jaaye
+        'extract_flat': 'in_playlist',
         'nocheckcertificate': True,
         'ignoreerrors': False,
         'logtostderr': False,
@@ -37,53 +87,244 @@ def get_video_info(url):
     if os.path.exists(cookie_path):
         ydl_opts['cookiefile'] = cookie_path
         logger.info("Using cookies.txt for authentication")
+    return ydl_opts
+
+
+def url_expiry(info):
+    """Earliest `expire=` timestamp among the signed format URLs, or the default TTL."""
+    expiry = time.time() + INFO_CACHE_TTL
+    for f in info.get('formats') or []:
+        qs = parse_qs(urlparse(f.get('url') or '').query)
+        if 'expire' in qs:
+            try:
+                expiry = min(expiry, int(qs['expire'][0]))
+            except ValueError:
+                pass
+    return expiry - URL_EXPIRY_MARGIN
+
+
+def remember_info(info, url):
+    entry = {
+        'info': info,
+        'url': info.get('webpage_url') or url,
+        'expires': url_expiry(info),
+    }
+    with _info_lock:
+        _info_cache[info['id']] = entry
+        _info_cache.move_to_end(info['id'])
+        while len(_info_cache) > INFO_CACHE_MAX:
+            _info_cache.popitem(last=False)
+
+
+def extract_info(url, ie_key=None):
+    with YoutubeDL(build_ydl_opts()) as ydl:
+        info = ydl.extract_info(url, download=False, ie_key=ie_key)
+    remember_info(info, url)
+    return info
+
+
+def get_cached_info(video_id, ie_key=None):
+    """Cached info for a video, re-extracted only once its signed URLs have expired.
+
+    With an extractor key, a video this instance has never seen is extracted
+    from its id, so tokens minted elsewhere still resolve.
+    """
+    with _info_lock:
+        entry = _info_cache.get(video_id)
+        if entry is not None:
+            _info_cache.move_to_end(video_id)
+    if entry is None:
+        return extract_info(video_id, ie_key=ie_key) if ie_key else None
+    if entry['expires'] > time.time():
+        return entry['info']
+    logger.info(f"Cached info for {video_id} expired, re-extracting")
+    return extract_info(entry['url'])
+
+
+def entry_info(entry):
+    """Full info for a flat playlist entry, extracted on first use and cached like any video."""
+    return get_cached_info(entry['id']) or extract_info(entry['url'] or entry['id'], ie_key=entry.get('ie_key'))
+
+
+def analyze_url(url):
+    """(listing, None) for playlists and channels, (None, info) for a single video."""
+    listing, info = playlists.open_url(url, playlist_registry.new_ydl)
+    if listing is not None:
+        return playlist_registry.add(listing), None
+    remember_info(info, url)
+    return None, info
+
+
+def fresh_info(video_id, ie_key):
+    """Cached info with URLs still valid and from the same extractor, without ever extracting."""
+    with _info_lock:
+        entry = _info_cache.get(video_id)
+    if entry is None or entry['expires'] <= time.time() or entry['info'].get('extractor_key') != ie_key:
+        return None
+    return entry['info']
+
+
+def peek_info(video_id):
+    """Cached info even if its URLs expired; enough for titles and extensions."""
+    with _info_lock:
+        entry = _info_cache.get(video_id)
+    return entry['info'] if entry else None
+
+
+def invalidate_info(video_id):
+    with _info_lock:
+        _info_cache.pop(video_id, None)
+
+
+def find_format(info, format_id):
+    for f in info.get('formats') or []:
+        if f.get('format_id') == format_id:
+            return f
+    return None
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            info = ydl.extract_info(url, download=False)
-            formats = info.get('formats', [])
-            
-            normal, audio_only, video_only = [], [], []
-
-            for f in formats:
-                ext = f.get('ext')
-                res = f.get('height')
-                filesize = f.get('filesize', 0)
-                filesize_mb = round(filesize / (1024 * 1024), 2) if filesize else "N/A"
-                
-                # Video + Audio
-                if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                    normal.append({
-                        'quality': f'{res}p' if res else 'Unknown',
-                        'ext': ext, 'size': f'{filesize_mb} MB', 'url': f.get('url')
-                    })
-                # Audio Only
-                elif f.get('vcodec') == 'none' and f.get('acodec') != 'none':
-                    abr = f.get('abr', 0)
-                    audio_only.append({
-                        'quality': f'{int(abr)}kbps' if abr else 'Unknown',
-                        'ext': ext, 'size': f'{filesize_mb} MB', 'url': f.get('url')
-                    })
-                # Video Only
-                elif f.get('vcodec') != 'none' and f.get('acodec') == 'none':
-                    video_only.append({
-                        'quality': f'{res}p' if res else 'Unknown',
-                        'ext': ext, 'size': f'{filesize_mb} MB', 'url': f.get('url')
-                    })
-
-            return {
-                'title': info.get('title'),
-                'thumbnail': info.get('thumbnail'),
-                'duration': info.get('duration'),
-                'uploader': info.get('uploader', 'Unknown Creator'),
-                'views': f"{info.get('view_count', 0):,}",
-                'normal': sorted(normal, key=lambda x: int(x['quality'].replace('p','')) if 'p' in x['quality'] and x['quality'] != 'Unknown' else 0, reverse=True)[:8],
-                'audio': sorted(audio_only, key=lambda x: int(x['quality'].replace('kbps','')) if 'kbps' in x['quality'] and x['quality'] != 'Unknown' else 0, reverse=True)[:8],
-                'video': sorted(video_only, key=lambda x: int(x['quality'].replace('p','')) if 'p' in x['quality'] and x['quality'] != 'Unknown' else 0, reverse=True)[:8]
-            }
-        except Exception as e:
-            logger.error(f"Error: {str(e)}")
-            return {"error": "YouTube blocked this request. Please update cookies.txt or try a different link."}
+
+def best_audio(info, video_format=None):
+    """Highest-bitrate audio-only format, preferring AAC next to H.264 video."""
+    audios = [f for f in info.get('formats') or []
+              if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none') and f.get('url')]
+    if not audios:
+        return None
+    if video_format and (video_format.get('vcodec') or '').startswith('avc1'):
+        aac = [f for f in audios if (f.get('acodec') or '').startswith('mp4a')]
+        audios = aac or audios
+    return max(audios, key=lambda f: f.get('abr') or 0)
+
+
+def best_audio_for(info, target):
+    """Best audio-only format for `target`, preferring codecs that copy into it without encoding."""
+    audios = [f for f in info.get('formats') or []
+              if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none') and f.get('url')]
+    if not audios:
+        return None
+    copyable = [f for f in audios if transcode.codec_family(f.get('acodec')) in transcode.TARGETS[target]['audio']]
+    return max(copyable or audios, key=lambda f: f.get('abr') or 0)
+
+
+def best_progressive(info):
+    """Highest-resolution format carrying both video and audio, so it downloads as one file."""
+    formats = [f for f in info.get('formats') or []
+               if f.get('vcodec') != 'none' and f.get('acodec') != 'none' and f.get('url')]
+    if not formats:
+        return None
+    return max(formats, key=lambda f: (f.get('height') or 0, f.get('tbr') or 0))
+
+
+def cover_image(info):
+    """(url, ext) of the largest thumbnail, preferring JPEG/PNG that can go into tags as is."""
+    thumbs = [t for t in info.get('thumbnails') or [] if t.get('url')]
+    if not thumbs:
+        return (info['thumbnail'], None) if info.get('thumbnail') else (None, None)
+
+    def ext(t):
+        return urlparse(t['url']).path.rsplit('.', 1)[-1].lower()
+
+    best = max(thumbs, key=lambda t: (ext(t) in transcode.COVER_COPY_EXTS,
+                                      (t.get('width') or 0) * (t.get('height') or 0), t.get('preference') or 0))
+    return best['url'], ext(best)
+
+
+def playlist_header(listing, client_ip=None):
+    token = make_token(listing.id, 'playlist', listing.ie_key, client_ip)
+    return {
+        'type': 'playlist',
+        'id': listing.id,
+        'playlist': True,
+        'title': listing.title,
+        'uploader': listing.uploader or 'Unknown Creator',
+        'thumbnail': listing.thumbnail,
+        'page_size': playlists.PLAYLIST_PAGE_SIZE,
+        # Pichli baar ke baad judi entries (dobara analyze karne pe)
+        'new_entries': listing.new_count,
+        'zip': {kind: f"/zip/{token}?kind={kind}" for kind in ('audio', 'video')},
+    }
+
+
+def playlist_records(listing, offset):
+    """One page of a listing as records: an 'entry' per video, then 'end' with the next cursor."""
+    count = 0
+    try:
+        for entry in listing.page(offset):
+            count += 1
+            yield dict(entry, type='entry')
+    except playlists.PlaylistError as e:
+        yield {'type': 'error', 'error': str(e)}
+    playlist_registry.save(listing)
+    yield {'type': 'end', 'next': listing.next_cursor(offset + count), 'loaded': len(listing.entries),
+           'complete': listing.complete}
+
+
+def wants_ndjson():
+    return 'application/x-ndjson' in (request.headers.get('Accept') or '')
+
+
+def records_response(records):
+    """NDJSON, one record per line as it is produced, if the client asked for it; else one JSON object."""
+    if wants_ndjson():
+        body = ((json.dumps(record) + '\n').encode() for record in records)
+        return Response(body, mimetype='application/x-ndjson', headers={'Cache-Control': 'no-store'})
+    result = {'entries': []}
+    for record in records:
+        kind = record.pop('type')
+        if kind == 'entry':
+            result['entries'].append(record)
+        else:
+            result.update(record)
+    return jsonify(result)
+
+
+def video_summary(info, client_ip=None):
+    formats = info.get('formats', [])
+
+    normal, audio_only, video_only = [], [], []
+
+    for f in formats:
+        # Manifest wale formats server pe jud ke ek file bante hain
+        ext = manifest.output_ext(f) if manifest.is_manifest(f) else f.get('ext')
+        res = f.get('height')
+        filesize = f.get('filesize', 0)
+        filesize_mb = round(filesize / (1024 * 1024), 2) if filesize else "N/A"
+
+        # Video + Audio
+        if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
+            normal.append({
+                'quality': f'{res}p' if res else 'Unknown',
+                'ext': ext, 'size': f'{filesize_mb} MB', 'format_id': f.get('format_id'),
+                'token': make_token(info['id'], f.get('format_id'), info.get('extractor_key'), client_ip)
+            })
+        # Audio Only
+        elif f.get('vcodec') == 'none' and f.get('acodec') != 'none':
+            abr = f.get('abr', 0)
+            audio_only.append({
+                'quality': f'{int(abr)}kbps' if abr else 'Unknown',
+                'ext': ext, 'size': f'{filesize_mb} MB', 'format_id': f.get('format_id'),
+                'token': make_token(info['id'], f.get('format_id'), info.get('extractor_key'), client_ip)
+            })
+        # Video Only
+        elif f.get('vcodec') != 'none' and f.get('acodec') == 'none':
+            video_only.append({
+                'quality': f'{res}p' if res else 'Unknown',
+                'ext': ext, 'size': f'{filesize_mb} MB', 'format_id': f.get('format_id'),
+                'token': make_token(info['id'], f.get('format_id'), info.get('extractor_key'), client_ip)
+            })
+
+    return {
+        'id': info.get('id'),
+        'title': info.get('title'),
+        'thumbnail': info.get('thumbnail'),
+        'thumb': thumbs.describe(info),
+        'preview': f"/preview/{info['id']}" if info.get('duration') else None,
+        'duration': info.get('duration'),
+        'uploader': info.get('uploader', 'Unknown Creator'),
+        'views': f"{info.get('view_count', 0):,}",
+        'normal': sorted(normal, key=lambda x: int(x['quality'].replace('p','')) if 'p' in x['quality'] and x['quality'] != 'Unknown' else 0, reverse=True)[:8],
+        'audio': sorted(audio_only, key=lambda x: int(x['quality'].replace('kbps','')) if 'kbps' in x['quality'] and x['quality'] != 'Unknown' else 0, reverse=True)[:8],
+        'video': sorted(video_only, key=lambda x: int(x['quality'].replace('p','')) if 'p' in x['quality'] and x['quality'] != 'Unknown' else 0, reverse=True)[:8]
+    }
 
 @app.route('/')
 def index():
@@ -95,11 +336,722 @@ def index():
 def health():
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/stats/bandwidth')
+def bandwidth_stats():
+    # Har active stream ka effective rate; client IP hash karke dikhate hain
+    return jsonify(bandwidth.shaper.status())
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
     url = request.json.get('url')
     if not url: return jsonify({"error": "No URL provided"}), 400
-    return jsonify(get_video_info(url))
+    try:
+        listing, info = analyze_url(url)
+        if listing is None:
+            return jsonify(video_summary(info, client_ip=request.remote_addr))
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({"error": "YouTube blocked this request. Please update cookies.txt or try a different link."})
+    # Playlist: header turant, phir pehle page ki entries jaise jaise yt-dlp se aati hain
+    return records_response(itertools.chain([playlist_header(listing, request.remote_addr)],
+                                             playlist_records(listing, 0)))
+
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    urls = batch.split_urls((request.get_json(silent=True) or {}).get('urls'))
+    if not urls: return jsonify({"error": "No URLs provided"}), 400
+    if len(urls) > batch.BATCH_MAX_URLS:
+        return jsonify({"error": f"Too many links. Please paste at most {batch.BATCH_MAX_URLS} at a time."}), 400
+    client_ip = request.remote_addr
+
+    def lookup(key):
+        ie_key, video_id = key
+        info = fresh_info(video_id, ie_key) if ie_key != 'url' else None
+        return {'video': video_summary(info, client_ip)} if info else None
+
+    def analyze_one(url):
+        listing, info = analyze_url(url)
+        if listing is None:
+            return {'video': video_summary(info, client_ip)}
+        # Batch me playlist ka sirf header; entries /playlist/<id> se jab khole
+        return {'playlist': playlist_header(listing, client_ip)}
+
+    # Har link ka result jaise hi ready ho; cache hits sabse pehle
+    return records_response(batch.BatchRun(urls, lookup, analyze_one))
+
+@app.route('/playlist/<playlist_id>')
+def playlist_page(playlist_id):
+    listing = playlist_registry.get(playlist_id)
+    if listing is None:
+        return jsonify({"error": "Playlist not analyzed yet. Please analyze the link again."}), 404
+    try:
+        offset = playlists.decode_cursor(request.args.get('cursor', ''), playlist_id)
+    except playlists.PlaylistError as e:
+        return jsonify({"error": str(e)}), 400
+    return records_response(playlist_records(listing, offset))
+
+@app.route('/playlist/<playlist_id>/<int:index>')
+def playlist_entry(playlist_id, index):
+    # Entry ke formats pehli baar kholne pe hi extract hote hain, phir info cache se
+    listing = playlist_registry.get(playlist_id)
+    if listing is None:
+        return jsonify({"error": "Playlist not analyzed yet. Please analyze the link again."}), 404
+    try:
+        entry = listing.entry(index - 1) if index > 0 else None
+    except playlists.PlaylistError as e:
+        return jsonify({"error": str(e)}), 502
+    if entry is None:
+        return jsonify({"error": "No such playlist entry"}), 404
+    try:
+        info = entry_info(entry)
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({"error": "Could not load this video. It may be private or removed."}), 502
+    return jsonify(dict(video_summary(info, client_ip=request.remote_addr), playlist_id=playlist_id, index=index))
+
+@app.route('/thumb/<video_id>')
+def thumb(video_id):
+    # Resized/re-encoded thumbnail; `v` source URL ka hash hai, isliye ek saal tak immutable
+    width = request.args.get('w', thumbs.THUMB_DEFAULT_WIDTH, type=int)
+    fmt = request.args.get('fmt', 'jpg')
+    ver = request.args.get('v', '')
+    if width not in thumbs.THUMB_WIDTHS or fmt not in thumbs.available_formats():
+        return jsonify({"error": "Unsupported thumbnail size or format"}), 400
+    path = thumbnailer.cached(video_id, ver, width, fmt)
+    if not path:
+        info = peek_info(video_id)
+        url = info.get('thumbnail') if info else None
+        if not url:
+            return jsonify({"error": "Video not analyzed yet"}), 404
+        if ver != thumbs.version(url):
+            # Purana version: current wale pe bhejo (redirect khud immutable nahi hai)
+            return redirect(url_for('thumb', video_id=video_id, v=thumbs.version(url), w=width, fmt=fmt), code=302)
+        try:
+            path = thumbnailer.render(video_id, url, width, fmt)
+        except thumbs.ThumbError as e:
+            logger.error(f"Thumbnail for {video_id} failed: {e}")
+            return redirect(url, code=302)
+    status, headers, body = media_cache.serve_file(
+        path, request.headers, request.method, media_proxy.client_socket(request.environ),
+        thumbs.content_type(fmt), 'inline')
+    headers['Cache-Control'] = thumbs.IMMUTABLE
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+@app.route('/preview/<video_id>')
+def preview(video_id):
+    # Seek preview sprite ka layout; storyboard se, warna keyframes se (scheduler ke through)
+    meta = previewer.cached(video_id)
+    if meta:
+        return jsonify(meta)
+    try:
+        info = get_cached_info(video_id)
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({"error": "Could not refresh this video. Please analyze the link again."}), 502
+    if info is None:
+        return jsonify({"error": "Video not analyzed yet"}), 404
+    if not info.get('duration'):
+        return jsonify({"error": "No preview for videos without a duration"}), 404
+    ticket = None
+    if previews.pick_storyboard(info) is None:
+        ticket, error = admit_job(1, previews.KEYFRAME_CPU_SECONDS)
+        if error:
+            return error
+        ticket.claimed = True
+    try:
+        meta = previewer.build(info, ticket)
+    except previews.PreviewError as e:
+        logger.error(f"Preview for {video_id} failed: {e}")
+        return jsonify({"error": "Could not build a preview for this video"}), 502
+    finally:
+        if ticket is not None:
+            ticket.release()
+    return jsonify(meta)
+
+@app.route('/preview/<video_id>/sprite')
+def preview_sprite(video_id):
+    path = previewer.sprite_path(video_id)
+    if not path:
+        return jsonify({"error": "Preview not built yet"}), 404
+    status, headers, body = media_cache.serve_file(
+        path, request.headers, request.method, media_proxy.client_socket(request.environ), 'image/jpeg', 'inline')
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+@app.route('/resolve')
+def resolve():
+    video_id = request.args.get('video')
+    format_id = request.args.get('format')
+    if not video_id or not format_id:
+        return jsonify({"error": "video and format are required"}), 400
+    try:
+        info = get_cached_info(video_id)
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({"error": "Could not refresh this video. Please analyze the link again."}), 502
+    if info is None:
+        return jsonify({"error": "Video not analyzed yet"}), 404
+    f = find_format(info, format_id)
+    if not f or not f.get('url'):
+        return jsonify({"error": "Format not found"}), 404
+    return redirect(f['url'], code=302)
+
+def request_job():
+    """Progress job named by the request's `?progress=` id, if any."""
+    return progress.job_for(request.args.get('progress'))
+
+def shaped_response(body, token=None, stage='downloading', **kwargs):
+    """Streaming response paced by the client's (and token's) bandwidth limits."""
+    job = request_job()
+    if job is not None:
+        length = (kwargs.get('headers') or {}).get('Content-Length')
+        job.update(stage=stage, total=int(length) if length else None)
+    return Response(bandwidth.shape(body, request.remote_addr, token, job), direct_passthrough=True, **kwargs)
+
+def send_cached(path, filename, ext, token=None):
+    status, headers, body = media_cache.serve_file(
+        path, request.headers, request.method, media_proxy.client_socket(request.environ),
+        media_proxy.guess_content_type(ext), media_proxy.content_disposition(filename))
+    return shaped_response(body, token, status=status, headers=headers)
+
+def refresh_format(claims):
+    # 403/410 ka matlab aksar signed URL expire ho gaya: ek baar fresh extract karke naya format
+    invalidate_info(claims['video'])
+    info = get_cached_info(claims['video'], ie_key=claims['ie_key'])
+    return find_format(info, claims['format']) if info else None
+
+def resolve_token_format(token, stale_ok=False):
+    """Validates a download token and returns (claims, info, format) or an error response.
+
+    With stale_ok, info whose signed URLs expired is returned as is; good
+    enough for cache lookups, which only need titles and format metadata.
+    """
+    try:
+        claims = verify_token(token, client_ip=request.remote_addr)
+    except TokenError as e:
+        return None, None, None, (jsonify({"error": str(e)}), 403)
+    info = peek_info(claims['video']) if stale_ok else None
+    if info is not None:
+        f = find_format(info, claims['format'])
+        if f:
+            return claims, info, f, None
+    try:
+        info = get_cached_info(claims['video'], ie_key=claims['ie_key'])
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return None, None, None, (jsonify({"error": "Could not refresh this video. Please analyze the link again."}), 502)
+    f = find_format(info, claims['format']) if info else None
+    if not f or not f.get('url'):
+        return None, None, None, (jsonify({"error": "Format not found"}), 404)
+    return claims, info, f, None
+
+@app.route('/t/<token>')
+def resolve_token(token):
+    claims, info, f, error = resolve_token_format(token)
+    if error:
+        return error
+    if manifest.is_manifest(f):
+        # Playlist URL dene se kuch nahi milega, file server hi banata hai
+        return redirect(url_for('download', token=token), code=302)
+    return redirect(f['url'], code=302)
+
+@app.route('/download/<token>')
+def download(token):
+    # Cache hit pe extraction ki zaroorat nahi, purani info se title/ext mil jaata hai
+    claims, info, f, error = resolve_token_format(token, stale_ok=True)
+    if error:
+        return error
+    key = media_cache.cache_key(claims['video'], claims['format'])
+    ext = manifest.output_ext(f) if manifest.is_manifest(f) else f.get('ext') or 'bin'
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    filename = media_proxy.safe_filename(info.get('title'), ext)
+    path = media_store.get(key, ext)
+    if path:
+        return send_cached(path, filename, ext, token)
+    if manifest.is_manifest(f):
+        claims, info, f, error = resolve_token_format(token)
+        if error:
+            return error
+        return manifest_download(token, claims, info, f, key, ext)
+    # Same file abhi kisi aur ke liye aa rahi ho toh usi fetch se padho, naya upstream nahi
+    if not range_header and request.method != 'HEAD':
+        shared = fanout_registry.join(key)
+        if shared:
+            total = shared.fetch.total
+            return shaped_response(shared, token, status=200,
+                                   headers=media_proxy.ranged_response_headers(0, total - 1, total, f.get('ext'),
+                                                                               filename, False))
+    # Seek wala range pehle se sparse cache me poora ho toh bhi extraction nahi chahiye
+    total = f.get('filesize')
+    if total and range_header and not if_range:
+        try:
+            byte_range = media_proxy.parse_range(range_header, total)
+        except media_proxy.RangeNotSatisfiable:
+            byte_range = None
+        sparse = media_store.sparse(key, ext, total) if byte_range else None
+        if sparse and not sparse.missing(*byte_range):
+            start, end = byte_range
+            return shaped_response(media_cache.SparseBody(sparse, start, end, None), token, status=206,
+                                   headers=media_proxy.ranged_response_headers(start, end, total, f.get('ext'),
+                                                                               filename, True))
+
+    claims, info, f, error = resolve_token_format(token)
+    if error:
+        return error
+    filename = media_proxy.safe_filename(info.get('title'), f.get('ext'))
+
+    def maybe_cache(body, status, fill):
+        # Poori file jaa rahi ho toh usi stream ko cache me bhi likho (tee);
+        # range requests (player seek) pe alag se background fill.
+        # `fill`: is request ka should_fill() result, jo ek hi baar poocha jaata hai
+        if not fill:
+            return body
+        if status == 200:
+            return media_cache.TeeBody(media_store, key, ext, body, f['filesize'])
+        media_cache.fill_in_background(
+            media_store, key, ext,
+            lambda: media_proxy.ParallelRangeBody(f['url'], f.get('http_headers'), 0, f['filesize'] - 1))
+        return body
+
+    # Size pata ho toh parallel ranged fetch; If-Range ke validators sirf upstream jaanta hai
+    total = f.get('filesize')
+    if total and not if_range:
+        try:
+            byte_range = media_proxy.parse_range(range_header, total)
+        except media_proxy.RangeNotSatisfiable:
+            return Response(status=416, headers={'Content-Range': f'bytes */{total}'})
+        if byte_range is not None or not range_header:
+            start, end = byte_range or (0, total - 1)
+            status = 206 if byte_range else 200
+            headers = media_proxy.ranged_response_headers(start, end, total, f.get('ext'), filename,
+                                                          byte_range is not None)
+            if request.method == 'HEAD':
+                # Size pehle se pata hai; HEAD probe ke liye na upstream, na .part file, na cache count
+                return Response(status=status, headers=headers)
+            # `f` fresh extract pe badal sakta hai, lambdas hamesha abhi wala URL lete hain
+            open_range = lambda s, e: media_proxy.ParallelRangeBody(f['url'], f.get('http_headers'), s, e)
+            fill = status == 200 and media_store.should_fill(key)
+
+            def open_checked():
+                # Pehla upstream chunk status line se pehle: expired signed URL (403/410) yahin
+                # pakda jaaye, 200 bhejne ke baad stream beech me na toote
+                if byte_range and not fill:
+                    # Seek ranges sparse cache se; sirf jo hissa nahi hai wahi upstream se aata hai
+                    return media_cache.SparseBody(media_store.sparse(key, ext, total), start, end,
+                                                  open_range).prime()
+                return open_range(start, end).prime()
+
+            try:
+                try:
+                    body = open_checked()
+                except media_proxy.UpstreamError as e:
+                    if e.status not in (403, 410):
+                        raise
+                    f = refresh_format(claims)
+                    if not f:
+                        if fill:
+                            media_store.fill_done(key)
+                        return jsonify({"error": "Format not found"}), 404
+                    body = open_checked()
+            except media_proxy.UpstreamError as e:
+                if fill:
+                    media_store.fill_done(key)
+                logger.error(f"Download failed for {claims['video']}/{claims['format']}: {e}")
+                return jsonify({"error": "Upstream download failed"}), 502
+            if fill:
+                # Shared fetch: isi dauraan aane wale baaki downloaders bhi isi se jud jaayenge.
+                # Cache fill shuru hi na ho sake toh None, tab yahi body seedhe
+                primed = body
+                body = fanout_registry.start(key, ext, total, lambda: primed, open_range) or primed
+            return shaped_response(body, token, status=status, headers=headers)
+
+    try:
+        try:
+            upstream = media_proxy.open_upstream(f['url'], f.get('http_headers'), range_header, if_range)
+        except media_proxy.UpstreamError as e:
+            if e.status not in (403, 410):
+                raise
+            f = refresh_format(claims)
+            if not f:
+                return jsonify({"error": "Format not found"}), 404
+            upstream = media_proxy.open_upstream(f['url'], f.get('http_headers'), range_header, if_range)
+    except media_proxy.UpstreamError as e:
+        logger.error(f"Download failed for {claims['video']}/{claims['format']}: {e}")
+        return jsonify({"error": "Upstream download failed"}), 502
+
+    headers = media_proxy.response_headers(upstream, filename)
+    if request.method == 'HEAD':
+        body = media_proxy.UpstreamBody(upstream)
+    else:
+        fill = bool(f.get('filesize')) and media_store.should_fill(key)
+        body = maybe_cache(media_proxy.UpstreamBody(upstream), upstream.status, fill)
+    return shaped_response(body, token, status=upstream.status, headers=headers)
+
+def manifest_download(token, claims, info, f, key, ext):
+    # HLS/DASH: fragments parallel me aate hain; TS ho toh ffmpeg copy se MP4 me remux
+    filename = media_proxy.safe_filename(info.get('title'), ext)
+    headers = {'Content-Disposition': media_proxy.content_disposition(filename)}
+    mimetype = media_proxy.guess_content_type(ext)
+    if request.method == 'HEAD':
+        return Response(status=200, mimetype=mimetype, headers=headers)
+    try:
+        stream = manifest.open_manifest(f)
+    except manifest.ManifestError as e:
+        logger.error(f"Manifest download failed for {claims['video']}/{claims['format']}: {e}")
+        return jsonify({"error": str(e)}), 502
+    job = request_job()
+    if stream.needs_remux:
+        plan = transcode.remux_plan(ext, stream.duration or info.get('duration'))
+        ticket, error = admit_job(plan.weight, plan.cpu_seconds)
+        if error:
+            return error
+        try:
+            body = transcode.FFmpegStream([stream.body], plan.args, ticket, nice=plan.nice,
+                                          progress=job, duration=stream.duration or info.get('duration'))
+        except transcode.TranscodeError as e:
+            logger.error(f"Remux failed for {claims['video']}: {e}")
+            if job:
+                job.finish("Remux failed")
+            return jsonify({"error": "Remux failed"}), 500
+    else:
+        body = stream.body(progress=job)
+    if media_store.should_fill(key):
+        body = media_cache.TeeBody(media_store, key, ext, body)
+    return shaped_response(body, token, mimetype=mimetype, headers=headers)
+
+def zip_entry(item, kind, digits):
+    """Archive entry for one playlist video: its best audio, or its best single-file video."""
+    info = entry_info(item)
+    f = best_audio_for(info, 'm4a') if kind == 'audio' else best_progressive(info)
+    if f is None:
+        raise archive.EntryError(f"No {kind} format")
+    ext = manifest.output_ext(f) if manifest.is_manifest(f) else f.get('ext') or 'bin'
+    name = f"{item['index']:0{digits}d} {media_proxy.safe_filename(info.get('title'), ext)}"
+    key = media_cache.cache_key(info['id'], f['format_id'])
+    path = media_store.get(key, ext)
+    if path:
+        return archive.ZipEntry(name, lambda: archive.file_body(path), os.path.getsize(path))
+
+    def open_body():
+        # Single download jaisa hi cache key, toh zip ke bytes baad me seedhe /download ke kaam aate hain
+        body = manifest.format_body(f)
+        if f.get('filesize') and media_store.should_fill(key):
+            body = media_cache.TeeBody(media_store, key, ext, body, f['filesize'])
+        return body
+
+    return archive.ZipEntry(name, open_body, None if manifest.is_manifest(f) else f.get('filesize'))
+
+@app.route('/zip/<token>')
+def playlist_zip(token):
+    # Poori playlist ek ZIP me; entries aate hi stream hoti hain, disk pe zip nahi banta
+    kind = request.args.get('kind', 'audio')
+    if kind not in ('audio', 'video'):
+        return jsonify({"error": f"Unsupported kind: {kind}"}), 400
+    try:
+        claims = verify_token(token, client_ip=request.remote_addr)
+    except TokenError as e:
+        return jsonify({"error": str(e)}), 403
+    if claims['format'] != 'playlist':
+        return jsonify({"error": "Not a playlist token"}), 400
+    listing = playlist_registry.get(claims['video'])
+    if listing is None:
+        return jsonify({"error": "Playlist not analyzed yet. Please analyze the link again."}), 404
+    filename = media_proxy.safe_filename(f"{listing.title or listing.id} ({kind})", 'zip')
+    headers = {'Content-Disposition': media_proxy.content_disposition(filename)}
+    if request.method == 'HEAD':
+        return Response(status=200, mimetype='application/zip', headers=headers)
+    # Flat pages saste hain; poori listing pehle padh lo taaki progress ko total pata ho.
+    # Limit se ek zyada padhte hain: badi playlist ka adha zip dene se behtar seedha mana karna
+    try:
+        items = list(listing.page(0, archive.ZIP_MAX_ENTRIES + 1))
+    except playlists.PlaylistError as e:
+        return jsonify({"error": str(e)}), 502
+    if not items:
+        return jsonify({"error": "Playlist is empty"}), 404
+    if len(items) > archive.ZIP_MAX_ENTRIES:
+        return jsonify({"error": f"Playlist has more than {archive.ZIP_MAX_ENTRIES} entries, "
+                                 f"too many for one ZIP"}), 413
+    digits = len(str(len(items)))
+    body = archive.ZipStreamBody(items, lambda item: zip_entry(item, kind, digits), progress=request_job())
+    return shaped_response(body, token, mimetype='application/zip', headers=headers)
+
+def conversion_inputs(info, f, target, audio_id=None):
+    """Formats to feed ffmpeg for `target`, video first, fetching only what the output needs."""
+    audio = find_format(info, audio_id) if audio_id else None
+    if audio_id and not audio:
+        return None
+    if transcode.TARGETS[target]['video'] is None:
+        if audio:
+            return [audio]
+        return [f] if f.get('acodec') != 'none' else [best_audio(info)]
+    if f.get('vcodec') in (None, 'none'):
+        return None
+    if audio or f.get('acodec') == 'none':
+        audio = audio or best_audio(info, f)
+        return [f, audio] if audio else None
+    return [f]
+
+def plan_for_request(info, f):
+    target = request.args.get('to', 'mp4')
+    if target not in transcode.TARGETS:
+        return None, None, (jsonify({"error": f"Unsupported output: {target}"}), 400)
+    inputs = conversion_inputs(info, f, target, request.args.get('audio'))
+    if not inputs or None in inputs:
+        return None, None, (jsonify({"error": "No suitable formats for this output"}), 404)
+    try:
+        plan = transcode.plan_conversion(inputs, target, info.get('duration'))
+    except transcode.TranscodeError as e:
+        return None, None, (jsonify({"error": str(e)}), 400)
+    return inputs, plan, None
+
+def admit_job(weight, cpu_seconds):
+    """Scheduler ticket for an ffmpeg job, or a 503 carrying queue position and ETA."""
+    client = request.remote_addr
+    ticket = transcode.scheduler.resume(request.args.get('ticket'), client)
+    if ticket is None:
+        try:
+            ticket = transcode.scheduler.submit(client, weight, cpu_seconds)
+        except transcode.TooBusy:
+            return None, (jsonify({"error": "Server busy, please retry shortly"}), 503, {'Retry-After': '30'})
+    # Thodi der queue me ruko; phir bhi slot na mile toh position/ETA ke saath lautao
+    job = request_job()
+    deadline = time.monotonic() + CONVERT_QUEUE_WAIT
+    while not ticket.wait(min(1.0, max(0.0, deadline - time.monotonic()))) and time.monotonic() < deadline:
+        if job is not None:
+            status = transcode.scheduler.status(ticket)
+            job.update(stage='queued', queue_position=status['position'], queue_eta=status['eta_seconds'])
+    if not ticket.admitted.is_set():
+        status = transcode.scheduler.status(ticket)
+        retry = max(5, min(status['eta_seconds'], transcode.TICKET_TTL // 2))
+        return None, (jsonify(dict(status, error="Queued", ticket=ticket.id)), 503,
+                      {'Retry-After': str(retry), 'X-Queue-Position': str(status['position']),
+                       'X-Queue-ETA': str(status['eta_seconds'])})
+    return ticket, None
+
+@app.route('/plan/<token>')
+def conversion_plan(token):
+    claims, info, f, error = resolve_token_format(token)
+    if error:
+        return error
+    inputs, plan, error = plan_for_request(info, f)
+    if error:
+        return error
+    return jsonify(dict(plan.to_dict(), **transcode.scheduler.status()))
+
+@app.route('/convert/<token>')
+def convert(token):
+    claims, info, f, error = resolve_token_format(token, stale_ok=True)
+    if error:
+        return error
+    inputs, plan, error = plan_for_request(info, f)
+    if error:
+        return error
+    # Output profile (target + input formats) bhi cache hota hai
+    profile = f"{plan.target}:{'+'.join(fmt['format_id'] for fmt in inputs)}"
+    key = media_cache.cache_key(claims['video'], profile)
+    path = media_store.get(key, plan.ext)
+    if path:
+        return send_cached(path, media_proxy.safe_filename(info.get('title'), plan.ext), plan.ext, token)
+
+    claims, info, f, error = resolve_token_format(token)
+    if error:
+        return error
+    inputs, plan, error = plan_for_request(info, f)
+    if error:
+        return error
+
+    # Lambi audio encode ko segments me kai cores pe chalao
+    workers = transcode.parallel_workers(plan, inputs, info.get('duration'))
+    if request.args.get('parallel') == '0':
+        workers = 0
+    ticket, error = admit_job(workers or plan.weight, plan.cpu_seconds)
+    if error:
+        return error
+
+    try:
+        if workers:
+            stream = transcode.ParallelTranscode(lambda: manifest.format_body(inputs[0]), plan.target,
+                                                 info['duration'], workers, ticket, nice=plan.nice,
+                                                 progress=request_job())
+        else:
+            stream = transcode.FFmpegStream(
+                [lambda fmt=fmt: manifest.format_body(fmt) for fmt in inputs], plan.args,
+                ticket, nice=plan.nice, progress=request_job(), duration=info.get('duration'))
+    except transcode.TranscodeError as e:
+        logger.error(f"Conversion failed for {claims['video']}: {e}")
+        if request_job():
+            request_job().finish("Conversion failed")
+        return jsonify({"error": "Conversion failed"}), 500
+    if media_store.should_fill(key):
+        stream = media_cache.TeeBody(media_store, key, plan.ext, stream)
+
+    filename = media_proxy.safe_filename(info.get('title'), plan.ext)
+    return shaped_response(stream, token, stage='converting', mimetype=plan.mimetype,
+                           headers={'Content-Disposition': media_proxy.content_disposition(filename)})
+
+@app.route('/merge/<token>')
+def merge(token):
+    # Video-only format + best audio, mp4 me (jahan ho sake stream copy)
+    return convert(token)
+
+@app.route('/audio/<token>')
+def audio(token):
+    # Audio-only token ho toh wahi format, warna video ka best audio; copy jahan ho sake
+    target = request.args.get('to', 'm4a')
+    if target not in AUDIO_TARGETS:
+        return jsonify({"error": f"Unsupported output: {target}"}), 400
+    tagged = request.args.get('tags', '1') != '0'
+    claims, info, f, error = resolve_token_format(token, stale_ok=True)
+    if error:
+        return error
+    if f.get('vcodec') != 'none' or f.get('acodec') in (None, 'none'):
+        f = best_audio_for(info, target)
+        if not f:
+            return jsonify({"error": "No audio formats for this video"}), 404
+    profile = f"audio:{target}:{f['format_id']}:{'tagged' if tagged else 'plain'}"
+    key = media_cache.cache_key(claims['video'], profile)
+    ext = transcode.TARGETS[target]['ext']
+    filename = media_proxy.safe_filename(info.get('title'), ext)
+    path = media_store.get(key, ext)
+    if path:
+        return send_cached(path, filename, ext, token)
+
+    try:
+        info = get_cached_info(claims['video'], ie_key=claims['ie_key'])
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({"error": "Could not refresh this video. Please analyze the link again."}), 502
+    f = find_format(info, f['format_id']) if info else None
+    if not f:
+        return jsonify({"error": "Format not found"}), 404
+
+    duration = info.get('duration')
+    cover_url, cover_ext = cover_image(info) if tagged and target in transcode.COVER_TARGETS else (None, None)
+    # Cover ke liye seekable file chahiye; bahut lambi audio pe cover chhod ke stream karo
+    to_file = bool(cover_url)
+    if to_file and (not duration or duration > AUDIO_FILE_MAX_SECONDS):
+        cover_url, to_file = None, False
+    try:
+        plan = transcode.plan_conversion([f], target, duration, cover=bool(cover_url), seekable=to_file)
+    except transcode.TranscodeError as e:
+        return jsonify({"error": str(e)}), 400
+    tags = {}
+    if tagged:
+        tags = {'title': info.get('track') or info.get('title'),
+                'artist': info.get('artist') or info.get('creator') or info.get('uploader'),
+                'album': info.get('album'), 'date': (info.get('upload_date') or '')[:4],
+                'comment': info.get('webpage_url')}
+    sources = [lambda: manifest.format_body(f)]
+    if cover_url:
+        sources.append(transcode.http_input_args({'url': cover_url, 'http_headers': f.get('http_headers')}))
+    args = plan.args + transcode.audio_tag_args(tags, 1 if cover_url else None, cover_ext)
+
+    ticket, error = admit_job(plan.weight, plan.cpu_seconds)
+    if error:
+        return error
+    job = request_job()
+    if not to_file:
+        try:
+            stream = transcode.FFmpegStream(sources, args, ticket, nice=plan.nice,
+                                            progress=job, duration=duration)
+        except transcode.TranscodeError as e:
+            logger.error(f"Audio extraction failed for {claims['video']}: {e}")
+            return jsonify({"error": "Audio extraction failed"}), 500
+        if media_store.should_fill(key):
+            stream = media_cache.TeeBody(media_store, key, ext, stream)
+        return shaped_response(stream, token, stage='converting', mimetype=plan.mimetype,
+                               headers={'Content-Disposition': media_proxy.content_disposition(filename)})
+
+    # ffmpeg seedha cache ki .part file me likhta hai; wahi publish hoke sendfile se jaati hai
+    writer = media_store.writer(key, ext)
+    try:
+        transcode.FFmpegStream(sources, args, ticket, nice=plan.nice, progress=job,
+                               duration=duration, output=writer.part_path).run()
+        writer.size = os.path.getsize(writer.part_path)
+        path = writer.commit()
+    except (transcode.TranscodeError, OSError) as e:
+        writer.abort()
+        logger.error(f"Audio extraction failed for {claims['video']}: {e}")
+        if job:
+            job.finish("Audio extraction failed")
+        return jsonify({"error": "Audio extraction failed"}), 500
+    return send_cached(path, filename, ext, token)
+
+@app.route('/clip')
+def clip():
+    video_id = request.args.get('video')
+    format_id = request.args.get('format')
+    try:
+        start = float(request.args.get('start', 0))
+        end = float(request.args['end'])
+    except (KeyError, ValueError):
+        return jsonify({"error": "start and end (seconds) are required"}), 400
+    if not video_id or not format_id:
+        return jsonify({"error": "video and format are required"}), 400
+    if start < 0 or end <= start or end - start > CLIP_MAX_SECONDS:
+        return jsonify({"error": f"Clip must be between 0 and {CLIP_MAX_SECONDS} seconds long"}), 400
+
+    try:
+        info = get_cached_info(video_id)
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return jsonify({"error": "Could not refresh this video. Please analyze the link again."}), 502
+    f = find_format(info, format_id) if info else None
+    if not f or not f.get('url'):
+        return jsonify({"error": "Format not found"}), 404
+    if info.get('duration') and start >= info['duration']:
+        return jsonify({"error": "Clip starts after the end of the video"}), 400
+
+    target = 'mp4' if f.get('vcodec') not in (None, 'none') else 'm4a'
+    inputs = conversion_inputs(info, f, target, request.args.get('audio'))
+    if not inputs or None in inputs:
+        return jsonify({"error": "No suitable formats for this clip"}), 404
+    length = end - start
+    try:
+        plan = transcode.plan_conversion(inputs, target, length)
+    except transcode.TranscodeError as e:
+        return jsonify({"error": str(e)}), 400
+
+    ticket, error = admit_job(plan.weight, plan.cpu_seconds)
+    if error:
+        return error
+    # ffmpeg khud URL se seek karta hai (mp4 sidx / webm cues ke zariye Range requests),
+    # isliye sirf clip wale bytes aate hain; -ss input pe hai toh copy keyframe se shuru hota hai
+    try:
+        stream = transcode.FFmpegStream(
+            [transcode.http_input_args(fmt, start) for fmt in inputs],
+            ['-t', f'{length:.3f}', '-avoid_negative_ts', 'make_zero'] + plan.args,
+            ticket, nice=plan.nice, progress=request_job(), duration=length)
+    except transcode.TranscodeError as e:
+        logger.error(f"Clip failed for {video_id}: {e}")
+        if request_job():
+            request_job().finish("Clip failed")
+        return jsonify({"error": "Clip failed"}), 500
+
+    title = f"{info.get('title') or 'clip'} [{int(start)}-{int(end)}]"
+    filename = media_proxy.safe_filename(title, plan.ext)
+    return shaped_response(stream, stage='converting', mimetype=plan.mimetype,
+                           headers={'Content-Disposition': media_proxy.content_disposition(filename)})
+
+class UpgradeResponse(Response):
+    # werkzeug 1xx responses ka body chhod deta hai; 101 ke baad socket hum khud chalate hain
+    def get_app_iter(self, environ):
+        return self.response
+
+@app.route('/progress/<job_id>')
+@app.route('/progress/<job_id>', websocket=True)
+def job_progress(job_id):
+    # WebSocket pe live updates; plain GET pe abhi ka snapshot (polling fallback)
+    job = progress.job_for(job_id)
+    if job is None:
+        return jsonify({"error": "Invalid progress id"}), 400
+    if not progress.is_websocket(request.environ):
+        return jsonify(job.snapshot())
+    sock = media_proxy.client_socket(request.environ)
+    if sock is None:
+        return jsonify({"error": "WebSockets are not available on this server"}), 400
+    status, headers, body = progress.websocket_response(request.environ, sock, job)
+    return UpgradeResponse(body, status=status, headers=headers, direct_passthrough=True)
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 10000))
@@ -0,0 +1,173 @@
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+# Playlist ki saari files ek ZIP me, bina disk pe zip banaye. Store mode hai
+# (media pehle se compressed hai): har entry ka header, phir bytes jaise upstream
+# se aate hain, phir data descriptor me CRC/size. 4 GB se badi entry/offset pe
+# ZIP64 records apne aap lagte hain. Entries ka resolve (extraction + format
+# choice) kuch workers parallel me karte hain; jo pehle ready ho wahi pehle
+# likhi jaati hai, aur memory ek chunk jitni hi rehti hai.
+ZIP_WORKERS = int(os.environ.get('PLAYLIST_ZIP_WORKERS', 4))
+ZIP_MAX_ENTRIES = int(os.environ.get('PLAYLIST_ZIP_MAX_ENTRIES', 500))
+READ_CHUNK = 256 * 1024
+MISSING_NAME = 'MISSING.txt'
+
+
+class EntryError(Exception):
+    pass
+
+
+class ZipEntry:
+    """One file of the archive; `open_body` is called only when it is its turn to be written."""
+
+    def __init__(self, name, open_body, size=None):
+        self.name = name
+        self.open_body = open_body
+        self.size = size
+
+
+def file_body(path):
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(READ_CHUNK)
+            if not data:
+                return
+            yield data
+
+
+class _Sink:
+    # zipfile isme likhta hai; seek/tell nahi hai toh woh data descriptors use karta hai
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+class ZipStreamBody:
+    """Streams a store-mode ZIP of `items`, resolving up to ZIP_WORKERS of them ahead.
+
+    `resolve(item)` turns a playlist item into a ZipEntry (or raises);
+    entries that fail are skipped and listed in MISSING.txt at the end, as
+    are any past the first ZIP_MAX_ENTRIES. `items` is read lazily.
+    """
+
+    def __init__(self, items, resolve, progress=None):
+        self.items = items
+        self.resolve = resolve
+        self.job = progress
+        self.executor = ThreadPoolExecutor(max_workers=ZIP_WORKERS)
+        self.pending = set()
+        self.body = None
+        self.ok = False
+        self.closed = False
+
+    def _resolve(self, item):
+        try:
+            return item, self.resolve(item), None
+        except Exception as e:
+            return item, None, str(e) or type(e).__name__
+
+    @staticmethod
+    def _over_limit(item):
+        return (f"{item.get('title') or item.get('id')} ({item.get('id')}): "
+                f"not included, archive holds at most {ZIP_MAX_ENTRIES} entries")
+
+    def _write(self, zf, sink, entry):
+        info = zipfile.ZipInfo(entry.name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_STORED
+        # Size pata na ho toh ZIP64 header hi likho, baad me badal nahi sakte
+        if entry.size:
+            info.file_size = entry.size
+        self.body = entry.open_body()
+        try:
+            with zf.open(info, 'w', force_zip64=not entry.size) as out:
+                for chunk in self.body:
+                    out.write(chunk)
+                    yield from sink.drain()
+        finally:
+            body, self.body = self.body, None
+            getattr(body, 'close', lambda: None)()
+        yield from sink.drain()
+
+    def __iter__(self):
+        started = time.monotonic()
+        sink = _Sink()
+        zf = zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED)
+        queue = iter(self.items)
+        taken = 0
+        missing = []
+        written = 0
+        done_duration = 0.0
+        # Totals sirf tab jab list pehle se haath me ho; lazy listing ko yahan padhna nahi
+        sized = isinstance(self.items, (list, tuple))
+        total_duration = sum(item.get('duration') or 0 for item in self.items) if sized else 0
+        if self.job is not None:
+            self.job.update(duration=total_duration or None,
+                            entries_total=min(len(self.items), ZIP_MAX_ENTRIES) if sized else None,
+                            entries_done=0)
+        try:
+            while len(self.pending) < ZIP_WORKERS and taken < ZIP_MAX_ENTRIES:
+                item = next(queue, None)
+                if item is None:
+                    break
+                taken += 1
+                self.pending.add(self.executor.submit(self._resolve, item))
+            while self.pending and not self.closed:
+                finished, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item, entry, error = future.result()
+                    if entry is not None:
+                        try:
+                            yield from self._write(zf, sink, entry)
+                            written += 1
+                        except Exception as e:
+                            # Upstream beech me toot gaya; entry jitni aayi utni hi rahegi
+                            error = f"incomplete: {e}"
+                    if error:
+                        logger.warning(f"Zip entry {item.get('id')} skipped: {error}")
+                        missing.append(f"{item.get('title') or item.get('id')} ({item.get('id')}): {error}")
+                    done_duration += item.get('duration') or 0
+                    if self.job is not None:
+                        self.job.update(position=done_duration if total_duration else None,
+                                        entries_done=written + len(missing))
+                    nxt = next(queue, None) if taken < ZIP_MAX_ENTRIES else None
+                    if nxt is not None:
+                        taken += 1
+                        self.pending.add(self.executor.submit(self._resolve, nxt))
+            if self.closed:
+                return
+            # Limit ke baad wali entries chupchap nahi chhodte, MISSING.txt me naam aate hain
+            missing.extend(self._over_limit(item) for item in queue)
+            if missing:
+                zf.writestr(MISSING_NAME, '\n'.join(missing) + '\n')
+            zf.close()
+            yield from sink.drain()
+            self.ok = True
+            logger.info(f"Zipped {written} of {written + len(missing)} entries in {time.monotonic() - started:.1f}s")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.pending:
+            future.cancel()
+        self.pending = set()
+        self.executor.shutdown(wait=False)
+        if self.body is not None:
+            getattr(self.body, 'close', lambda: None)()
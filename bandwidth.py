@@ -0,0 +1,255 @@
+import hashlib
+import heapq
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Egress shaping. Har client aur har download token ka apna token bucket hai
+# (rate tier se aata hai), aur upar se saare active streams ek weighted fair
+# queue se total egress (BANDWIDTH_TOTAL) baant-te hain. Rates bytes/sec me,
+# 0 = koi limit nahi.
+#
+# BANDWIDTH_TIERS='{"default": {"client": 4000000, "token": 2000000, "weight": 1},
+#                   "premium": {"client": 0, "token": 0, "weight": 4}}'
+# BANDWIDTH_TIER_NETWORKS='{"10.0.0.0/8": "premium"}'
+DEFAULT_TIERS = {'default': {'client': 0, 'token': 0, 'weight': 1}}
+BANDWIDTH_TIERS = json.loads(os.environ.get('BANDWIDTH_TIERS', 'null')) or DEFAULT_TIERS
+BANDWIDTH_TIER_NETWORKS = [
+    (ipaddress.ip_network(net, strict=False), tier)
+    for net, tier in (json.loads(os.environ.get('BANDWIDTH_TIER_NETWORKS', 'null')) or {}).items()
+]
+BANDWIDTH_TOTAL = int(os.environ.get('BANDWIDTH_TOTAL', 0))
+# Itne se bade chunk ko tukdon me bhejo taaki fair queue me ek stream lamba slot na le
+SLICE_BYTES = 256 * 1024
+# Bucket kitne second ka burst jama kar sakta hai
+BURST_SECONDS = 1.0
+# Effective rate itne-itne second ke windows pe naapte hain, phir EWMA
+RATE_WINDOW = 0.5
+RATE_SMOOTHING = 0.5
+# Idle buckets itni der baad hata do
+BUCKET_IDLE = 300
+
+
+def tier_for(client_ip):
+    if client_ip:
+        try:
+            addr = ipaddress.ip_address(client_ip)
+        except ValueError:
+            addr = None
+        for net, tier in BANDWIDTH_TIER_NETWORKS:
+            if addr is not None and addr.version == net.version and addr in net:
+                return tier
+    return 'default' if 'default' in BANDWIDTH_TIERS else next(iter(BANDWIDTH_TIERS))
+
+
+class TokenBucket:
+    """Token bucket that can go into debt: a caller reserves bytes and sleeps off the returned delay."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * BURST_SECONDS
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n):
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class FairQueue:
+    """Weighted fair queueing of send slots on a link of `rate` bytes/sec.
+
+    Each request gets a virtual finish tag (start + bytes / weight) and
+    slots are granted in tag order as link time frees up. Only streams
+    that are actually waiting to send compete, so bandwidth a slow client
+    cannot use goes to the others.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.vtime = 0.0
+        self.link_free = 0.0
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def acquire(self, stream, n):
+        if not self.rate:
+            return
+        with self.cond:
+            tag = max(self.vtime, stream.last_tag) + n / stream.weight
+            stream.last_tag = tag
+            entry = (tag, next(self.seq))
+            heapq.heappush(self.heap, entry)
+            while True:
+                now = time.monotonic()
+                if self.heap[0] is entry and now >= self.link_free:
+                    break
+                self.cond.wait(self.link_free - now if self.heap[0] is entry else None)
+            heapq.heappop(self.heap)
+            self.vtime = tag
+            self.link_free = max(now, self.link_free) + n / self.rate
+            self.cond.notify_all()
+
+
+class Stream:
+    """One response being sent, with its buckets and live throughput numbers."""
+
+    def __init__(self, shaper, stream_id, client_ip, token, tier, progress=None):
+        limits = BANDWIDTH_TIERS[tier]
+        self.progress = progress
+        self.shaper = shaper
+        self.id = stream_id
+        self.client_tag = hashlib.sha256((client_ip or '').encode()).hexdigest()[:8]
+        self.tier = tier
+        self.weight = max(float(limits.get('weight', 1)), 0.01)
+        self.buckets = [shaper.bucket('client', client_ip, limits.get('client', 0))]
+        if token:
+            self.buckets.append(shaper.bucket('token', token, limits.get('token', 0)))
+        self.limited = bool(shaper.queue.rate or any(b.rate for b in self.buckets))
+        self.last_tag = 0.0
+        self.sent = 0
+        self.started = time.monotonic()
+        self.rate = 0.0
+        self.window_start = self.started
+        self.window_bytes = 0
+        self.throttled = 0.0
+
+    def throttle(self, n):
+        """Blocks until `n` more bytes may go out on this stream, then counts them."""
+        if not n:
+            return
+        delay = max(bucket.reserve(n) for bucket in self.buckets)
+        if delay:
+            self.throttled += delay
+            time.sleep(delay)
+        self.shaper.queue.acquire(self, n)
+        self.sent += n
+        if self.progress is not None:
+            self.progress.advance(n)
+        self.window_bytes += n
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= RATE_WINDOW:
+            sample = self.window_bytes / elapsed
+            self.rate = sample if not self.rate else self.rate + RATE_SMOOTHING * (sample - self.rate)
+            self.window_start = now
+            self.window_bytes = 0
+
+    def stats(self):
+        seconds = time.monotonic() - self.started
+        return {
+            'id': self.id, 'client': self.client_tag, 'tier': self.tier, 'weight': self.weight,
+            'bytes': self.sent, 'seconds': round(seconds, 1),
+            'rate': int(self.rate), 'avg_rate': int(self.sent / seconds) if seconds else 0,
+            'throttled_seconds': round(self.throttled, 1),
+        }
+
+
+class Shaper:
+    def __init__(self, total=BANDWIDTH_TOTAL):
+        self.queue = FairQueue(total)
+        self.streams = {}
+        self.buckets = {}
+        self.ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def bucket(self, kind, name, rate):
+        key = (kind, name or '', rate)
+        now = time.monotonic()
+        with self._lock:
+            for stale in [k for k, b in self.buckets.items() if now - b.updated > BUCKET_IDLE]:
+                del self.buckets[stale]
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate)
+            return bucket
+
+    def open(self, client_ip, token=None, progress=None):
+        stream = Stream(self, next(self.ids), client_ip, token, tier_for(client_ip), progress)
+        with self._lock:
+            self.streams[stream.id] = stream
+        return stream
+
+    def done(self, stream):
+        with self._lock:
+            self.streams.pop(stream.id, None)
+        s = stream.stats()
+        logger.info(f"Stream {s['id']} ({s['tier']}) sent {s['bytes']} bytes in {s['seconds']}s "
+                    f"({s['avg_rate']} B/s, throttled {s['throttled_seconds']}s)")
+
+    def status(self):
+        with self._lock:
+            streams = [s.stats() for s in self.streams.values()]
+        return {'total_rate': self.queue.rate, 'active': len(streams),
+                'rate': sum(s['rate'] for s in streams), 'streams': streams}
+
+
+class ShapedBody:
+    """Paces a WSGI body through a Stream.
+
+    Bodies that write to the client socket themselves expose a `throttle`
+    attribute; it is pointed at the stream so their sendfile loops
+    are paced too, and their empty framing chunks pass straight through.
+    """
+
+    def __init__(self, shaper, stream, body):
+        self.shaper = shaper
+        self.stream = stream
+        self.body = body
+        self.closed = False
+        self.completed = False
+        if hasattr(body, 'throttle'):
+            body.throttle = stream.throttle
+
+    def __iter__(self):
+        throttle = self.stream.throttle
+        for chunk in self.body:
+            if len(chunk) <= SLICE_BYTES or not self.stream.limited:
+                throttle(len(chunk))
+                yield chunk
+                continue
+            view = memoryview(chunk)
+            for i in range(0, len(chunk), SLICE_BYTES):
+                piece = view[i:i + SLICE_BYTES]
+                throttle(len(piece))
+                yield bytes(piece)
+        self.completed = True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            getattr(self.body, 'close', lambda: None)()
+        finally:
+            self.shaper.done(self.stream)
+            job = self.stream.progress
+            if job is not None:
+                ok = self.completed and getattr(self.body, 'ok', True)
+                job.finish(None if ok else 'Interrupted')
+
+
+shaper = Shaper()
+
+
+def shape(body, client_ip, token=None, progress=None):
+    """Wraps a response body in bandwidth shaping and instrumentation (and progress reporting)."""
+    if isinstance(body, (list, tuple)):
+        if progress is not None:
+            progress.finish()
+        return body
+    return ShapedBody(shaper, shaper.open(client_ip, token, progress), body)
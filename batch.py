@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit, urlunsplit
+
+from yt_dlp.extractor import gen_extractor_classes
+
+logger = logging.getLogger(__name__)
+
+# Ek saath bahut saare links. Pehle har link ko normalize karke (extractor + id,
+# jaise yt-dlp khud match karta hai) duplicates hata dete hain, cache me mile
+# toh turant result, baaki ka extraction kuch workers parallel me. Ek process
+# me saare batches milake ANALYZE_MAX_CONCURRENT se zyada extractions nahi
+# chalte, taaki do bade batches YouTube pe ek saath toot na padein.
+BATCH_MAX_URLS = int(os.environ.get('ANALYZE_BATCH_MAX_URLS', 100))
+BATCH_WORKERS = int(os.environ.get('ANALYZE_BATCH_WORKERS', 4))
+MAX_CONCURRENT = int(os.environ.get('ANALYZE_MAX_CONCURRENT', 8))
+MAX_URL_LENGTH = 2048
+
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+_extractors = None
+
+
+def split_urls(value):
+    """Links from a JSON list, or from text with one or more links per line."""
+    if isinstance(value, str):
+        value = value.split()
+    if not isinstance(value, list):
+        return []
+    return [u.strip() for u in value if isinstance(u, str) and u.strip()]
+
+
+def normalize(url, extractors=None):
+    """Dedupe key for a link: (extractor key, id) when an extractor knows the id, else ('url', cleaned URL)."""
+    global _extractors
+    if extractors is None:
+        if _extractors is None:
+            _extractors = list(gen_extractor_classes())
+        extractors = _extractors
+    for ie in extractors:
+        if not ie.suitable(url):
+            continue
+        # Generic sab kuch match karta hai, uske paas id nahi hoti
+        temp_id = ie.get_temp_id(url) if ie.ie_key() != 'Generic' else None
+        if temp_id:
+            return ie.ie_key(), temp_id
+        break
+    parts = urlsplit(url)
+    return 'url', urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+class BatchRun:
+    """Streams one record per distinct link of `urls`, in the order they become ready.
+
+    `lookup(key)` returns a cached result for a normalized key or None;
+    `analyze(url)` extracts a miss and returns its result (or raises).
+    Results are dicts merged into an 'entry' record carrying the link's
+    positions in `urls`; the stream opens with 'batch' and closes with 'end'.
+    """
+
+    def __init__(self, urls, lookup, analyze, extractors=None):
+        self.urls = urls
+        self.lookup = lookup
+        self.analyze = analyze
+        self.extractors = extractors
+
+    def _groups(self):
+        groups = OrderedDict()
+        invalid = []
+        for i, url in enumerate(self.urls):
+            if len(url) > MAX_URL_LENGTH:
+                invalid.append(i)
+                continue
+            groups.setdefault(normalize(url, self.extractors), []).append(i)
+        return groups, invalid
+
+    def _analyze(self, url):
+        with _slots:
+            return self.analyze(url)
+
+    def __iter__(self):
+        started = time.monotonic()
+        groups, invalid = self._groups()
+        yield {'type': 'batch', 'total': len(self.urls), 'unique': len(groups),
+               'duplicates': len(self.urls) - len(invalid) - len(groups)}
+        for i in invalid:
+            yield {'type': 'entry', 'url': self.urls[i], 'indexes': [i], 'error': "Link is too long"}
+
+        counts = {'cached': 0, 'analyzed': 0, 'failed': len(invalid)}
+        misses = []
+        for key, indexes in groups.items():
+            try:
+                hit = self.lookup(key)
+            except Exception as e:
+                logger.warning(f"Batch cache lookup for {key} failed: {e}")
+                hit = None
+            if hit is None:
+                misses.append((key, indexes))
+                continue
+            counts['cached'] += 1
+            yield dict(hit, type='entry', url=self.urls[indexes[0]], indexes=indexes, cached=True)
+
+        pending = {}
+        executor = ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(misses))))
+        try:
+            for key, indexes in misses:
+                url = self.urls[indexes[0]]
+                pending[executor.submit(self._analyze, url)] = (url, indexes)
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    url, indexes = pending.pop(future)
+                    record = {'type': 'entry', 'url': url, 'indexes': indexes, 'cached': False}
+                    try:
+                        record.update(future.result())
+                        counts['analyzed'] += 1
+                    except Exception as e:
+                        logger.error(f"Batch analyze of {url} failed: {e}")
+                        record['error'] = "Could not analyze this link. It may be private, removed or unsupported."
+                        counts['failed'] += 1
+                    yield record
+        finally:
+            # Client chala gaya toh jo extractions shuru nahi hue woh cancel
+            executor.shutdown(wait=False, cancel_futures=True)
+        elapsed = time.monotonic() - started
+        logger.info(f"Batch of {len(self.urls)} links: {counts['cached']} cached, {counts['analyzed']} analyzed, "
+                    f"{counts['failed']} failed in {elapsed:.1f}s")
+        yield dict(counts, type='end', elapsed=round(elapsed, 2))
@@ -0,0 +1,129 @@
+"""Single-process vs segmented parallel transcoding on synthetic local media.
+
+    python benchmarks/parallel_transcode.py --minutes 30 --target mp3 --workers 2 4
+
+Generates an Opus source with ffmpeg's lavfi sources, then times a plain
+one-process transcode against ParallelTranscode at each worker count. Every
+output is decoded back and checked: its length against the source (mp3
+must match exactly; m4a keeps the AAC priming, like the single-process
+file) and against the single-process file, plus the largest per-sample
+difference from the single-process decode, which shows any seam slip
+(mp3 should be 0).
+"""
+import argparse
+import array
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import transcode  # noqa: E402
+
+# Opus hamesha 48 kHz decode hota hai
+RATE = 48000
+
+
+def make_source(path, minutes):
+    # Noise + tone so the encoder has real work to do
+    subprocess.run([transcode.FFMPEG, '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.2:duration={minutes * 60}',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:duration={minutes * 60}',
+                    '-filter_complex', 'amix=inputs=2', '-ac', '2', '-c:a', 'libopus', '-b:a', '128k', path],
+                   check=True)
+
+
+def file_source(path):
+    def open_body():
+        with open(path, 'rb') as fh:
+            while True:
+                chunk = fh.read(1024 * 1024)
+                if not chunk:
+                    return
+                yield chunk
+    return open_body
+
+
+def decode(path):
+    """Mono s16 samples of `path`, after the decoder's own priming/padding trim."""
+    out = subprocess.run([transcode.FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', path,
+                          '-map', '0:a:0', '-ac', '1', '-f', 's16le', 'pipe:1'],
+                         stdout=subprocess.PIPE, check=True).stdout
+    return array.array('h', out)
+
+
+def single(src, target, duration, out):
+    plan = transcode.plan_conversion([{'acodec': 'opus', 'vcodec': 'none', 'ext': 'webm'}], target, duration)
+    # File me (pipe nahi) taaki mp3 ko bhi LAME tag mile aur decode gapless ho
+    cmd = [transcode.FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', src] + plan.args + ['-y', out]
+    subprocess.run(cmd, check=True)
+    return os.path.getsize(out)
+
+
+def parallel(src, target, duration, workers, out):
+    scheduler = transcode.TranscodeScheduler(capacity=workers)
+    ticket = scheduler.submit('bench', workers, 0)
+    job = transcode.ParallelTranscode(file_source(src), target, duration, workers, ticket)
+    with open(out, 'wb') as fh:
+        for chunk in job:
+            fh.write(chunk)
+    if not job.ok:
+        raise SystemExit(f"Parallel transcode with {workers} workers failed")
+    return os.path.getsize(out)
+
+
+def compare(reference, samples):
+    """(sample count difference, largest per-sample difference) against the single-process decode."""
+    n = min(len(reference), len(samples))
+    worst = max(map(abs, map(int.__sub__, reference[:n], samples[:n])), default=0)
+    return len(samples) - len(reference), worst
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--minutes', type=int, default=30)
+    parser.add_argument('--target', choices=sorted(transcode.SEGMENT_FORMATS), default='mp3')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='vd-bench-')
+    try:
+        src = os.path.join(workdir, 'source.webm')
+        print(f"Generating {args.minutes} min Opus source...")
+        make_source(src, args.minutes)
+        duration = args.minutes * 60
+
+        ext = transcode.TARGETS[args.target]['ext']
+        out = os.path.join(workdir, f'single.{ext}')
+        began = time.perf_counter()
+        size = single(src, args.target, duration, out)
+        base = time.perf_counter() - began
+        source, reference = decode(src), decode(out)
+        print(f"Source: {len(source)} samples ({len(source) / RATE:.3f} s); single-process output: "
+              f"{len(reference)} samples ({len(reference) / RATE:.3f} s)")
+        print(f"{'mode':<14}{'seconds':>10}{'speedup':>10}{'MB out':>10}{'vs source':>11}{'vs single':>11}"
+              f"{'max diff':>10}")
+        print(f"{'single':<14}{base:>10.1f}{1.0:>10.2f}{size / 1e6:>10.1f}{len(reference) - len(source):>+11}"
+              f"{0:>+11}{0:>10}")
+        failed = False
+        for workers in args.workers:
+            out = os.path.join(workdir, f'parallel{workers}.{ext}')
+            began = time.perf_counter()
+            size = parallel(src, args.target, duration, workers, out)
+            took = time.perf_counter() - began
+            samples = decode(out)
+            extra, worst = compare(reference, samples)
+            failed = failed or extra != 0
+            print(f"{f'{workers} workers':<14}{took:>10.1f}{base / took:>10.2f}{size / 1e6:>10.1f}"
+                  f"{len(samples) - len(source):>+11}{extra:>+11}{worst:>10}")
+        if failed:
+            raise SystemExit("Parallel output length differs from the single-process transcode")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
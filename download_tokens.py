@@ -0,0 +1,73 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+
+logger = logging.getLogger(__name__)
+
+# Har instance pe same secret hona chahiye, warna token doosre worker pe invalid hoga
+_secret = os.environ.get('DOWNLOAD_TOKEN_SECRET', '').encode()
+if not _secret:
+    _secret = secrets.token_bytes(32)
+    logger.warning("DOWNLOAD_TOKEN_SECRET not set, using a per-process secret")
+
+TOKEN_TTL = int(os.environ.get('DOWNLOAD_TOKEN_TTL', 6 * 3600))
+SIG_BYTES = 16
+
+
+class TokenError(Exception):
+    pass
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _ip_tag(ip):
+    return hashlib.sha256(ip.encode()).hexdigest()[:12]
+
+
+def _sign(body):
+    return hmac.new(_secret, body.encode(), hashlib.sha256).digest()[:SIG_BYTES]
+
+
+def make_token(video_id, format_id, ie_key=None, client_ip=None, ttl=TOKEN_TTL):
+    """Signed, self-contained token for one (video, format) download.
+
+    Extractor key is included so any instance can re-extract the video
+    without having seen the original /analyze call.
+    """
+    payload = [video_id, format_id, ie_key or '', int(time.time() + ttl),
+               _ip_tag(client_ip) if client_ip else '']
+    body = _b64encode(json.dumps(payload, separators=(',', ':')).encode())
+    return f"{body}.{_b64encode(_sign(body))}"
+
+
+def verify_token(token, client_ip=None):
+    """Returns {'video', 'format', 'ie_key', 'expires'} or raises TokenError."""
+    try:
+        body, sig = token.split('.', 1)
+        valid = hmac.compare_digest(_b64decode(sig), _sign(body))
+    except (ValueError, TypeError):
+        raise TokenError("Malformed token")
+    if not valid:
+        raise TokenError("Bad signature")
+
+    try:
+        video_id, format_id, ie_key, expires, ip_tag = json.loads(_b64decode(body))
+        expired = expires < time.time()
+    except (ValueError, TypeError):
+        raise TokenError("Malformed token")
+    if expired:
+        raise TokenError("Token expired")
+    if ip_tag and (not client_ip or not hmac.compare_digest(ip_tag, _ip_tag(client_ip))):
+        raise TokenError("Token bound to a different client")
+    return {'video': video_id, 'format': format_id, 'ie_key': ie_key or None, 'expires': expires}
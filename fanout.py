@@ -0,0 +1,252 @@
+import logging
+import os
+import threading
+
+import media_cache
+
+logger = logging.getLogger(__name__)
+
+# Ek hi (video, format) ko ek saath kai log download karein toh upstream se
+# sirf ek fetch hota hai. Producer thread bytes ko cache .part file aur ek
+# ring buffer dono me likhta hai; har reader ka apna cursor hai. Jo reader
+# ring se peeche reh jaaye (late joiner ya slow client) woh .part file se
+# padhta hai, isliye producer kabhi kisi reader ka intezaar nahi karta.
+# Cache me likhna fail ho (disk bhari, object cache se bada) toh sirf fill
+# chhodte hain, upstream se ring bharta rehta hai; jo reader na ring me
+# na file me mile, woh apne cursor se khud upstream range maangta hai.
+RING_SIZE = int(os.environ.get('FANOUT_RING_MB', 16)) * 1024 * 1024
+READ_SIZE = 256 * 1024
+
+
+class FetchFailed(Exception):
+    pass
+
+
+class SharedFetch:
+    """One upstream fetch of a whole object, fanned out to any number of readers."""
+
+    def __init__(self, registry, key, ext, total, open_body, open_range=None):
+        self.registry = registry
+        self.key = key
+        self.total = total
+        self.open_body = open_body
+        self.open_range = open_range
+        self.writer = registry.cache.writer(key, ext)
+        self.claimed = True
+        self.ring = bytearray(min(RING_SIZE, total))
+        self.head = 0
+        # Itne bytes .part file me likhe ja chuke hain (fill chhutne ke baad nahi badhta)
+        self.spooled = 0
+        self.readers = 0
+        self.done = False
+        self.failed = False
+        self.cancelled = False
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._produce, daemon=True).start()
+
+    def _append(self, chunk):
+        view = memoryview(chunk)
+        size = len(self.ring)
+        while view:
+            pos = self.head % size
+            n = min(len(view), size - pos)
+            self.ring[pos:pos + n] = view[:n]
+            view = view[n:]
+            self.head += n
+
+    def _release(self):
+        # Fill claim sirf ek baar chhodo: baad me kisi naye fetch ka claim na chhoot jaaye
+        if self.claimed:
+            self.claimed = False
+            self.registry.cache.fill_done(self.key)
+
+    def _abandon_fill(self, error):
+        logger.error(f"Media cache: fill for {self.key} dropped: {error}")
+        with self.cond:
+            writer, self.writer = self.writer, None
+            writer.abort()
+            # Naye downloaders is fetch se na judein, unka apna fetch hoga
+            self.registry._finished(self)
+        self._release()
+
+    def _fill(self, chunk):
+        if self.writer is None:
+            return
+        try:
+            self.writer.write(chunk)
+            # Flush taaki peeche wale readers file se ye bytes pread kar sakein
+            self.writer.fh.flush()
+        except OSError as e:
+            self._abandon_fill(e)
+
+    def _produce(self):
+        body = None
+        try:
+            body = self.open_body()
+            for chunk in body:
+                if self.cancelled:
+                    raise FetchFailed("All readers left")
+                self._fill(chunk)
+                with self.cond:
+                    self._append(chunk)
+                    if self.writer is not None:
+                        self.spooled = self.head
+                    self.cond.notify_all()
+            if self.head != self.total:
+                raise FetchFailed(f"Got {self.head} of {self.total} bytes")
+            if self.writer is not None:
+                try:
+                    self.writer.commit()
+                except OSError as e:
+                    self._abandon_fill(e)
+            with self.cond:
+                self.done = True
+                self.registry._finished(self)
+                self.cond.notify_all()
+        except Exception as e:
+            if not self.cancelled:
+                logger.error(f"Shared fetch of {self.key} failed: {e}")
+            with self.cond:
+                if self.writer is not None:
+                    self.writer.abort()
+                    self.writer = None
+                self.failed = True
+                self.registry._finished(self)
+                self.cond.notify_all()
+        finally:
+            getattr(body, 'close', lambda: None)()
+            self._release()
+
+    def attach(self):
+        """A new reader starting at byte 0, or None if the fetch already finished, failed or dropped its fill."""
+        with self.cond:
+            if self.done or self.failed or self.writer is None:
+                return None
+            fd = os.open(self.writer.part_path, os.O_RDONLY)
+            self.readers += 1
+            return SharedReader(self, fd)
+
+    def _detach(self, reader_done):
+        with self.cond:
+            self.readers -= 1
+            if self.readers or self.done or self.failed or reader_done:
+                return
+            # Fill chhoot chuka ho toh bina reader ke aage laane ka koi fayda nahi
+            if self.writer is None or self.head / self.total < media_cache.TEE_CONTINUE_AT:
+                self.cancelled = True
+
+
+class SharedReader:
+    """A reader's cursor into a SharedFetch: served from the ring when hot, else from the file.
+
+    If the fill was dropped and the bytes at the cursor are in neither, the
+    reader continues with its own upstream range (FetchFailed without one).
+    """
+
+    def __init__(self, fetch, fd):
+        self.fetch = fetch
+        self.fd = fd
+        self.cursor = 0
+        self.own = None
+        self.own_body = None
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        fetch = self.fetch
+        if self.cursor >= fetch.total:
+            self.close()
+            raise StopIteration
+        if self.own is not None:
+            return self._next_own()
+        with fetch.cond:
+            while fetch.head <= self.cursor and not fetch.failed:
+                fetch.cond.wait()
+            if fetch.head <= self.cursor:
+                self.close()
+                raise FetchFailed("Shared upstream fetch failed")
+            n = min(fetch.head - self.cursor, READ_SIZE)
+            size = len(fetch.ring)
+            if fetch.head - self.cursor <= size:
+                pos = self.cursor % size
+                first = min(n, size - pos)
+                data = bytes(fetch.ring[pos:pos + first]) + bytes(fetch.ring[:n - first])
+                self.cursor += n
+                return data
+            n = min(fetch.spooled - self.cursor, READ_SIZE)
+        if n <= 0:
+            # Ring aage nikal gaya aur fill chhoot gaya: ye bytes kahin nahi bache
+            if fetch.open_range is None:
+                self.close()
+                raise FetchFailed("Fell behind a shared fetch that stopped caching")
+            logger.info(f"Shared fetch of {fetch.key}: reader at {self.cursor} continues on its own")
+            self.own_body = fetch.open_range(self.cursor, fetch.total - 1)
+            self.own = iter(self.own_body)
+            return self._next_own()
+        # Ring aage nikal gaya; ye bytes file me pehle hi likhe ja chuke hain
+        data = os.pread(self.fd, n, self.cursor)
+        if not data:
+            self.close()
+            raise FetchFailed("Cache file shorter than expected")
+        self.cursor += len(data)
+        return data
+
+    def _next_own(self):
+        try:
+            data = next(self.own)
+        except StopIteration:
+            self.close()
+            if self.cursor < self.fetch.total:
+                raise FetchFailed(f"Own fetch ended at {self.cursor} of {self.fetch.total} bytes")
+            raise
+        self.cursor += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        os.close(self.fd)
+        getattr(self.own_body, 'close', lambda: None)()
+        self.fetch._detach(self.cursor >= self.fetch.total)
+
+
+class FanoutRegistry:
+    """Active shared fetches by cache key (per process)."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.active = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        with self._lock:
+            fetch = self.active.get(key)
+        return fetch.attach() if fetch else None
+
+    def start(self, key, ext, total, open_body, open_range=None):
+        """Starts a shared fetch (the caller must hold the cache fill claim) and returns its first reader.
+
+        Returns None, with the claim released, if the cache can't take the
+        fill; the caller then fetches on its own.
+        """
+        try:
+            fetch = SharedFetch(self, key, ext, total, open_body, open_range)
+        except OSError as e:
+            logger.error(f"Media cache: cannot start shared fetch for {key}: {e}")
+            self.cache.fill_done(key)
+            return None
+        with self._lock:
+            self.active[key] = fetch
+        reader = fetch.attach()
+        fetch.start()
+        return reader
+
+    def _finished(self, fetch):
+        with self._lock:
+            if self.active.get(fetch.key) is fetch:
+                del self.active[fetch.key]
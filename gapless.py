@@ -0,0 +1,261 @@
+import mmap
+import operator
+import struct
+from collections import namedtuple
+
+# Alag alag encode hue audio segments ko bina gap/click ke jodna. Har segment
+# thoda pehle se (pre-roll) aur thoda aage tak (post-roll) encode hota hai, aur
+# segment ki shuruaat encoder ke frame grid pe hoti hai: tab segment ka frame j
+# wahi samples cover karta hai jo ek process wale encode ka frame (start/N + j).
+# Jodte waqt har seam pe frame index se kaatte hain, toh priming aur padding
+# sirf file ke shuru aur ant me bachte hain, bilkul single encode jaisa.
+#
+# mp3 me ek frame ka data pichhle frames ke "bit reservoir" me shuru ho sakta
+# hai (main_data_begin bytes peeche). Seam ke baad wala pehla frame apne
+# segment ke reservoir bytes maangta hai, isliye woh bytes pichhle segment ke
+# aakhri frames ki khaali jagah me likh dete hain; seam wahan rakhte hain jahan
+# itni jagah ho.
+
+
+class SegmentError(Exception):
+    pass
+
+
+# offset: file me frame kahan; main: main data area kahan shuru; mdb: main_data_begin
+Frame = namedtuple('Frame', 'offset size main mdb')
+
+_MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+_ADTS_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+
+# Isse dheemi PCM (s16) ko chup maante hain, usme lag nahi dhoondh sakte
+SILENCE = 64
+
+# LAME tag ke andar fields (Xing/Info string se offset), ffmpeg ke mp3 muxer jaisa
+XING_FRAMES = 8
+XING_BYTES = 12
+LAME_DELAY_PADDING = 141
+LAME_TAG_CRC = 154
+LAME_CRC_SPAN = 190
+
+
+def frame_samples(kind, rate):
+    """Samples per encoded frame of `kind` ('mp3' or 'adts') at `rate`, or None when the encoder can't take that rate."""
+    if kind == 'mp3':
+        if not any(rate in rates for rates in _MP3_RATES.values()):
+            return None
+        return 1152 if rate >= 32000 else 576
+    return 1024 if rate in _ADTS_RATES else None
+
+
+def mp3_frames(buf):
+    """(frames, rate, xing) of a Layer III stream; `xing` is the leading Xing/Info frame, if any."""
+    frames = []
+    rate = None
+    xing = None
+    pos = 0
+    end = len(buf)
+    while pos + 4 <= end:
+        h = struct.unpack_from('>I', buf, pos)[0]
+        version = (h >> 19) & 3
+        if h >> 21 != 0x7ff or version == 1 or (h >> 17) & 3 != 1 or (h >> 12) & 15 in (0, 15) or (h >> 10) & 3 == 3:
+            raise SegmentError(f"Bad mp3 frame header at byte {pos}")
+        mpeg1 = version == 3
+        rate = _MP3_RATES[version][(h >> 10) & 3]
+        bitrate = _MP3_BITRATES[1 if mpeg1 else 2][(h >> 12) & 15] * 1000
+        size = (144 if mpeg1 else 72) * bitrate // rate + ((h >> 9) & 1)
+        mono = (h >> 6) & 3 == 3
+        side = pos + 4 + (0 if (h >> 16) & 1 else 2)
+        side_size = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+        if pos + size > end:
+            raise SegmentError(f"Truncated mp3 frame at byte {pos}")
+        if not frames and xing is None and buf[side + side_size:side + side_size + 4] in (b'Xing', b'Info'):
+            xing = (pos, size, side + side_size - pos)
+        else:
+            mdb = (buf[side] << 1 | buf[side + 1] >> 7) if mpeg1 else buf[side]
+            frames.append(Frame(pos, size, side + side_size, mdb))
+        pos += size
+    return frames, rate, xing
+
+
+def adts_frames(buf):
+    """(frames, rate) of an ADTS stream; every frame must carry one 1024-sample AAC block."""
+    frames = []
+    rate = None
+    pos = 0
+    end = len(buf)
+    while pos + 7 <= end:
+        if buf[pos] != 0xff or buf[pos + 1] & 0xf0 != 0xf0:
+            raise SegmentError(f"Bad ADTS header at byte {pos}")
+        rate = _ADTS_RATES[(buf[pos + 2] >> 2) & 15]
+        size = (buf[pos + 3] & 3) << 11 | buf[pos + 4] << 3 | buf[pos + 5] >> 5
+        if buf[pos + 6] & 3 or size < 7 or pos + size > end:
+            raise SegmentError(f"Unsupported ADTS frame at byte {pos}")
+        frames.append(Frame(pos, size, pos, 0))
+        pos += size
+    return frames, rate
+
+
+def _main_data_tail(frames, index, count):
+    """File spans, in order, of the last `count` main-data bytes before frame `index`."""
+    spans = []
+    i = index - 1
+    while count > 0:
+        if i < 0:
+            raise SegmentError("Bit reservoir reaches before the segment start")
+        f = frames[i]
+        take = min(count, f.offset + f.size - f.main)
+        spans.append((f.offset + f.size - take, take))
+        count -= take
+        i -= 1
+    return spans[::-1]
+
+
+def mp3_seam(prev, prev_first, nxt, nxt_first, start, window):
+    """First global frame in [start, start + window) where `nxt` can take over from `prev`.
+
+    `prev_first`/`nxt_first` are the global indexes of each segment's first
+    frame. Returns (frame, source spans in nxt, target spans in prev): nxt's
+    reservoir bytes get written over prev's unused tail bytes.
+    """
+    for g in range(start, start + window):
+        p, q = g - prev_first, g - nxt_first
+        if p >= len(prev) or q < 0 or q >= len(nxt):
+            break
+        need = nxt[q].mdb
+        # prev ke frame g ka reservoir prev ke pichhle frames ne khaali chhoda tha; utna hi likh sakte hain
+        if need > prev[p].mdb:
+            continue
+        try:
+            return g, _main_data_tail(nxt, q, need), _main_data_tail(prev, p, need)
+        except SegmentError:
+            continue
+    raise SegmentError(f"No mp3 seam near frame {start}")
+
+
+def best_lag(ref, probe, reach, span, step=8):
+    """Where `ref` sits in `probe`, which has `reach` extra samples on each side; None when `ref` is silence.
+
+    Only the loudest `span` samples of `ref` are matched (a pause at the
+    seam says nothing about the shift), comparing every `step`-th sample.
+    """
+    start, loudest = 0, -1
+    for at in range(0, max(1, len(ref) - span + 1), span):
+        level = sum(map(abs, ref[at:at + span:step]))
+        if level > loudest:
+            start, loudest = at, level
+    a = ref[start:start + span:step]
+    if max(map(abs, a), default=0) < SILENCE:
+        return None
+    best = None
+    for lag in range(-reach, reach + 1):
+        at = reach + start + lag
+        b = probe[at:at + span:step]
+        if len(b) < len(a):
+            break
+        err = sum(map(abs, map(operator.sub, a, b)))
+        if best is None or err < best[0]:
+            best = (err, lag)
+    return best[1] if best else None
+
+
+def crc16(data):
+    # CRC-16/ARC (poly 0x8005 reflected), LAME tag CRC isi ka hai
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return crc
+
+
+def lame_tag(frame, tag_offset, frames, size, padding):
+    """Copy of a Xing/LAME frame with the frame count, byte size and end padding replaced."""
+    out = bytearray(frame)
+    struct.pack_into('>I', out, tag_offset + XING_FRAMES, frames)
+    struct.pack_into('>I', out, tag_offset + XING_BYTES, size)
+    at = tag_offset + LAME_DELAY_PADDING
+    delay = (out[at] << 4) | (out[at + 1] >> 4)
+    out[at:at + 3] = ((delay << 12) | min(padding, 0xfff)).to_bytes(3, 'big')
+    struct.pack_into('>H', out, tag_offset + LAME_TAG_CRC, crc16(out[:LAME_CRC_SPAN]))
+    return bytes(out)
+
+
+def lame_padding(frame, tag_offset):
+    at = tag_offset + LAME_DELAY_PADDING
+    return ((frame[at + 1] & 0x0f) << 8) | frame[at + 2]
+
+
+def _load(path, kind):
+    with open(path, 'rb') as fh:
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise SegmentError(f"Empty segment {path}")
+    if kind == 'mp3':
+        frames, _, xing = mp3_frames(buf)
+        return buf, frames, xing
+    return buf, adts_frames(buf)[0], None
+
+
+def join_segments(paths, firsts, cuts, kind, out, window=1):
+    """Writes segments `paths` as one gapless stream to `out`; returns the audio frame count.
+
+    `firsts[i]` is the global index of segment i's first audio frame, and
+    segment i takes over at global frame `cuts[i]` (mp3 may move a seam up
+    to `window` frames later). mp3 gets a LAME tag with the joined frame
+    count, the first segment's encoder delay and the last one's padding.
+    """
+    loaded = [_load(path, kind) for path in paths]
+    try:
+        seams = [None]
+        for i in range(1, len(paths)):
+            prev, nxt = loaded[i - 1][1], loaded[i][1]
+            if kind == 'mp3':
+                seams.append(mp3_seam(prev, firsts[i - 1], nxt, firsts[i], cuts[i], window))
+            elif cuts[i] - firsts[i - 1] > len(prev) or cuts[i] < firsts[i]:
+                raise SegmentError(f"Segment {i - 1} ends before frame {cuts[i]}")
+            else:
+                seams.append((cuts[i], [], []))
+
+        ranges = []
+        for i, (buf, frames, _) in enumerate(loaded):
+            first = seams[i][0] - firsts[i] if i else 0
+            last = seams[i + 1][0] - firsts[i] if i + 1 < len(loaded) else len(frames)
+            if not 0 <= first < last <= len(frames):
+                raise SegmentError(f"Segment {i} does not cover frames {first}-{last}")
+            ranges.append((frames[first].offset, frames[last - 1].offset + frames[last - 1].size, last - first))
+        total_frames = sum(n for _, _, n in ranges)
+
+        if kind == 'mp3':
+            head, last_xing = loaded[0][2], loaded[-1][2]
+            if head is None or last_xing is None:
+                raise SegmentError("Segment without a LAME tag")
+            frame = loaded[0][0][head[0]:head[0] + head[1]]
+            padding = lame_padding(loaded[-1][0][last_xing[0]:last_xing[0] + last_xing[1]], last_xing[2])
+            size = head[1] + sum(end - start for start, end, _ in ranges)
+            out.write(lame_tag(frame, head[2], total_frames, size, padding))
+
+        for i, (buf, _, _) in enumerate(loaded):
+            start, end, _ = ranges[i]
+            targets = seams[i + 1][2] if i + 1 < len(loaded) else []
+            if not targets:
+                out.write(buf[start:end])
+                continue
+            # Aakhri frames me agle segment ka reservoir
+            tail_start = targets[0][0]
+            out.write(buf[start:tail_start])
+            tail = bytearray(buf[tail_start:end])
+            data = b''.join(loaded[i + 1][0][o:o + n] for o, n in seams[i + 1][1])
+            pos = 0
+            for o, n in targets:
+                tail[o - tail_start:o - tail_start + n] = data[pos:pos + n]
+                pos += n
+            out.write(tail)
+        return total_frames
+    finally:
+        for buf, _, _ in loaded:
+            buf.close()
@@ -0,0 +1,301 @@
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from yt_dlp.aes import aes_cbc_decrypt_bytes, unpad_pkcs7
+
+import media_proxy
+
+logger = logging.getLogger(__name__)
+
+# Manifest (HLS m3u8 / DASH mpd) wale formats me file ki jagah playlist URL
+# hota hai. Server playlist padh ke fragments parallel me fetch karta hai aur
+# order me ek hi file ki tarah bhejta hai. fMP4/DASH fragments seedhe jud ke
+# valid file ban jaate hain; MPEG-TS fragments ffmpeg se (stream copy) MP4 me
+# remux hote hain.
+MANIFEST_PROTOCOLS = ('m3u8', 'm3u8_native', 'http_dash_segments')
+FRAGMENT_MAX_CONCURRENCY = int(os.environ.get('FRAGMENT_MAX_CONCURRENCY', 8))
+FRAGMENT_INITIAL_CONCURRENCY = 2
+FRAGMENT_RETRIES = 3
+MAX_FRAGMENTS = 50000
+
+
+class ManifestError(Exception):
+    pass
+
+
+def is_manifest(f):
+    return f.get('protocol') in MANIFEST_PROTOCOLS
+
+
+def output_ext(f):
+    """Extension of the single file a manifest format is served as."""
+    if f.get('protocol') == 'http_dash_segments' and f.get('ext') in ('mp4', 'm4a', 'webm'):
+        return f['ext']
+    return 'm4a' if f.get('vcodec') == 'none' else 'mp4'
+
+
+class ConcurrencyTuner:
+    """Per-host fragment concurrency: grows while fetches succeed, halves when the CDN pushes back.
+
+    The ceiling comes from the host's measured per-connection throughput
+    (the same EWMA the range proxy keeps): enough fetches in flight to reach
+    TARGET_RATE, and never more than FRAGMENT_MAX_CONCURRENCY.
+    """
+
+    def __init__(self):
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def concurrency(self, host):
+        with self._lock:
+            limit = self._limits.get(host, FRAGMENT_INITIAL_CONCURRENCY)
+        rate = media_proxy.tuner.rate(host)
+        wanted = math.ceil(media_proxy.TARGET_RATE / rate) if rate else FRAGMENT_MAX_CONCURRENCY
+        return max(1, min(int(limit), wanted, FRAGMENT_MAX_CONCURRENCY))
+
+    def success(self, host):
+        # Additive increase: har `limit` successful fetches pe ~1 badhta hai
+        with self._lock:
+            limit = self._limits.get(host, FRAGMENT_INITIAL_CONCURRENCY)
+            self._limits[host] = min(FRAGMENT_MAX_CONCURRENCY, limit + 1 / limit)
+
+    def backoff(self, host):
+        with self._lock:
+            limit = self._limits.get(host, FRAGMENT_INITIAL_CONCURRENCY)
+            self._limits[host] = max(1.0, limit / 2)
+
+
+tuner = ConcurrencyTuner()
+
+
+class Fragment:
+    def __init__(self, url, byte_range=None, duration=0.0, key_url=None, iv=None, init=False):
+        self.url = url
+        self.byte_range = byte_range
+        self.duration = duration
+        self.key_url = key_url
+        self.iv = iv
+        self.init = init
+
+
+def _attributes(line):
+    attrs = {}
+    for name, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', line.partition(':')[2]):
+        attrs[name] = value.strip('"')
+    return attrs
+
+
+def _byte_range(spec, url, offsets):
+    """(start, end) for an HLS `length[@offset]`; without an offset it follows the previous range of the same URL."""
+    length, _, offset = spec.partition('@')
+    start = int(offset) if offset else offsets.get(url, 0)
+    end = start + int(length) - 1
+    offsets[url] = end + 1
+    return start, end
+
+
+def parse_hls(text, base_url):
+    """Fragments of an HLS media playlist, init sections included where they change."""
+    if not text.lstrip().startswith('#EXTM3U'):
+        raise ManifestError("Not an HLS playlist")
+    if '#EXT-X-STREAM-INF' in text:
+        raise ManifestError("Expected a media playlist, got a master playlist")
+    if '#EXT-X-ENDLIST' not in text:
+        raise ManifestError("Live streams cannot be downloaded")
+
+    fragments = []
+    offsets = {}
+    sequence = 0
+    key_url = iv = None
+    last_init = None
+    duration = 0.0
+    range_spec = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.partition(':')[2])
+        elif line.startswith('#EXT-X-KEY:'):
+            attrs = _attributes(line)
+            method = attrs.get('METHOD')
+            if method == 'NONE':
+                key_url = iv = None
+            elif method == 'AES-128' and attrs.get('URI'):
+                key_url = urljoin(base_url, attrs['URI'])
+                iv = bytes.fromhex(attrs['IV'][2:].zfill(32)) if attrs.get('IV') else None
+            else:
+                # SAMPLE-AES wagairah DRM hai, usse hum nahi khol sakte
+                raise ManifestError(f"Unsupported encryption: {method}")
+        elif line.startswith('#EXT-X-MAP:'):
+            attrs = _attributes(line)
+            url = urljoin(base_url, attrs['URI'])
+            byte_range = _byte_range(attrs['BYTERANGE'], url, offsets) if attrs.get('BYTERANGE') else None
+            if (url, byte_range) != last_init:
+                last_init = (url, byte_range)
+                fragments.append(Fragment(url, byte_range, key_url=key_url, iv=iv, init=True))
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            range_spec = line.partition(':')[2]
+        elif line.startswith('#EXTINF:'):
+            try:
+                duration = float(line.partition(':')[2].split(',')[0])
+            except ValueError:
+                duration = 0.0
+        elif not line.startswith('#'):
+            url = urljoin(base_url, line)
+            byte_range = _byte_range(range_spec, url, offsets) if range_spec else None
+            # IV na diya ho toh media sequence number hi IV hai
+            fragments.append(Fragment(url, byte_range, duration, key_url,
+                                      iv or (sequence.to_bytes(16, 'big') if key_url else None)))
+            sequence += 1
+            duration = 0.0
+            range_spec = None
+            if len(fragments) > MAX_FRAGMENTS:
+                raise ManifestError("Playlist has too many fragments")
+    if not any(not fr.init for fr in fragments):
+        raise ManifestError("Playlist has no fragments")
+    return fragments
+
+
+class Manifest:
+    """A manifest format resolved to its fragment list."""
+
+    def __init__(self, fragments, headers, needs_remux):
+        self.fragments = fragments
+        self.headers = headers
+        # MPEG-TS fragments jod ke MP4 nahi banta, ffmpeg se remux chahiye
+        self.needs_remux = needs_remux
+        self.duration = sum(fr.duration for fr in fragments)
+
+    def body(self, progress=None):
+        return ManifestBody(self, progress)
+
+
+def open_manifest(f):
+    """Fragment list for a manifest-backed yt-dlp format; raises ManifestError if it can't be downloaded."""
+    headers = f.get('http_headers')
+    if f.get('protocol') == 'http_dash_segments':
+        fragments = []
+        for fr in f.get('fragments') or []:
+            url = fr.get('url') or urljoin(f.get('fragment_base_url') or '', fr.get('path') or '')
+            fragments.append(Fragment(url, duration=fr.get('duration') or 0.0))
+        if not fragments:
+            raise ManifestError("Manifest has no fragments")
+        return Manifest(fragments, headers, needs_remux=False)
+
+    text = f.get('hls_media_playlist_data')
+    base_url = f['url']
+    if not text:
+        try:
+            with media_proxy.open_upstream(f['url'], headers) as resp:
+                text = resp.read().decode('utf-8', 'replace')
+                base_url = resp.final_url
+        except (media_proxy.UpstreamError, OSError) as e:
+            raise ManifestError(f"Could not fetch playlist: {e}")
+    fragments = parse_hls(text, base_url)
+    return Manifest(fragments, headers, needs_remux=not fragments[0].init)
+
+
+class ManifestBody:
+    """Streams a manifest's fragments in order, fetching several at once.
+
+    Concurrency follows the host's tuned limit, and the bytes in flight
+    are capped at media_proxy.MAX_INFLIGHT_BYTES using the running average
+    fragment size, so memory stays flat however long the video is.
+    """
+
+    def __init__(self, manifest, progress=None):
+        self.manifest = manifest
+        self.fragments = manifest.fragments
+        self.host = urlsplit(self.fragments[-1].url).netloc
+        self.next_index = 0
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=FRAGMENT_MAX_CONCURRENCY)
+        self.keys = {}
+        self._keys_lock = threading.Lock()
+        self.job = progress
+        self.fetched = 0
+        self.fetched_bytes = 0
+        self.position = 0.0
+        self.ok = False
+        self.closed = False
+
+    def _key(self, url):
+        with self._keys_lock:
+            key = self.keys.get(url)
+            if key is None:
+                key = self.keys[url] = media_proxy.fetch_range(url, self.manifest.headers)
+                if len(key) != 16:
+                    raise ManifestError(f"Bad AES-128 key length: {len(key)}")
+            return key
+
+    def _fetch(self, fragment):
+        host = urlsplit(fragment.url).netloc
+        for attempt in range(FRAGMENT_RETRIES + 1):
+            try:
+                data = media_proxy.fetch_range(fragment.url, self.manifest.headers, *(fragment.byte_range or ()))
+                break
+            except media_proxy.UpstreamError as e:
+                if e.status in (403, 404, 410) or attempt == FRAGMENT_RETRIES:
+                    raise
+                # 429/503/timeouts: CDN ko saans lene do
+                tuner.backoff(host)
+                time.sleep(attempt + 1)
+        tuner.success(host)
+        if fragment.key_url:
+            data = unpad_pkcs7(aes_cbc_decrypt_bytes(data, self._key(fragment.key_url), fragment.iv))
+        return data
+
+    def _fill(self):
+        limit = tuner.concurrency(self.host)
+        if self.fetched:
+            limit = max(1, min(limit, media_proxy.MAX_INFLIGHT_BYTES * self.fetched // self.fetched_bytes))
+        while len(self.pending) < limit and self.next_index < len(self.fragments):
+            fragment = self.fragments[self.next_index]
+            self.pending.append((fragment, self.executor.submit(self._fetch, fragment)))
+            self.next_index += 1
+
+    def __iter__(self):
+        started = time.monotonic()
+        if self.job is not None and self.manifest.duration:
+            self.job.update(duration=self.manifest.duration)
+        try:
+            self._fill()
+            while self.pending and not self.closed:
+                fragment, future = self.pending.popleft()
+                data = future.result()
+                self.fetched += 1
+                self.fetched_bytes += len(data) or 1
+                self.position += fragment.duration
+                if self.job is not None and fragment.duration:
+                    self.job.update(position=self.position)
+                self._fill()
+                yield data
+            self.ok = not self.closed
+            logger.info(f"Fetched {self.fetched} fragments ({self.fetched_bytes} bytes) from {self.host} "
+                        f"in {time.monotonic() - started:.1f}s, concurrency {tuner.concurrency(self.host)}")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+def format_body(f):
+    """Whole-file body for any format; manifest formats come as their fragments, joined."""
+    if is_manifest(f):
+        return open_manifest(f).body()
+    return media_proxy.format_body(f)
@@ -0,0 +1,395 @@
+import http.client
+import logging
+import math
+import mimetypes
+import os
+import re
+import ssl
+import threading
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin, quote
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+UPSTREAM_TIMEOUT = 30
+MAX_REDIRECTS = 5
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+}
+
+# Upstream ke ye headers client tak jaate hain, baaki (cookies, alt-svc, ...) nahi
+PASSTHROUGH_HEADERS = ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges',
+                       'ETag', 'Last-Modified')
+
+_ssl_context = ssl.create_default_context()
+
+
+class UpstreamError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def _connect(parts):
+    if parts.scheme == 'https':
+        return http.client.HTTPSConnection(parts.netloc, timeout=UPSTREAM_TIMEOUT, context=_ssl_context)
+    return http.client.HTTPConnection(parts.netloc, timeout=UPSTREAM_TIMEOUT)
+
+
+def open_upstream(url, headers=None, range_header=None, if_range=None):
+    """GET `url`, following redirects, with the client's Range/If-Range forwarded.
+
+    Returns the open http.client response; the caller owns closing it.
+    """
+    req_headers = dict(DEFAULT_HEADERS)
+    req_headers.update(headers or {})
+    req_headers['Accept-Encoding'] = 'identity'
+    if range_header:
+        req_headers['Range'] = range_header
+        if if_range:
+            req_headers['If-Range'] = if_range
+
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        conn = _connect(parts)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        try:
+            conn.request('GET', path, headers=req_headers)
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise UpstreamError(f"Upstream request failed: {e}")
+
+        if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+            url = urljoin(url, resp.getheader('Location'))
+            conn.close()
+            continue
+        if resp.status >= 400 and resp.status != 416:
+            conn.close()
+            raise UpstreamError(f"Upstream returned {resp.status}", status=resp.status)
+        resp.final_url = url
+        return resp
+    raise UpstreamError("Too many redirects")
+
+
+class UpstreamBody:
+    """Iterates an upstream response in fixed-size chunks, so memory stays at one chunk.
+
+    WSGI servers call close() even when the body is never iterated (HEAD,
+    client gone), which releases the upstream connection.
+    """
+
+    def __init__(self, resp, chunk_size=CHUNK_SIZE):
+        self.resp = resp
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.resp.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self.resp.close()
+
+
+def safe_filename(title, ext):
+    name = re.sub(r'[\\/:*?"<>|\s]+', ' ', title or 'download').strip() or 'download'
+    return f"{name[:150]}.{ext}" if ext else name[:150]
+
+
+def content_disposition(filename):
+    ascii_name = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode()
+    ascii_name = ascii_name.replace('"', '').replace('\\', '') or 'download'
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def response_headers(resp, filename):
+    headers = {name: resp.getheader(name) for name in PASSTHROUGH_HEADERS if resp.getheader(name)}
+    headers.setdefault('Accept-Ranges', 'bytes')
+    headers['Content-Disposition'] = content_disposition(filename)
+    return headers
+
+
+# Parallel ranged fetching. YouTube ek connection ko throttle karta hai aur bade
+# unranged requests ko slow kar deta hai, isliye file ko chhote byte ranges me
+# kai pooled connections pe parallel fetch karke order me client ko bhejte hain.
+RANGE_CHUNK_MIN = int(os.environ.get('PROXY_CHUNK_MIN', 1024 * 1024))
+RANGE_CHUNK_MAX = int(os.environ.get('PROXY_CHUNK_MAX', 10 * 1024 * 1024))
+RANGE_CHUNK_INITIAL = int(os.environ.get('PROXY_CHUNK_SIZE', 2 * 1024 * 1024))
+MAX_CONNECTIONS = int(os.environ.get('PROXY_MAX_CONNECTIONS', 6))
+MAX_INFLIGHT_BYTES = int(os.environ.get('PROXY_MAX_INFLIGHT_MB', 32)) * 1024 * 1024
+# Per-download target rate; parallelism is sized to reach it from per-connection throughput
+TARGET_RATE = int(os.environ.get('PROXY_TARGET_RATE_MB', 8)) * 1024 * 1024
+# A chunk should take about this long on one connection
+CHUNK_SECONDS = 2.0
+CHUNK_RETRIES = 2
+
+
+class ConnectionPool:
+    """Keeps idle keep-alive connections per host for reuse across chunk requests."""
+
+    def __init__(self, max_idle_per_host=MAX_CONNECTIONS * 2):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, parts):
+        key = (parts.scheme, parts.netloc)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return _connect(parts)
+
+    def put(self, parts, conn):
+        key = (parts.scheme, parts.netloc)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+
+class ThroughputTuner:
+    """EWMA of per-connection throughput per upstream host, used to size chunks and parallelism."""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def record(self, host, nbytes, seconds):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        rate = nbytes / seconds
+        with self._lock:
+            prev = self._rates.get(host)
+            self._rates[host] = rate if prev is None else prev + self.alpha * (rate - prev)
+
+    def rate(self, host):
+        with self._lock:
+            return self._rates.get(host)
+
+    def chunk_size(self, host):
+        rate = self.rate(host)
+        if rate is None:
+            return RANGE_CHUNK_INITIAL
+        return int(min(RANGE_CHUNK_MAX, max(RANGE_CHUNK_MIN, rate * CHUNK_SECONDS)))
+
+    def parallelism(self, host):
+        rate = self.rate(host)
+        if rate is None:
+            return min(2, MAX_CONNECTIONS)
+        return max(1, min(MAX_CONNECTIONS, math.ceil(TARGET_RATE / rate)))
+
+
+pool = ConnectionPool()
+tuner = ThroughputTuner()
+
+
+MAX_RANGES = 16
+
+
+def parse_ranges(header, total):
+    """Satisfiable (start, end) pairs of a `bytes=` Range header, sorted and coalesced.
+
+    Returns None when there is no usable Range header (the full body should
+    be sent) and raises RangeNotSatisfiable when no range overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(','):
+        m = re.fullmatch(r'\s*(\d*)\s*-\s*(\d*)\s*', part)
+        if not m or (not m.group(1) and not m.group(2)):
+            return None
+        if m.group(1):
+            start = int(m.group(1))
+            if m.group(2) and int(m.group(2)) < start:
+                return None
+            end = min(int(m.group(2)), total - 1) if m.group(2) else total - 1
+        else:
+            start, end = max(0, total - int(m.group(2))), total - 1
+        if start < total and end >= start:
+            ranges.append((start, end))
+    if len(spec.split(',')) > MAX_RANGES:
+        return None
+    if not ranges:
+        raise RangeNotSatisfiable()
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def parse_range(header, total):
+    """(start, end) inclusive for a single `bytes=` range, or None for no/unsupported/multi Range."""
+    ranges = parse_ranges(header, total)
+    if ranges is None or len(ranges) != 1:
+        return None
+    return ranges[0]
+
+
+def fetch_range(url, headers, start=None, end=None):
+    """Fetches bytes [start, end] (the whole resource if start is None) over a pooled connection, retrying on a fresh one."""
+    parts = urlsplit(url)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    req_headers = dict(DEFAULT_HEADERS)
+    req_headers.update(headers or {})
+    req_headers['Accept-Encoding'] = 'identity'
+    if start is not None:
+        req_headers['Range'] = f'bytes={start}-{end}'
+    expected = end - start + 1 if start is not None else None
+    ok_status = 206 if start is not None else 200
+
+    last_error = None
+    for _ in range(CHUNK_RETRIES + 1):
+        conn = pool.get(parts)
+        began = time.monotonic()
+        try:
+            conn.request('GET', path, headers=req_headers)
+            resp = conn.getresponse()
+            if resp.status in (301, 302, 303, 307, 308):
+                resp.read()
+                pool.put(parts, conn)
+                # Redirect ke baad pooled path chhod ke seedha fetch
+                with open_upstream(urljoin(url, resp.getheader('Location')), headers,
+                                   req_headers.get('Range')) as redirected:
+                    data = redirected.read()
+            elif resp.status != ok_status:
+                conn.close()
+                raise UpstreamError(f"Upstream returned {resp.status} for range", status=resp.status)
+            else:
+                data = resp.read()
+                if resp.will_close:
+                    conn.close()
+                else:
+                    pool.put(parts, conn)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            last_error = UpstreamError(f"Range fetch failed: {e}")
+            continue
+        except UpstreamError as e:
+            if e.status in (403, 404, 410, 416):
+                raise
+            last_error = e
+            continue
+        if expected is not None and len(data) != expected:
+            last_error = UpstreamError(f"Short range read: {len(data)} of {expected} bytes")
+            continue
+        tuner.record(parts.netloc, len(data), time.monotonic() - began)
+        return data
+    raise last_error
+
+
+class ParallelRangeBody:
+    """Streams bytes [start, end] of `url` fetched as parallel ranged chunks, in order.
+
+    Chunks outstanding at once are capped by the tuned parallelism and by
+    MAX_INFLIGHT_BYTES, so memory stays bounded however large the file is.
+    """
+
+    def __init__(self, url, headers, start, end):
+        self.url = url
+        self.headers = headers
+        self.host = urlsplit(url).netloc
+        self.next_offset = start
+        self.end = end
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONNECTIONS)
+        self.closed = False
+
+    def _fill(self):
+        chunk_size = tuner.chunk_size(self.host)
+        inflight = max(1, min(tuner.parallelism(self.host), MAX_INFLIGHT_BYTES // chunk_size))
+        while len(self.pending) < inflight and self.next_offset <= self.end:
+            chunk_end = min(self.next_offset + chunk_size - 1, self.end)
+            self.pending.append(self.executor.submit(
+                fetch_range, self.url, self.headers, self.next_offset, chunk_end))
+            self.next_offset = chunk_end + 1
+
+    def prime(self):
+        """Waits for the first chunk, so an upstream error (an expired URL's 403) surfaces before a response goes out."""
+        try:
+            self._fill()
+            if self.pending:
+                self.pending[0].result()
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __iter__(self):
+        try:
+            self._fill()
+            while self.pending and not self.closed:
+                data = self.pending.popleft().result()
+                self._fill()
+                yield data
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+
+
+def format_body(f):
+    """Whole-file body for a format: parallel ranges when the size is known, else one stream."""
+    if f.get('filesize'):
+        return ParallelRangeBody(f['url'], f.get('http_headers'), 0, f['filesize'] - 1)
+    return UpstreamBody(open_upstream(f['url'], f.get('http_headers')))
+
+
+def guess_content_type(ext):
+    return mimetypes.guess_type(f'file.{ext}')[0] or 'application/octet-stream'
+
+
+def ranged_response_headers(start, end, total, ext, filename, partial):
+    headers = {
+        'Content-Type': guess_content_type(ext),
+        'Content-Length': str(end - start + 1),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition(filename),
+    }
+    if partial:
+        headers['Content-Range'] = f'bytes {start}-{end}/{total}'
+    return headers
+
+
+# Cached files sendfile(2) se seedhe client socket pe jaate hain (media_cache.FileBody)
+def client_socket(environ):
+    """The raw client socket from the WSGI server, if it exposes a plain one."""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None or isinstance(sock, ssl.SSLSocket):
+        return None
+    return sock
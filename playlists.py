@@ -0,0 +1,374 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from yt_dlp.utils import PagedList
+
+import media_cache
+
+logger = logging.getLogger(__name__)
+
+# Playlist/channel URL pe har video ka full extraction minute aur GB kha jaata
+# hai. Isliye listing flat hoti hai (sirf id/title/duration, yt-dlp ke pages
+# jaise jaise aate hain) aur pages me client tak jaati hai. yt-dlp ka entries
+# generator listing ke saath zinda rehta hai, toh agla page wahin se aage
+# badhta hai jahan pichla ruka tha; pehle ke pages dobara crawl nahi hote.
+# Kisi video ke formats tabhi resolve hote hain jab uski entry kholi jaaye.
+#
+# Listing ka snapshot media cache me bhi jaata hai. Wahi playlist dobara aaye
+# toh naya source sirf pehli pehchani hui entry tak padha jaata hai (zyada se
+# zyada ek page); usse pehle wali entries nayi hain aur purani listing ke aage
+# jud jaati hain, poora crawl dobara nahi hota.
+PLAYLIST_PAGE_SIZE = int(os.environ.get('PLAYLIST_PAGE_SIZE', 50))
+PLAYLIST_CACHE_MAX = int(os.environ.get('PLAYLIST_CACHE_MAX', 64))
+# yt-dlp ka live source (continuation tokens) itni der rakhte hain; baad me snapshot se
+PLAYLIST_TTL = int(os.environ.get('PLAYLIST_TTL', 6 * 3600))
+PLAYLIST_MAX_ENTRIES = int(os.environ.get('PLAYLIST_MAX_ENTRIES', 5000))
+MAX_URL_HOPS = 3
+
+
+class PlaylistError(Exception):
+    pass
+
+
+def encode_cursor(playlist_id, offset):
+    raw = json.dumps([playlist_id, offset], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor, playlist_id):
+    """Offset a cursor points at; raises PlaylistError if it isn't one of this playlist's."""
+    try:
+        cid, offset = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise PlaylistError("Malformed cursor")
+    if cid != playlist_id or not isinstance(offset, int) or offset < 0:
+        raise PlaylistError("Cursor is for a different playlist")
+    return offset
+
+
+def _thumbnail(entry):
+    if entry.get('thumbnail'):
+        return entry['thumbnail']
+    thumbs = [t for t in entry.get('thumbnails') or [] if t.get('url')]
+    return thumbs[-1]['url'] if thumbs else None
+
+
+def _iter_entries(entries):
+    # yt-dlp entries list, generator ya PagedList (page dar page) ho sakte hain
+    if isinstance(entries, PagedList):
+        start = 0
+        while True:
+            page = entries.getslice(start, start + PLAYLIST_PAGE_SIZE)
+            if not page:
+                return
+            yield from page
+            start += len(page)
+    else:
+        yield from entries or []
+
+
+def _finished(ended, count, entries):
+    # Snapshot ka "ant" tabhi maano jab source sach me khatm hua tha aur extractor ki
+    # batayi ginti bhi itni hi entries kehti ho (ya cap tak pahunch gaye)
+    if len(entries) >= PLAYLIST_MAX_ENTRIES:
+        return True
+    return bool(ended) and not (count and count > len(entries))
+
+
+class Listing:
+    """Flat entries of one playlist seen so far, plus the live yt-dlp source to read more from."""
+
+    def __init__(self, playlist_id, url, title=None, uploader=None, ie_key=None, thumbnail=None, count=None):
+        self.id = playlist_id
+        self.url = url
+        self.title = title
+        self.uploader = uploader
+        self.ie_key = ie_key
+        self.thumbnail = thumbnail
+        # Extractor ki batayi kul ginti, agar pata ho
+        self.count = count
+        self.entries = []
+        self.complete = False
+        self.new_count = 0
+        # Is index se aage padhi entries nayi hain (playlist ke ant me judi hui)
+        self._new_from = None
+        # Snapshot ke baad entries badli hain ya nahi
+        self.dirty = True
+        self.expires = time.time() + PLAYLIST_TTL
+        self._seen = set()
+        self._source = iter(())
+        self._ydl = None
+        self._new_ydl = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_result(cls, result, ydl, url, new_ydl):
+        listing = cls(result['id'], result.get('webpage_url') or url, result.get('title'),
+                      result.get('uploader') or result.get('channel'), result.get('extractor_key'),
+                      _thumbnail(result), result.get('playlist_count'))
+        listing._source = _iter_entries(result.get('entries'))
+        listing._ydl = ydl
+        listing._new_ydl = new_ydl
+        return listing
+
+    @classmethod
+    def from_snapshot(cls, snap, new_ydl):
+        listing = cls(snap['id'], snap['url'], snap.get('title'), snap.get('uploader'), snap.get('ie_key'),
+                      snap.get('thumbnail'), snap.get('count'))
+        listing.entries = snap['entries']
+        listing._seen = {e['id'] for e in listing.entries}
+        listing.complete = _finished(snap.get('ended'), listing.count, listing.entries)
+        listing.dirty = False
+        listing._new_ydl = new_ydl
+        if not listing.complete:
+            listing._source = listing._reopen(new_ydl)
+        return listing
+
+    def _reopen(self, new_ydl):
+        # Snapshot ke aage ke pages chahiye toh playlist phir kholo; dekhi hui entries skip hongi
+        ydl, result = _extract(self.url, new_ydl)
+        self._ydl = ydl
+        if result.get('_type') in ('playlist', 'multi_video'):
+            yield from _iter_entries(result.get('entries'))
+
+    def _pull(self):
+        try:
+            e = next(self._source)
+        except StopIteration:
+            self._finish()
+            return
+        except Exception as e:
+            # Beech ka error (network, 429) playlist ka ant nahi hai: source band karo,
+            # agli request pe playlist phir khulegi aur dekhi hui entries skip hongi
+            self.close()
+            self._source = self._reopen(self._new_ydl)
+            logger.error(f"Listing {self.id} failed after {len(self.entries)} entries, will reopen: {e}")
+            raise PlaylistError("Could not load more of this playlist")
+        if not e or not e.get('id') or e['id'] in self._seen:
+            return
+        self._seen.add(e['id'])
+        self.dirty = True
+        entry = {
+            'index': len(self.entries) + 1, 'id': e['id'], 'title': e.get('title'),
+            'duration': e.get('duration'), 'thumbnail': _thumbnail(e),
+            'url': e.get('url') or e.get('webpage_url'), 'ie_key': e.get('ie_key') or e.get('extractor_key'),
+        }
+        if self._new_from is not None and len(self.entries) >= self._new_from:
+            entry['new'] = True
+        self.entries.append(entry)
+        if len(self.entries) >= PLAYLIST_MAX_ENTRIES:
+            self._finish()
+
+    def _finish(self):
+        self.complete = True
+        self.dirty = True
+        self._source = iter(())
+        self.close()
+
+    def sync(self, known, ended, older=None, known_count=None):
+        """Puts what this fresh listing has ahead of previously seen entries `known` in front of them.
+
+        The fresh source is read only up to the first entry already known,
+        and at most one page; False if none turned up, in which case this
+        listing just stands on its own. `ended` says `known` ran to the end
+        of the playlist; `older` is the previous live listing, whose source
+        is taken over to page past `known`.
+
+        Entries ahead of `known` are new on newest-first sources (channels,
+        uploads). When the top is unchanged but playlist_count grew past
+        `known_count` (the count `known` was listed under), the playlist
+        grew at its end instead, as ordinary playlists do: the growth is
+        reported as new and those entries are flagged as they are read.
+        """
+        position = {e['id']: i for i, e in enumerate(known)}
+        with self._lock:
+            anchor = None
+            while anchor is None and len(self.entries) < PLAYLIST_PAGE_SIZE and not self.complete:
+                before = len(self.entries)
+                self._pull()
+                if len(self.entries) > before and self.entries[-1]['id'] in position:
+                    anchor = position[self.entries.pop()['id']]
+            if anchor is None:
+                return False
+            head = [dict(e, new=True) for e in self.entries]
+            tail = [{k: v for k, v in e.items() if k != 'new'} for e in known[anchor:]]
+            self.entries = head + tail
+            for i, e in enumerate(self.entries, 1):
+                e['index'] = i
+            self._seen = {e['id'] for e in self.entries}
+            self.new_count = len(head)
+            if not head and known_count and self.count and self.count > known_count:
+                # Upar kuch nahi badla par ginti badh gayi: entries ant me judi hain
+                self.new_count = self.count - known_count
+                self._new_from = known_count
+            self.dirty = True
+            if older is not None:
+                with older._lock:
+                    if older._ydl is not None and not older.complete:
+                        # Purana source wahin khada hai jahan `known` khatm hota hai
+                        fresh_ydl, self._ydl = self._ydl, older._ydl
+                        self._source, older._source, older._ydl = older._source, iter(()), None
+                        if fresh_ydl is not None:
+                            fresh_ydl.close()
+                        return True
+            if _finished(ended, self.count, self.entries):
+                self._finish()
+            # Warna naya source hi aage chalega, pehchani hui entries skip karte hue
+            return True
+
+    def entry(self, i):
+        """Entry at 0-based position `i`, reading further into the playlist if needed; None past the end."""
+        with self._lock:
+            while len(self.entries) <= i and not self.complete:
+                self._pull()
+            return self.entries[i] if i < len(self.entries) else None
+
+    def page(self, offset, count=PLAYLIST_PAGE_SIZE):
+        """Yields entries [offset, offset + count) as they are read."""
+        for i in range(offset, offset + count):
+            entry = self.entry(i)
+            if entry is None:
+                return
+            yield entry
+
+    def next_cursor(self, offset):
+        if self.complete and offset >= len(self.entries):
+            return None
+        return encode_cursor(self.id, offset)
+
+    def snapshot(self):
+        with self._lock:
+            return {'id': self.id, 'url': self.url, 'title': self.title, 'uploader': self.uploader,
+                    'ie_key': self.ie_key, 'thumbnail': self.thumbnail, 'count': self.count,
+                    'ended': self.complete, 'saved': int(time.time()),
+                    'entries': [{k: v for k, v in e.items() if k != 'new'} for e in self.entries]}
+
+    def close(self):
+        ydl, self._ydl = self._ydl, None
+        if ydl is not None:
+            ydl.close()
+
+
+def _extract(url, new_ydl):
+    """(ydl, result): the playlist result with its lazy entries (ydl left open), or the fully processed video."""
+    ydl = new_ydl()
+    try:
+        result = ydl.extract_info(url, download=False, process=False)
+        for _ in range(MAX_URL_HOPS):
+            if result.get('_type') != 'url':
+                break
+            result = ydl.extract_info(result['url'], download=False, ie_key=result.get('ie_key'), process=False)
+        if result.get('_type') in ('playlist', 'multi_video'):
+            # ydl listing ke saath khula rehta hai, agle pages usi se aate hain
+            return ydl, result
+        result = ydl.process_ie_result(result, download=False)
+    except BaseException:
+        ydl.close()
+        raise
+    ydl.close()
+    return None, result
+
+
+def open_url(url, new_ydl):
+    """(Listing, None) for a playlist or channel URL, (None, info) with the video fully extracted otherwise.
+
+    `new_ydl()` builds the YoutubeDL to use; it must have extract_flat='in_playlist'.
+    """
+    ydl, result = _extract(url, new_ydl)
+    if ydl is None:
+        return None, result
+    return Listing.from_result(result, ydl, url, new_ydl), None
+
+
+class PlaylistRegistry:
+    """Live listings by playlist id (LRU past PLAYLIST_CACHE_MAX), backed by snapshots in the media cache.
+
+    Snapshots outlive the live yt-dlp sources, are shared by all workers and
+    survive restarts; a listing missing here is restored from its snapshot.
+    """
+
+    def __init__(self, store, new_ydl, max_entries=PLAYLIST_CACHE_MAX):
+        self.store = store
+        self.new_ydl = new_ydl
+        self.max_entries = max_entries
+        self._listings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, playlist_id):
+        return media_cache.cache_key(playlist_id, 'playlist')
+
+    def saved(self, playlist_id):
+        path = self.store.get(self._key(playlist_id), 'json')
+        if not path:
+            return None
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, listing):
+        """Writes the listing's snapshot if it changed since the last save."""
+        if not listing.dirty:
+            return
+        listing.dirty = False
+        snap = listing.snapshot()
+        writer = self.store.writer(self._key(listing.id), 'json')
+        try:
+            writer.write(json.dumps(snap, separators=(',', ':')).encode())
+            writer.commit()
+        except OSError as e:
+            writer.abort()
+            listing.dirty = True
+            logger.error(f"Could not save listing {listing.id}: {e}")
+
+    def _put(self, listing):
+        with self._lock:
+            old = self._listings.pop(listing.id, None)
+            self._listings[listing.id] = listing
+            evicted = []
+            while len(self._listings) > self.max_entries:
+                evicted.append(self._listings.popitem(last=False)[1])
+        for stale in ([old] if old is not None and old is not listing else []) + evicted:
+            stale.close()
+
+    def add(self, listing):
+        """Registers a freshly opened listing, first syncing it against what was seen of it before."""
+        with self._lock:
+            older = self._listings.get(listing.id)
+        if older is not None:
+            with older._lock:
+                known, ended, known_count = list(older.entries), older.complete, older.count
+            # Expired listing ka source purana ho chuka, sirf uski entries kaam ki hain
+            synced = listing.sync(known, ended, older if older.expires > time.time() else None, known_count)
+        else:
+            snap = self.saved(listing.id)
+            synced = False
+            if snap:
+                synced = listing.sync(snap['entries'], snap.get('ended'), known_count=snap.get('count'))
+        if synced:
+            logger.info(f"Listing {listing.id} synced: {listing.new_count} new, {len(listing.entries)} known")
+        self._put(listing)
+        return listing
+
+    def get(self, playlist_id):
+        with self._lock:
+            listing = self._listings.get(playlist_id)
+            if listing is not None and listing.expires > time.time():
+                self._listings.move_to_end(playlist_id)
+                return listing
+        snap = self.saved(playlist_id)
+        if snap is None:
+            if listing is not None:
+                with self._lock:
+                    self._listings.pop(playlist_id, None)
+                listing.close()
+            return None
+        restored = Listing.from_snapshot(snap, self.new_ydl)
+        self._put(restored)
+        return restored
@@ -0,0 +1,248 @@
+import json
+import logging
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import media_cache
+import media_proxy
+import transcode
+
+logger = logging.getLogger(__name__)
+
+# Seek preview sprite. YouTube storyboards (sb0..sb3) pehle se tiles ki grid
+# images hain; jo tiles chahiye sirf wahi images fetch karke crop/scale karte
+# hain aur ek sprite sheet banate hain, video download kiye bina. Storyboard
+# na ho toh ffmpeg kuch timestamps pe sirf keyframe decode karta hai
+# (-skip_frame nokey), jo Range requests se bas uske aas-paas ke bytes padhta hai.
+PREVIEW_TILES = int(os.environ.get('PREVIEW_TILES', 50))
+PREVIEW_COLUMNS = 10
+PREVIEW_TILE_WIDTH = 160
+# Storyboard images itni se zyada fetch karni padein toh chhoti tiles wala storyboard lo
+PREVIEW_MAX_FETCHES = 12
+PREVIEW_FETCHERS = 4
+KEYFRAME_TILES = int(os.environ.get('PREVIEW_KEYFRAME_TILES', 20))
+KEYFRAME_WORKERS = 4
+# Scheduler ke liye keyframe fallback ka andaza
+KEYFRAME_CPU_SECONDS = 0.1 * KEYFRAME_TILES
+PREVIEW_TIMEOUT = 30
+
+
+class PreviewError(Exception):
+    pass
+
+
+def _even(n):
+    return max(2, int(round(n / 2)) * 2)
+
+
+def _times(duration, count):
+    return [(i + 0.5) * duration / count for i in range(count)]
+
+
+def storyboard_tiles(sb, duration, times):
+    """(fragment index, x, y) of the storyboard tile showing each time."""
+    per_image = sb['columns'] * sb['rows']
+    last = max(0, min(int(sb['fps'] * duration), len(sb['fragments']) * per_image) - 1)
+    tiles = []
+    for t in times:
+        k = min(int(t * sb['fps']), last)
+        index = k % per_image
+        tiles.append((k // per_image, (index % sb['columns']) * sb['width'], (index // sb['columns']) * sb['height']))
+    return tiles
+
+
+def pick_storyboard(info):
+    """Storyboard format with the sharpest tiles that needs at most PREVIEW_MAX_FETCHES images, else the fewest."""
+    duration = info.get('duration')
+    boards = [f for f in info.get('formats') or []
+              if f.get('format_note') == 'storyboard' and f.get('fragments')
+              and all(f.get(k) for k in ('fps', 'columns', 'rows', 'width', 'height'))]
+    if not boards or not duration:
+        return None
+
+    def score(sb):
+        count = min(PREVIEW_TILES, max(1, int(sb['fps'] * duration)))
+        fetches = len({j for j, _, _ in storyboard_tiles(sb, duration, _times(duration, count))})
+        return (fetches <= PREVIEW_MAX_FETCHES, sb['width'] if fetches <= PREVIEW_MAX_FETCHES else -fetches)
+
+    return max(boards, key=score)
+
+
+def keyframe_format(info):
+    """Smallest direct-URL video format, cheapest to seek and decode keyframes from."""
+    videos = [f for f in info.get('formats') or []
+              if f.get('vcodec') not in (None, 'none') and f.get('url')
+              and f.get('protocol', 'https') in ('http', 'https')]
+    if not videos:
+        return None
+    return min(videos, key=lambda f: (f.get('height') or 10000, f.get('tbr') or 0))
+
+
+def _run(cmd):
+    try:
+        proc = subprocess.run(cmd, capture_output=True, timeout=PREVIEW_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return "timed out"
+    if proc.returncode != 0:
+        return proc.stderr.decode(errors='replace').strip()[-300:] or f"exit {proc.returncode}"
+    return None
+
+
+class PreviewBuilder:
+    """Builds and caches one seek-preview sprite (plus its JSON layout) per video."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._locks = [threading.Lock() for _ in range(64)]
+
+    def _keys(self, video_id):
+        return media_cache.cache_key(video_id, 'preview:meta'), media_cache.cache_key(video_id, 'preview:sprite')
+
+    def cached(self, video_id):
+        meta_key, sprite_key = self._keys(video_id)
+        path = self.cache.get(meta_key, 'json')
+        if not path or not self.cache.get(sprite_key, 'jpg'):
+            return None
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def sprite_path(self, video_id):
+        return self.cache.get(self._keys(video_id)[1], 'jpg')
+
+    def build(self, info, ticket=None):
+        """Layout of the video's preview sprite, building it on a miss.
+
+        Storyboards are used when the video has them; otherwise keyframes
+        are decoded, which needs an admitted scheduler `ticket`.
+        """
+        video_id = info['id']
+        meta_key, sprite_key = self._keys(video_id)
+        with self._locks[int(meta_key[:8], 16) % len(self._locks)]:
+            meta = self.cached(video_id)
+            if meta:
+                return meta
+            workdir = tempfile.mkdtemp(prefix='vd-preview-')
+            try:
+                sb = pick_storyboard(info)
+                if sb:
+                    times, size = self._storyboard(info, sb, workdir)
+                    source = 'storyboard'
+                elif ticket is not None:
+                    times, size = self._keyframes(info, workdir)
+                    source = 'keyframes'
+                else:
+                    raise PreviewError("No storyboard for this video")
+                if not times:
+                    raise PreviewError("Could not extract any preview frames")
+                meta = self._compose(video_id, sprite_key, meta_key, workdir, times, size, source, info['duration'])
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            logger.info(f"Preview for {video_id}: {len(times)} tiles from {source}")
+            return meta
+
+    def _storyboard(self, info, sb, workdir):
+        duration = info['duration']
+        count = min(PREVIEW_TILES, max(1, int(sb['fps'] * duration)))
+        times = _times(duration, count)
+        tiles = storyboard_tiles(sb, duration, times)
+        width = PREVIEW_TILE_WIDTH
+        height = _even(width * sb['height'] / sb['width'])
+        needed = sorted({j for j, _, _ in tiles})
+
+        def fetch(j):
+            path = os.path.join(workdir, f'sb{j}.img')
+            with open(path, 'wb') as fh:
+                fh.write(media_proxy.fetch_range(sb['fragments'][j]['url'], sb.get('http_headers')))
+            return path
+
+        try:
+            with ThreadPoolExecutor(max_workers=PREVIEW_FETCHERS) as pool:
+                images = dict(zip(needed, pool.map(fetch, needed)))
+        except (media_proxy.UpstreamError, OSError) as e:
+            raise PreviewError(f"Storyboard fetch failed: {e}")
+
+        # Har storyboard image se uski saari tiles ek hi ffmpeg run me
+        for j in needed:
+            mine = [(i, x, y) for i, (fj, x, y) in enumerate(tiles) if fj == j]
+            graph = f"[0:v]split={len(mine)}" + ''.join(f'[s{i}]' for i, _, _ in mine) + ';'
+            graph += ';'.join(f"[s{i}]crop={sb['width']}:{sb['height']}:{x}:{y},scale={width}:{height}[t{i}]"
+                              for i, x, y in mine)
+            cmd = [transcode.FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', images[j],
+                   '-filter_complex', graph]
+            for i, _, _ in mine:
+                cmd += ['-map', f'[t{i}]', '-frames:v', '1', '-q:v', '3', '-y', os.path.join(workdir, f't{i:03d}.jpg')]
+            error = _run(cmd)
+            if error:
+                raise PreviewError(f"Storyboard crop failed: {error}")
+        return times, (width, height)
+
+    def _keyframes(self, info, workdir):
+        f = keyframe_format(info)
+        if f is None:
+            raise PreviewError("No video format to take keyframes from")
+        duration = info['duration']
+        times = _times(duration, KEYFRAME_TILES)
+        width = PREVIEW_TILE_WIDTH
+        height = _even(width * (f.get('height') or 9) / (f.get('width') or 16))
+        scale = (f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                 f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2")
+
+        def grab(i):
+            # -noaccurate_seek: seek point se pehle wala keyframe hi le lo, aage decode mat karo
+            cmd = [transcode.FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error',
+                   '-skip_frame', 'nokey', '-noaccurate_seek'] + transcode.http_input_args(f, times[i])
+            cmd += ['-map', '0:v:0', '-frames:v', '1', '-vf', scale, '-q:v', '3', '-y',
+                    os.path.join(workdir, f'k{i:03d}.jpg')]
+            error = _run(cmd)
+            if error:
+                logger.warning(f"Keyframe at {times[i]:.1f}s of {info['id']} failed: {error}")
+            return error is None
+
+        with ThreadPoolExecutor(max_workers=KEYFRAME_WORKERS) as pool:
+            ok = list(pool.map(grab, range(len(times))))
+        # Jo frames nahi mile unhe chhod ke tiles ko lagataar number do
+        kept = []
+        for i, good in enumerate(ok):
+            if good:
+                os.rename(os.path.join(workdir, f'k{i:03d}.jpg'), os.path.join(workdir, f't{len(kept):03d}.jpg'))
+                kept.append(times[i])
+        return kept, (width, height)
+
+    def _compose(self, video_id, sprite_key, meta_key, workdir, times, size, source, duration):
+        count = len(times)
+        columns = min(PREVIEW_COLUMNS, count)
+        rows = math.ceil(count / columns)
+        writer = self.cache.writer(sprite_key, 'jpg')
+        cmd = [transcode.FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error',
+               '-framerate', '1', '-i', os.path.join(workdir, 't%03d.jpg'),
+               '-vf', f'tile={columns}x{rows}:nb_frames={count}', '-frames:v', '1', '-q:v', '4', '-pix_fmt', 'yuvj420p',
+               '-f', 'mjpeg', '-y', writer.part_path]
+        error = _run(cmd)
+        if error:
+            writer.abort()
+            raise PreviewError(f"Sprite compose failed: {error}")
+        writer.size = os.path.getsize(writer.part_path)
+        writer.commit()
+
+        meta = {
+            'id': video_id, 'source': source, 'sprite': f'/preview/{video_id}/sprite',
+            'columns': columns, 'rows': rows, 'count': count,
+            'tile_width': size[0], 'tile_height': size[1],
+            'duration': duration, 'times': [round(t, 1) for t in times],
+        }
+        writer = self.cache.writer(meta_key, 'json')
+        try:
+            writer.write(json.dumps(meta).encode())
+            writer.commit()
+        except OSError:
+            writer.abort()
+            raise
+        return meta
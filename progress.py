@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import re
+import select
+import threading
+import time
+
+from websockets.datastructures import Headers
+from websockets.http11 import Request
+from websockets.protocol import State
+from websockets.server import ServerProtocol
+
+logger = logging.getLogger(__name__)
+
+# Server-side jobs (proxy download, ffmpeg mux/transcode, playlist zip) ki
+# progress. Client apna random job id `?progress=<id>` ke saath bhejta hai aur
+# /progress/<id> pe WebSocket kholta hai. Job sirf latest snapshot rakhta hai;
+# watchers version number se dekhte hain ki kuch naya hai ya nahi, isliye
+# update ka kharcha watchers ki ginti pe depend nahi karta.
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 0.5))
+# Har watcher ek worker thread pakadta hai (gthread), isliye cap zaroori hai
+PROGRESS_MAX_WATCHERS = int(os.environ.get('PROGRESS_MAX_WATCHERS', 8))
+JOB_TTL = 300
+MAX_JOBS = 10000
+PING_INTERVAL = 20
+RATE_WINDOW = 0.5
+JOB_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+FINAL_STAGES = ('done', 'error')
+
+
+def valid_job_id(job_id):
+    return bool(job_id and JOB_ID_RE.match(job_id))
+
+
+class Job:
+    """Latest progress of one server-side job; updates are published at most every PROGRESS_INTERVAL."""
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.stage = 'waiting'
+        self.bytes = 0
+        self.total = None
+        self.position = None
+        self.duration = None
+        self.error = None
+        self.detail = {}
+        self.rate = 0.0
+        self.speed = None
+        self.version = 0
+        self.published = 0.0
+        self.touched = time.monotonic()
+        self.window_start = self.touched
+        self.window_bytes = 0
+        self.position_mark = None
+        self.cond = threading.Condition()
+
+    def _publish(self, force=False):
+        now = time.monotonic()
+        self.touched = now
+        if force or now - self.published >= PROGRESS_INTERVAL:
+            self.published = now
+            self.version += 1
+            self.cond.notify_all()
+
+    def update(self, stage=None, total=None, position=None, duration=None, **detail):
+        with self.cond:
+            changed = stage is not None and stage != self.stage
+            if stage is not None:
+                self.stage = stage
+            if total is not None:
+                self.total = total
+            if duration is not None:
+                self.duration = duration
+            if position is not None:
+                now = time.monotonic()
+                # Media seconds per wall second, ffmpeg ki `speed=` jaisa
+                if self.position_mark and now > self.position_mark[0]:
+                    sample = (position - self.position_mark[1]) / (now - self.position_mark[0])
+                    self.speed = sample if self.speed is None else self.speed + 0.3 * (sample - self.speed)
+                self.position_mark = (now, position)
+                self.position = position
+            self.detail.update(detail)
+            self._publish(force=changed)
+
+    def advance(self, n):
+        """Counts `n` more bytes done (sent to the client or written by the job)."""
+        with self.cond:
+            self.bytes += n
+            self.window_bytes += n
+            now = time.monotonic()
+            elapsed = now - self.window_start
+            if elapsed >= RATE_WINDOW:
+                sample = self.window_bytes / elapsed
+                self.rate = sample if not self.rate else self.rate + 0.5 * (sample - self.rate)
+                self.window_start = now
+                self.window_bytes = 0
+            self._publish()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.stage = 'error' if error else 'done'
+            self.error = error
+            self._publish(force=True)
+
+    def eta(self):
+        if self.stage in FINAL_STAGES:
+            return 0
+        if self.duration and self.position is not None and self.speed:
+            return max(0, int((self.duration - self.position) / self.speed))
+        if self.total and self.rate:
+            return max(0, int((self.total - self.bytes) / self.rate))
+        return None
+
+    def snapshot(self):
+        with self.cond:
+            snap = {'id': self.id, 'stage': self.stage, 'bytes': self.bytes, 'total': self.total,
+                    'rate': int(self.rate), 'eta': self.eta(), 'version': self.version}
+            if self.duration:
+                snap['position'] = round(self.position or 0, 1)
+                snap['duration'] = self.duration
+                snap['percent'] = round(min(100.0, 100.0 * (self.position or 0) / self.duration), 1)
+            elif self.total:
+                snap['percent'] = round(min(100.0, 100.0 * self.bytes / self.total), 1)
+            if self.error:
+                snap['error'] = self.error
+            snap.update(self.detail)
+            return snap
+
+    def wait(self, seen, timeout):
+        """Blocks until a version newer than `seen` is published or `timeout` passes; returns the version."""
+        with self.cond:
+            if self.version == seen:
+                self.cond.wait(timeout)
+            return self.version
+
+
+class ProgressHub:
+    def __init__(self):
+        self.jobs = {}
+        self.watchers = 0
+        self._lock = threading.Lock()
+
+    def job(self, job_id):
+        """The job with this id, created if new; None for ids that are not well-formed."""
+        if not valid_job_id(job_id):
+            return None
+        now = time.monotonic()
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                self._expire(now)
+                if len(self.jobs) >= MAX_JOBS:
+                    return None
+                job = self.jobs[job_id] = Job(job_id)
+            return job
+
+    def _expire(self, now):
+        for job_id in [i for i, j in self.jobs.items() if now - j.touched > JOB_TTL]:
+            del self.jobs[job_id]
+
+    def watch(self):
+        with self._lock:
+            if self.watchers >= PROGRESS_MAX_WATCHERS:
+                return False
+            self.watchers += 1
+            return True
+
+    def unwatch(self):
+        with self._lock:
+            self.watchers -= 1
+
+
+hub = ProgressHub()
+
+
+def job_for(job_id):
+    """Job for an optional `?progress=` id; None when absent or invalid."""
+    return hub.job(job_id) if job_id else None
+
+
+def read_ffmpeg_progress(fh, job, duration=None):
+    """Feeds `-progress` key=value lines from ffmpeg into a job until EOF."""
+    job.update(stage='converting', duration=duration)
+    for raw in fh:
+        key, _, value = raw.decode(errors='replace').strip().partition('=')
+        if key == 'out_time_us' and value.isdigit():
+            job.update(position=int(value) / 1e6)
+        elif key == 'total_size' and value.isdigit():
+            job.update(output_bytes=int(value))
+
+
+def is_websocket(environ):
+    return (environ.get('HTTP_UPGRADE', '').lower() == 'websocket'
+            and 'upgrade' in environ.get('HTTP_CONNECTION', '').lower())
+
+
+class WebSocketBody:
+    """Pushes a job's snapshots over a WebSocket on the raw client socket.
+
+    The handshake response goes out through the WSGI server as a normal
+    101; the empty first chunk flushes it, and after that frames are
+    written with the sans-I/O websockets protocol straight to the socket.
+    """
+
+    def __init__(self, protocol, sock, job):
+        self.protocol = protocol
+        self.sock = sock
+        self.job = job
+        self.closed = False
+
+    def _flush(self):
+        for data in self.protocol.data_to_send():
+            if data:
+                self.sock.sendall(data)
+
+    def _read_client(self):
+        # Client ke frames (close/ping) padho; band ho gaya toh False
+        while select.select([self.sock], [], [], 0)[0]:
+            data = self.sock.recv(4096)
+            if not data:
+                self.protocol.receive_eof()
+                return False
+            self.protocol.receive_data(data)
+            self.protocol.events_received()
+        self._flush()
+        return self.protocol.state is State.OPEN
+
+    def __iter__(self):
+        yield b''
+        try:
+            seen = -1
+            last_sent = time.monotonic()
+            while self._read_client():
+                version = self.job.wait(seen, timeout=1.0)
+                if version != seen:
+                    seen = version
+                    snap = self.job.snapshot()
+                    self.protocol.send_text(json.dumps(snap).encode())
+                    last_sent = time.monotonic()
+                    if snap['stage'] in FINAL_STAGES:
+                        self.protocol.send_close(1000)
+                        self._flush()
+                        break
+                elif time.monotonic() - last_sent > PING_INTERVAL:
+                    self.protocol.send_ping(b'')
+                    last_sent = time.monotonic()
+                self._flush()
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            hub.unwatch()
+
+
+def websocket_response(environ, sock, job):
+    """(status, headers, body) for a WebSocket handshake on `sock` that streams `job`."""
+    protocol = ServerProtocol()
+    headers = Headers()
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            headers[key[5:].replace('_', '-').title()] = value
+    response = protocol.accept(Request(environ.get('PATH_INFO', '/'), headers))
+    if response.status_code != 101:
+        return response.status_code, {}, [response.body or b'']
+    protocol.send_response(response)
+    protocol.data_to_send()  # handshake WSGI server bhejega, yahan se nahi
+    if not hub.watch():
+        return 503, {'Retry-After': '10'}, [b'Too many progress watchers']
+    # Date/Server WSGI server khud lagata hai
+    headers = {k: v for k, v in response.headers.raw_items() if k.lower() not in ('date', 'server')}
+    return 101, headers, WebSocketBody(protocol, sock, job)
@@ -0,0 +1,8 @@
+import pytest
+
+import media_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return media_cache.MediaCache(root=str(tmp_path / 'cache'), max_bytes=1024 * 1024)
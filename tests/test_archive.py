@@ -0,0 +1,119 @@
+import io
+import zipfile
+
+import pytest
+
+import archive
+
+
+def items(n):
+    return [{'id': f'v{i}', 'title': f'Video {i}', 'index': i, 'duration': 10} for i in range(1, n + 1)]
+
+
+def payload(item):
+    return item['id'].encode() * 1000
+
+
+def resolve(item, sized=True):
+    data = payload(item)
+    return archive.ZipEntry(f"{item['index']:02d} {item['title']}.m4a", lambda: iter([data[:700], data[700:]]),
+                            len(data) if sized else None)
+
+
+def broken_body():
+    yield b'x' * 10
+    raise ConnectionError("reset")
+
+
+def unzip(body):
+    return zipfile.ZipFile(io.BytesIO(b''.join(body)))
+
+
+class Job:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, **fields):
+        self.updates.append(fields)
+
+
+@pytest.mark.parametrize('sized', [True, False])
+def test_entries_are_zipped(sized):
+    zf = unzip(archive.ZipStreamBody(items(5), lambda item: resolve(item, sized)))
+    assert zf.testzip() is None
+    assert sorted(zf.namelist()) == [f"{i:02d} Video {i}.m4a" for i in range(1, 6)]
+    assert zf.read('03 Video 3.m4a') == payload({'id': 'v3'})
+    assert all(info.compress_type == zipfile.ZIP_STORED for info in zf.infolist())
+
+
+def test_failed_entries_go_to_missing_txt():
+    def flaky(item):
+        if item['id'] == 'v2':
+            raise archive.EntryError("No audio format")
+        if item['id'] == 'v4':
+            return archive.ZipEntry('04.m4a', broken_body, 100)
+        return resolve(item)
+
+    body = archive.ZipStreamBody(items(5), flaky)
+    zf = unzip(body)
+    missing = zf.read(archive.MISSING_NAME).decode()
+    assert 'Video 2 (v2): No audio format' in missing
+    assert 'Video 4 (v4): incomplete' in missing
+    assert body.ok
+
+
+def test_entries_past_the_limit_are_listed_not_dropped(monkeypatch):
+    monkeypatch.setattr(archive, 'ZIP_MAX_ENTRIES', 3)
+    resolved = []
+
+    def tracking(item):
+        resolved.append(item['id'])
+        return resolve(item)
+
+    zf = unzip(archive.ZipStreamBody(iter(items(6)), tracking))
+    assert sorted(resolved) == ['v1', 'v2', 'v3']
+    assert len(zf.namelist()) == 4
+    missing = zf.read(archive.MISSING_NAME).decode().splitlines()
+    assert missing == [f"Video {i} (v{i}): not included, archive holds at most 3 entries" for i in (4, 5, 6)]
+
+
+def test_listing_is_read_lazily():
+    seen = []
+
+    def listing():
+        for item in items(20):
+            seen.append(item['id'])
+            yield item
+
+    body = iter(archive.ZipStreamBody(listing(), resolve))
+    next(body)
+    # Sirf utni entries padhi jaati hain jitni workers ke paas resolve hone ko hain
+    assert len(seen) <= archive.ZIP_WORKERS + 1
+    body.close()
+
+
+def test_progress():
+    job = Job()
+    b''.join(archive.ZipStreamBody(items(3), resolve, progress=job))
+    assert job.updates[0] == {'duration': 30, 'entries_total': 3, 'entries_done': 0}
+    assert job.updates[-1]['entries_done'] == 3
+
+
+def test_close_stops_the_current_body():
+    closed = []
+
+    class Body:
+        def __iter__(self):
+            while True:
+                yield b'y' * 1000
+
+        def close(self):
+            closed.append(True)
+
+    body = archive.ZipStreamBody(items(1), lambda item: archive.ZipEntry('a.bin', Body, None))
+    stream = iter(body)
+    next(stream)
+    next(stream)
+    stream.close()
+    assert closed == [True]
+    assert not body.ok
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+import download_tokens
+from download_tokens import TokenError, make_token, verify_token
+
+
+def test_round_trip():
+    claims = verify_token(make_token('abc123', '140', 'Youtube'))
+    assert claims['video'] == 'abc123'
+    assert claims['format'] == '140'
+    assert claims['ie_key'] == 'Youtube'
+    assert claims['expires'] > time.time()
+
+
+def test_missing_ie_key_is_none():
+    assert verify_token(make_token('abc123', '140'))['ie_key'] is None
+
+
+def test_tampered_payload_is_rejected():
+    body, sig = make_token('abc123', '140').split('.')
+    other_body = make_token('zzz999', '140').split('.')[0]
+    with pytest.raises(TokenError, match="Bad signature"):
+        verify_token(f"{other_body}.{sig}")
+
+
+def test_tampered_signature_is_rejected():
+    body, sig = make_token('abc123', '140').split('.')
+    flipped = ('A' if sig[0] != 'A' else 'B') + sig[1:]
+    with pytest.raises(TokenError, match="Bad signature"):
+        verify_token(f"{body}.{flipped}")
+
+
+@pytest.mark.parametrize('token', ['', 'no-dot', 'abc.!!!', '.'])
+def test_malformed(token):
+    with pytest.raises(TokenError):
+        verify_token(token)
+
+
+def test_expired():
+    with pytest.raises(TokenError, match="expired"):
+        verify_token(make_token('abc123', '140', ttl=-1))
+
+
+def test_other_secret_is_rejected(monkeypatch):
+    token = make_token('abc123', '140')
+    monkeypatch.setattr(download_tokens, '_secret', b'another instance')
+    with pytest.raises(TokenError, match="Bad signature"):
+        verify_token(token)
+
+
+def test_client_binding():
+    token = make_token('abc123', '140', client_ip='10.0.0.1')
+    assert verify_token(token, client_ip='10.0.0.1')['video'] == 'abc123'
+    with pytest.raises(TokenError, match="different client"):
+        verify_token(token, client_ip='10.0.0.2')
+    with pytest.raises(TokenError, match="different client"):
+        verify_token(token)
+
+
+def test_unbound_token_works_from_any_client():
+    assert verify_token(make_token('abc123', '140'), client_ip='10.0.0.2')['format'] == '140'
@@ -0,0 +1,126 @@
+import os
+import threading
+
+import pytest
+
+import fanout
+from fanout import FanoutRegistry, FetchFailed
+
+KEY = 'k' * 40
+DATA = os.urandom(5000)
+
+
+def claim(cache, key):
+    # Fill claim waise hi lo jaise ek popular download leta hai
+    while not cache.should_fill(key):
+        pass
+
+
+def chunks(data, size=700):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def failing_body():
+    yield DATA[:2000]
+    raise OSError("connection reset")
+
+
+def wait_finished(reader):
+    fetch = reader.fetch
+    with fetch.cond:
+        fetch.cond.wait_for(lambda: fetch.done or fetch.failed)
+    return fetch
+
+
+def start(cache, open_body=lambda: chunks(DATA), open_range=None):
+    claim(cache, KEY)
+    registry = FanoutRegistry(cache)
+    return registry, registry.start(KEY, 'm4a', len(DATA), open_body, open_range)
+
+
+@pytest.fixture
+def small_ring(monkeypatch):
+    monkeypatch.setattr(fanout, 'RING_SIZE', 1000)
+
+
+def test_readers_share_one_fetch(cache):
+    opened = []
+    gate = threading.Event()
+
+    def open_body():
+        opened.append(1)
+        gate.wait()
+        yield from chunks(DATA)
+
+    registry, first = start(cache, open_body)
+    second = registry.join(KEY)
+    gate.set()
+    assert b''.join(first) == DATA
+    assert b''.join(second) == DATA
+    wait_finished(first)
+    assert opened == [1]
+    assert open(cache.path_for(KEY, 'm4a'), 'rb').read() == DATA
+    assert registry.active == {}
+    assert KEY not in cache.filling
+
+
+def test_reader_behind_the_ring_reads_the_file(cache, small_ring):
+    _, reader = start(cache)
+    wait_finished(reader)
+    assert b''.join(reader) == DATA
+
+
+def test_dropped_fill_keeps_readers_going(cache, small_ring):
+    # Object is bigger than the whole cache: the fill is dropped, not the download
+    cache.max_bytes = 1000
+    ranges = []
+
+    def open_range(start, end):
+        ranges.append((start, end))
+        return chunks(DATA[start:end + 1])
+
+    registry, reader = start(cache, open_range=open_range)
+    fetch = wait_finished(reader)
+    assert fetch.done
+    assert b''.join(reader) == DATA
+    assert ranges and ranges[0][1] == len(DATA) - 1
+    assert cache.get(KEY, 'm4a') is None
+    assert KEY not in cache.filling
+    assert registry.join(KEY) is None
+
+
+def test_dropped_fill_without_own_fetch_fails_cleanly(cache, small_ring):
+    cache.max_bytes = 1000
+    _, reader = start(cache)
+    wait_finished(reader)
+    got = bytearray()
+    with pytest.raises(FetchFailed):
+        for chunk in reader:
+            got.extend(chunk)
+    assert DATA.startswith(bytes(got))
+
+
+def test_upstream_failure_ends_readers(cache):
+    _, reader = start(cache, failing_body)
+    fetch = wait_finished(reader)
+    assert fetch.failed
+    got = bytearray()
+    with pytest.raises(FetchFailed):
+        for chunk in reader:
+            got.extend(chunk)
+    assert bytes(got) == DATA[:2000]
+    assert cache.get(KEY, 'm4a') is None
+    assert os.listdir(cache.partial_dir) == []
+    assert KEY not in cache.filling
+
+
+def test_start_without_a_writer_falls_back(cache, monkeypatch):
+    def no_space(key, ext):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(cache, 'writer', no_space)
+    registry, reader = start(cache)
+    assert reader is None
+    assert registry.active == {}
+    assert KEY not in cache.filling
@@ -0,0 +1,188 @@
+import os
+import socket
+import threading
+from email.utils import formatdate
+
+import pytest
+
+import media_cache
+import media_proxy
+
+DATA = bytes(range(256)) * 40  # 10240 bytes
+
+
+@pytest.fixture
+def media_file(tmp_path):
+    path = tmp_path / 'obj.m4a'
+    path.write_bytes(DATA)
+    return str(path)
+
+
+def serve(path, method='GET', sock=None, **headers):
+    return media_cache.serve_file(path, headers, method, sock, 'audio/mp4', 'attachment')
+
+
+def test_full_body(media_file):
+    status, headers, body = serve(media_file)
+    assert status == 200
+    assert headers['Content-Length'] == str(len(DATA))
+    assert headers['Content-Type'] == 'audio/mp4'
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert b''.join(body) == DATA
+
+
+def test_single_range(media_file):
+    status, headers, body = serve(media_file, Range='bytes=100-199')
+    assert status == 206
+    assert headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+    assert headers['Content-Length'] == '100'
+    assert b''.join(body) == DATA[100:200]
+
+
+def test_multiple_ranges(media_file):
+    status, headers, body = serve(media_file, Range='bytes=0-9,5000-5009')
+    assert status == 206
+    boundary = headers['Content-Type'].split('boundary=')[1]
+    payload = b''.join(body)
+    assert len(payload) == int(headers['Content-Length'])
+    parts = payload.split(f'--{boundary}'.encode())
+    assert parts[-1] == b'--\r\n'
+    assert b'Content-Range: bytes 0-9/10240\r\n\r\n' + DATA[:10] in parts[1]
+    assert b'Content-Range: bytes 5000-5009/10240\r\n\r\n' + DATA[5000:5010] in parts[2]
+
+
+def test_unsatisfiable_range(media_file):
+    status, headers, body = serve(media_file, Range='bytes=20000-')
+    assert status == 416
+    assert headers['Content-Range'] == f'bytes */{len(DATA)}'
+    assert list(body) == []
+
+
+def test_head_has_no_body(media_file):
+    status, headers, body = serve(media_file, method='HEAD', Range='bytes=0-9')
+    assert status == 206
+    assert headers['Content-Length'] == '10'
+    assert list(body) == []
+
+
+def test_conditional_get(media_file):
+    _, headers, _ = serve(media_file)
+    assert serve(media_file, **{'If-None-Match': headers['ETag']})[0] == 304
+    assert serve(media_file, **{'If-None-Match': '"other"'})[0] == 200
+    later = formatdate(os.stat(media_file).st_mtime + 60, usegmt=True)
+    assert serve(media_file, **{'If-Modified-Since': later})[0] == 304
+
+
+def test_if_range_mismatch_sends_whole_file(media_file):
+    _, headers, _ = serve(media_file)
+    assert serve(media_file, Range='bytes=0-9', **{'If-Range': headers['ETag']})[0] == 206
+    status, _, body = serve(media_file, Range='bytes=0-9', **{'If-Range': '"stale"'})
+    assert status == 200
+    assert b''.join(body) == DATA
+
+
+def test_sendfile_to_socket(media_file):
+    server, client = socket.socketpair()
+    received = bytearray()
+
+    def read():
+        while True:
+            data = client.recv(65536)
+            if not data:
+                return
+            received.extend(data)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        status, headers, body = serve(media_file, sock=server, Range='bytes=10-19,100-109')
+        # The server only sees empty framing chunks; the bytes go out on the socket
+        assert set(body) == {b''}
+    finally:
+        server.close()
+        reader.join()
+        client.close()
+    assert status == 206
+    assert len(received) == int(headers['Content-Length'])
+    assert DATA[10:20] in received and DATA[100:110] in received
+
+
+SPARSE_KEY = 's' * 40
+
+
+class Upstream:
+    """open_range for SparseBody over DATA, recording which ranges were asked for."""
+
+    def __init__(self, data=DATA, cut=None):
+        self.data = data
+        self.cut = cut
+        self.calls = []
+
+    def __call__(self, start, end):
+        self.calls.append((start, end))
+        stop = end + 1 if self.cut is None else min(end + 1, self.cut)
+        return iter([self.data[i:min(i + 1000, stop)] for i in range(start, stop, 1000)])
+
+
+def sparse_read(cache, start, end, upstream):
+    obj = cache.sparse(SPARSE_KEY, 'm4a', len(DATA))
+    return b''.join(media_cache.SparseBody(obj, start, end, upstream))
+
+
+def test_sparse_missing_and_plan(cache):
+    obj = cache.sparse(SPARSE_KEY, 'm4a', 1_000_000)
+    obj.ranges = [[100, 199], [300, 399], [500_000, 599_999]]
+    assert obj.missing(0, 999) == [(0, 99), (200, 299), (400, 999)]
+    assert obj.missing(120, 180) == []
+    # Beech me thoda sa data ho toh gaps ek request me; SPARSE_MERGE_GAP se zyada ho toh alag
+    assert obj.fetch_plan(0, 999_999) == [(0, 499_999), (600_000, 999_999)]
+
+
+def test_sparse_fetches_only_gaps(cache):
+    upstream = Upstream()
+    assert sparse_read(cache, 1000, 1999, upstream) == DATA[1000:2000]
+    assert sparse_read(cache, 1500, 2499, upstream) == DATA[1500:2500]
+    assert upstream.calls == [(1000, 1999), (2000, 2499)]
+    assert cache.sparse(SPARSE_KEY, 'm4a', len(DATA)).ranges == [[1000, 2499]]
+
+
+def test_sparse_publishes_when_complete(cache):
+    upstream = Upstream()
+    sparse_read(cache, 0, 4999, upstream)
+    assert cache.get(SPARSE_KEY, 'm4a') is None
+    sparse_read(cache, 5000, len(DATA) - 1, upstream)
+    path = cache.get(SPARSE_KEY, 'm4a')
+    assert path and open(path, 'rb').read() == DATA
+    assert os.listdir(cache.sparse_dir) == []
+
+
+def test_sparse_keeps_a_short_gap(cache):
+    with pytest.raises(OSError):
+        sparse_read(cache, 0, 2999, Upstream(cut=1500))
+    assert cache.sparse(SPARSE_KEY, 'm4a', len(DATA)).ranges == [[0, 1499]]
+    upstream = Upstream()
+    assert sparse_read(cache, 0, 2999, upstream) == DATA[:3000]
+    assert upstream.calls == [(1500, 2999)]
+
+
+def test_sparse_index_for_other_size_is_ignored(cache):
+    sparse_read(cache, 0, 999, Upstream())
+    assert cache.sparse(SPARSE_KEY, 'm4a', len(DATA) + 1).ranges == []
+
+
+def test_sparse_prime_surfaces_upstream_errors(cache):
+    def expired(start, end):
+        raise media_proxy.UpstreamError("Upstream returned 403 for range", status=403)
+
+    obj = cache.sparse(SPARSE_KEY, 'm4a', len(DATA))
+    with pytest.raises(media_proxy.UpstreamError):
+        media_cache.SparseBody(obj, 0, 999, expired).prime()
+
+
+def test_sparse_prime_reuses_its_fetch(cache):
+    upstream = Upstream()
+    obj = cache.sparse(SPARSE_KEY, 'm4a', len(DATA))
+    body = media_cache.SparseBody(obj, 0, 999, upstream).prime()
+    assert upstream.calls == [(0, 999)]
+    assert b''.join(body) == DATA[:1000]
+    assert upstream.calls == [(0, 999)]
@@ -0,0 +1,43 @@
+import pytest
+
+import media_proxy
+from media_proxy import RangeNotSatisfiable, parse_range, parse_ranges
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=100-', [(100, 999)]),
+    ('bytes=-100', [(900, 999)]),
+    ('bytes=-5000', [(0, 999)]),
+    ('bytes=900-5000', [(900, 999)]),
+    ('BYTES = 0-0', [(0, 0)]),
+    ('bytes=500-599, 0-99', [(0, 99), (500, 599)]),
+    ('bytes=0-99,50-149,150-199', [(0, 199)]),
+    ('bytes=0-99,2000-2100', [(0, 99)]),
+])
+def test_parse_ranges(header, expected):
+    assert parse_ranges(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', [
+    None, '', 'items=0-9', 'bytes=', 'bytes=-', 'bytes=9-0', 'bytes=a-b', 'bytes=0-9;x',
+])
+def test_unusable_header_means_full_body(header):
+    assert parse_ranges(header, 1000) is None
+
+
+def test_too_many_ranges_means_full_body():
+    header = 'bytes=' + ','.join(f'{i * 10}-{i * 10 + 1}' for i in range(media_proxy.MAX_RANGES + 1))
+    assert parse_ranges(header, 1000) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=5000-6000', 'bytes=-0'])
+def test_unsatisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_ranges(header, 1000)
+
+
+def test_parse_range_is_single_range_only():
+    assert parse_range('bytes=10-19', 1000) == (10, 19)
+    assert parse_range('bytes=0-9,20-29', 1000) is None
+    assert parse_range(None, 1000) is None
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+
+import media_cache
+import media_proxy
+import transcode
+
+logger = logging.getLogger(__name__)
+
+# Thumbnail proxy. Upstream thumbnail aksar maxresdefault (1280px+) hota hai
+# jabki card ~370px ka hai. Original ek baar fetch hoke cache hota hai, phir
+# UI ki widths me resize aur AVIF/WebP/JPEG me encode (ffmpeg se) hoke media
+# cache me jaata hai. URL me source URL ka hash (`v`) hai, isliye response
+# immutable hai: thumbnail badle toh URL bhi badal jaata hai.
+THUMB_WIDTHS = (320, 480, 640, 960)
+THUMB_DEFAULT_WIDTH = 640
+THUMB_ENCODERS = int(os.environ.get('THUMB_ENCODERS', 2))
+THUMB_MAX_SOURCE_BYTES = 5 * 1024 * 1024
+THUMB_TIMEOUT = 20
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# fmt -> (encoder args, content type, encoder ffmpeg must have)
+THUMB_FORMATS = {
+    'avif': (['-c:v', 'libaom-av1', '-still-picture', '1', '-crf', '34', '-cpu-used', '6',
+              '-pix_fmt', 'yuv420p', '-f', 'avif'], 'image/avif', 'libaom-av1'),
+    'webp': (['-c:v', 'libwebp', '-quality', '78', '-compression_level', '4', '-f', 'webp'],
+             'image/webp', 'libwebp'),
+    'jpg': (['-c:v', 'mjpeg', '-q:v', '4', '-pix_fmt', 'yuvj420p', '-f', 'mjpeg'], 'image/jpeg', None),
+}
+
+
+class ThumbError(Exception):
+    pass
+
+
+def version(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:12]
+
+
+_formats = None
+
+
+def available_formats():
+    """Output formats this ffmpeg build can encode, best first."""
+    global _formats
+    if _formats is None:
+        try:
+            encoders = subprocess.run([transcode.FFMPEG, '-hide_banner', '-encoders'],
+                                      capture_output=True, text=True, timeout=10).stdout
+        except (OSError, subprocess.TimeoutExpired):
+            encoders = ''
+        _formats = [fmt for fmt, (_, _, needs) in THUMB_FORMATS.items() if needs is None or f' {needs} ' in encoders]
+    return _formats
+
+
+def content_type(fmt):
+    return THUMB_FORMATS[fmt][1]
+
+
+def describe(info):
+    """Thumbnail URL base, widths and formats the UI builds its srcset from; None without a thumbnail."""
+    url = info.get('thumbnail')
+    if not url:
+        return None
+    return {'url': f"/thumb/{info['id']}?v={version(url)}", 'widths': list(THUMB_WIDTHS),
+            'formats': available_formats()}
+
+
+class Thumbnailer:
+    """Renders thumbnail variants into the media cache; concurrent misses for one image render it once."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.slots = threading.BoundedSemaphore(THUMB_ENCODERS)
+        self._locks = [threading.Lock() for _ in range(64)]
+
+    def _lock_for(self, key):
+        return self._locks[int(key[:8], 16) % len(self._locks)]
+
+    def cached(self, video_id, ver, width, fmt):
+        return self.cache.get(media_cache.cache_key(video_id, f'thumb:{ver}:{width}:{fmt}'), fmt)
+
+    def _source(self, video_id, url):
+        key = media_cache.cache_key(video_id, f'thumb:{version(url)}:src')
+        with self._lock_for(key):
+            path = self.cache.get(key, 'img')
+            if path:
+                return path
+            try:
+                data = media_proxy.fetch_range(url, None)
+            except media_proxy.UpstreamError as e:
+                raise ThumbError(f"Could not fetch thumbnail: {e}")
+            if not data or len(data) > THUMB_MAX_SOURCE_BYTES:
+                raise ThumbError(f"Thumbnail has an unusable size ({len(data)} bytes)")
+            writer = self.cache.writer(key, 'img')
+            try:
+                writer.write(data)
+                return writer.commit()
+            except OSError:
+                writer.abort()
+                raise
+
+    def render(self, video_id, url, width, fmt):
+        """Path of the thumbnail at `url` scaled down to `width` and encoded as `fmt`."""
+        key = media_cache.cache_key(video_id, f'thumb:{version(url)}:{width}:{fmt}')
+        path = self.cache.get(key, fmt)
+        if path:
+            return path
+        source = self._source(video_id, url)
+        with self._lock_for(key):
+            path = self.cache.get(key, fmt)
+            if path:
+                return path
+            writer = self.cache.writer(key, fmt)
+            # Chhoti image ko bada nahi karte
+            cmd = [transcode.FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', source,
+                   '-frames:v', '1', '-vf', f"scale='min({width},iw)':-2:flags=lanczos"]
+            cmd += THUMB_FORMATS[fmt][0] + ['-y', writer.part_path]
+            try:
+                with self.slots:
+                    proc = subprocess.run(cmd, capture_output=True, timeout=THUMB_TIMEOUT)
+                if proc.returncode != 0:
+                    raise ThumbError(f"ffmpeg failed: {proc.stderr.decode(errors='replace').strip()[-300:]}")
+                writer.size = os.path.getsize(writer.part_path)
+                return writer.commit()
+            except (OSError, subprocess.TimeoutExpired) as e:
+                writer.abort()
+                raise ThumbError(f"Thumbnail encode failed: {e}")
+            except ThumbError:
+                writer.abort()
+                raise
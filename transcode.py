@@ -0,0 +1,825 @@
+import array
+import itertools
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque, OrderedDict
+
+import gapless
+import progress
+from media_proxy import DEFAULT_HEADERS, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = os.environ.get('FFMPEG_BIN') or shutil.which('ffmpeg') or 'ffmpeg'
+READ_SIZE = 64 * 1024
+
+
+class TranscodeError(Exception):
+    pass
+
+
+class TooBusy(TranscodeError):
+    pass
+
+
+def cpu_quota():
+    """Cores this container may use: cgroup v2/v1 CFS quota, else the affinity mask."""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as fh:
+            quota, period = fh.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as fh:
+                quota = int(fh.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as fh:
+                period = int(fh.read())
+            if quota > 0:
+                return quota / period
+        except (OSError, ValueError):
+            pass
+    if hasattr(os, 'sched_getaffinity'):
+        return float(len(os.sched_getaffinity(0)))
+    return float(os.cpu_count() or 1)
+
+
+# Ek core /analyze aur proxy ke liye chhod ke baaki ffmpeg ko
+CPU_CORES = cpu_quota()
+FFMPEG_CAPACITY = float(os.environ.get('FFMPEG_CPU_CAPACITY', max(1.0, CPU_CORES - 1)))
+FFMPEG_MAX_QUEUE = int(os.environ.get('FFMPEG_MAX_QUEUE', 50))
+COPY_NICE = int(os.environ.get('FFMPEG_COPY_NICE', 5))
+TRANSCODE_NICE = int(os.environ.get('FFMPEG_TRANSCODE_NICE', 15))
+# Queued ticket ko itni der tak koi poll na kare toh drop
+TICKET_TTL = 60
+
+
+class Ticket:
+    def __init__(self, scheduler, client, weight, cpu_seconds):
+        self.id = f"{next(scheduler._ids):x}{os.urandom(4).hex()}"
+        self.scheduler = scheduler
+        self.client = client
+        self.weight = weight
+        self.cpu_seconds = cpu_seconds
+        self.admitted = threading.Event()
+        self.started = None
+        self.touched = time.monotonic()
+        self.claimed = False
+        self.released = False
+
+    def wait(self, timeout):
+        self.touched = time.monotonic()
+        ok = self.admitted.wait(timeout)
+        self.touched = time.monotonic()
+        return ok
+
+    def release(self):
+        self.scheduler.release(self)
+
+
+class TranscodeScheduler:
+    """Admits ffmpeg jobs against a CPU budget, queueing the rest round-robin per client.
+
+    Each job has a weight in cores (copy jobs are cheap, encodes take their
+    thread count). The client with the fewest running jobs goes next, so one
+    client with many conversions cannot push everyone else back.
+    """
+
+    def __init__(self, capacity=FFMPEG_CAPACITY, max_queue=FFMPEG_MAX_QUEUE):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.in_use = 0.0
+        self.running = {}
+        self.queues = OrderedDict()
+        self.tickets = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, client, weight, cpu_seconds):
+        with self._lock:
+            self._expire()
+            if sum(len(q) for q in self.queues.values()) >= self.max_queue:
+                raise TooBusy("Conversion queue is full")
+            ticket = Ticket(self, client, min(weight, self.capacity), cpu_seconds)
+            self.tickets[ticket.id] = ticket
+            self.queues.setdefault(client, deque()).append(ticket)
+            self._dispatch()
+        return ticket
+
+    def resume(self, ticket_id, client):
+        with self._lock:
+            self._expire()
+            ticket = self.tickets.get(ticket_id)
+            if ticket is None or ticket.client != client:
+                return None
+            ticket.touched = time.monotonic()
+            return ticket
+
+    def release(self, ticket):
+        with self._lock:
+            self._release(ticket)
+            self._dispatch()
+
+    def _release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        self.tickets.pop(ticket.id, None)
+        if self.running.pop(ticket.id, None) is not None:
+            self.in_use -= ticket.weight
+            return
+        queue = self.queues.get(ticket.client)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self.queues[ticket.client]
+
+    def _dispatch(self):
+        # Sabse kam running jobs wale client ki baari (barabar ho toh round-robin);
+        # uska pehla job fit ho tabhi admit, chhote jobs aage nahi nikalte
+        while self.queues:
+            active = {}
+            for t in self.running.values():
+                active[t.client] = active.get(t.client, 0) + 1
+            client = min(self.queues, key=lambda c: active.get(c, 0))
+            queue = self.queues[client]
+            ticket = queue[0]
+            if self.running and self.in_use + ticket.weight > self.capacity:
+                return
+            queue.popleft()
+            del self.queues[client]
+            if queue:
+                self.queues[client] = queue
+            self.in_use += ticket.weight
+            self.running[ticket.id] = ticket
+            ticket.started = time.monotonic()
+            ticket.touched = ticket.started
+            ticket.admitted.set()
+
+    def _expire(self):
+        # Queue me chhode gaye, ya admit hone ke baad kabhi claim na hue tickets
+        now = time.monotonic()
+        for ticket in list(self.tickets.values()):
+            if not ticket.claimed and now - ticket.touched > TICKET_TTL:
+                self._release(ticket)
+        self._dispatch()
+
+    def _order(self):
+        """Queued tickets interleaved per client, approximating admission order."""
+        queues = [list(q) for q in self.queues.values()]
+        return [t for group in itertools.zip_longest(*queues) for t in group if t is not None]
+
+    def status(self, ticket=None):
+        """Queue depth, the ticket's position and an ETA from remaining CPU work over capacity."""
+        with self._lock:
+            now = time.monotonic()
+            work = sum(max(0.0, t.cpu_seconds - (now - t.started) * t.weight) for t in self.running.values())
+            order = self._order()
+            ahead = order.index(ticket) if ticket in order else len(order)
+            work += sum(t.cpu_seconds for t in order[:ahead])
+            return {
+                'queue_depth': len(order),
+                'running': len(self.running),
+                'position': ahead + 1 if ticket in order else 0,
+                'eta_seconds': math.ceil(work / self.capacity) if ticket is None or ticket in order else 0,
+            }
+
+
+scheduler = TranscodeScheduler()
+
+
+def http_input_args(f, start=None):
+    """ffmpeg args to read a format straight from its URL, seeking with Range requests."""
+    headers = dict(f.get('http_headers') or {})
+    args = ['-user_agent', headers.pop('User-Agent', DEFAULT_HEADERS['User-Agent']),
+            '-reconnect', '1', '-reconnect_streamed', '1']
+    if headers:
+        args += ['-headers', ''.join(f'{k}: {v}\r\n' for k, v in headers.items())]
+    if start:
+        args += ['-ss', f'{start:.3f}']
+    return args + ['-i', f['url']]
+
+
+def _renice(pid, nice):
+    if nice and hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        except OSError:
+            pass
+
+
+def _feed(source, fd):
+    """Opens an upstream body and copies it into an ffmpeg input pipe.
+
+    Runs in its own thread; stops quietly if ffmpeg goes away, and closes
+    the pipe on upstream errors so ffmpeg sees EOF instead of hanging.
+    """
+    body = None
+    try:
+        with os.fdopen(fd, 'wb') as pipe:
+            body = source()
+            for chunk in body:
+                pipe.write(chunk)
+    except BrokenPipeError:
+        pass
+    except Exception as e:
+        logger.error(f"ffmpeg input feed failed: {e}")
+    finally:
+        close = getattr(body, 'close', None)
+        if close:
+            close()
+
+
+class FFmpegStream:
+    """Runs one ffmpeg process fed from upstream bodies over pipes and iterates its stdout.
+
+    Each source is either a zero-arg callable returning a body iterable,
+    opened in a feeder thread and piped in through `pipe:<fd>`, or a list of
+    ffmpeg input args (ending in `-i <url>`) for inputs ffmpeg should fetch
+    and seek itself. Nothing touches disk, and the kernel pipe buffer bounds
+    what is held between fetch and ffmpeg. The admitted scheduler ticket is
+    held until the process is reaped.
+    """
+
+    def __init__(self, sources, output_args, ticket, nice=0, progress=None, duration=None, output='pipe:1'):
+        self.proc = None
+        self.ok = False
+        self.ticket = ticket
+        ticket.claimed = True
+        self.stderr_tail = deque(maxlen=20)
+        try:
+            self._start(sources, output_args, nice, progress, duration, output)
+        except Exception:
+            ticket.release()
+            raise
+
+    def _start(self, sources, output_args, nice, job, duration, output):
+        cmd = [FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error']
+        pipes = []
+        report = None
+        if job is not None:
+            # -progress ka key=value output alag pipe pe, stderr sirf errors ke liye
+            report = os.pipe()
+            cmd += ['-nostats', '-progress', f'pipe:{report[1]}']
+        for source in sources:
+            if callable(source):
+                r, w = os.pipe()
+                pipes.append((source, r, w))
+                cmd += ['-i', f'pipe:{r}']
+            else:
+                cmd += list(source)
+        cmd += output_args + (['pipe:1'] if output == 'pipe:1' else ['-y', output])
+        try:
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                         pass_fds=[r for _, r, _ in pipes] + list(report[1:] if report else []))
+        except OSError as e:
+            for _, r, w in pipes:
+                os.close(r)
+                os.close(w)
+            for fd in report or ():
+                os.close(fd)
+            raise TranscodeError(f"Could not start ffmpeg: {e}")
+        for _, r, _ in pipes:
+            os.close(r)
+        if report:
+            os.close(report[1])
+            threading.Thread(target=progress.read_ffmpeg_progress,
+                             args=(os.fdopen(report[0], 'rb'), job, duration), daemon=True).start()
+        _renice(self.proc.pid, nice)
+        self.feeders = [threading.Thread(target=_feed, args=(source, w), daemon=True)
+                        for source, _, w in pipes]
+        for t in self.feeders:
+            t.start()
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
+
+    def _drain_stderr(self):
+        for line in self.proc.stderr:
+            self.stderr_tail.append(line.decode(errors='replace').rstrip())
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.proc.stdout.read1(READ_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            if self.proc.wait() != 0:
+                logger.error(f"ffmpeg exited with {self.proc.returncode}: {' | '.join(self.stderr_tail)}")
+            else:
+                self.ok = True
+        finally:
+            self.close()
+
+    def run(self):
+        """Waits for a job writing to a file (`output` path) and raises TranscodeError if it failed."""
+        for _ in self:
+            pass
+        if not self.ok:
+            raise TranscodeError(f"ffmpeg failed: {' | '.join(self.stderr_tail)}")
+
+    def close(self):
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        if proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+        self.ticket.release()
+
+
+# Conversion planning. Container remux (stream copy) almost free hai, lekin
+# codec container me allowed na ho (jaise Opus -> mp3) toh encode karna padta
+# hai. Planner har stream ke liye sabse sasta valid rasta chunta hai aur
+# expected CPU cost batata hai taaki scheduler job admit/queue kar sake.
+# Sirf audio ho toh keyframe pe kabhi fragment nahi kat-ta (poori file ek fragment,
+# jo pipe pe toot jaata hai), isliye duration se bhi kaato
+FRAGMENTED_MP4 = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-frag_duration', '2000000']
+
+TARGETS = {
+    'mp4': {'video': ('h264', 'hevc', 'av1', 'vp9'), 'audio': ('aac', 'mp3', 'opus', 'ac3', 'eac3', 'flac'),
+            'video_encoder': ['libx264', '-preset', 'veryfast', '-crf', '23'],
+            'audio_encoder': ['aac', '-b:a', '192k'],
+            'format': ['-f', 'mp4'] + FRAGMENTED_MP4, 'mimetype': 'video/mp4', 'ext': 'mp4'},
+    'webm': {'video': ('vp9', 'vp8', 'av1'), 'audio': ('opus', 'vorbis'),
+             'video_encoder': ['libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8', '-b:v', '0', '-crf', '33'],
+             'audio_encoder': ['libopus', '-b:a', '160k'],
+             'format': ['-f', 'webm'], 'mimetype': 'video/webm', 'ext': 'webm'},
+    'm4a': {'video': None, 'audio': ('aac',),
+            'audio_encoder': ['aac', '-b:a', '192k'],
+            'format': ['-f', 'ipod'] + FRAGMENTED_MP4, 'mimetype': 'audio/mp4', 'ext': 'm4a'},
+    'mp3': {'video': None, 'audio': ('mp3',),
+            'audio_encoder': ['libmp3lame', '-q:a', '2'],
+            'format': ['-f', 'mp3'], 'mimetype': 'audio/mpeg', 'ext': 'mp3'},
+    'opus': {'video': None, 'audio': ('opus',),
+             'audio_encoder': ['libopus', '-b:a', '160k'],
+             'format': ['-f', 'opus'], 'mimetype': 'audio/ogg', 'ext': 'opus'},
+}
+
+# Estimated CPU seconds per second of media
+COPY_COST = 0.002
+AUDIO_ENCODE_COST = 0.03
+VIDEO_ENCODE_COST_1080P = 1.5
+# Scheduler weight in cores; encoders are pinned to this many threads
+COPY_WEIGHT = 0.25
+AUDIO_ENCODE_THREADS = 1
+VIDEO_ENCODE_THREADS = int(os.environ.get('FFMPEG_VIDEO_THREADS', 2))
+
+_CODEC_FAMILIES = {
+    'avc1': 'h264', 'avc3': 'h264', 'h264': 'h264',
+    'hev1': 'hevc', 'hvc1': 'hevc', 'hevc': 'hevc', 'h265': 'hevc',
+    'av01': 'av1', 'av1': 'av1',
+    'vp09': 'vp9', 'vp9': 'vp9', 'vp8': 'vp8',
+    'mp4a': 'aac', 'aac': 'aac', 'opus': 'opus', 'vorbis': 'vorbis',
+    'mp3': 'mp3', 'mp4a.40.34': 'mp3', 'ac-3': 'ac3', 'ac3': 'ac3', 'ec-3': 'eac3', 'eac3': 'eac3',
+    'flac': 'flac',
+}
+# Jab yt-dlp codec na bataye tab extension se andaza
+_AUDIO_BY_EXT = {'m4a': 'aac', 'mp3': 'mp3', 'opus': 'opus', 'ogg': 'vorbis', 'webm': 'opus', 'flac': 'flac'}
+
+
+class ConversionPlan:
+    def __init__(self, target, args, video_copy, audio_copy, cpu_seconds):
+        self.target = target
+        self.args = args
+        self.video_copy = video_copy
+        self.audio_copy = audio_copy
+        self.cpu_seconds = cpu_seconds
+
+    @property
+    def mode(self):
+        return 'copy' if self.video_copy is not False and self.audio_copy else 'transcode'
+
+    @property
+    def weight(self):
+        if self.video_copy is False:
+            return float(VIDEO_ENCODE_THREADS)
+        return COPY_WEIGHT if self.audio_copy else float(AUDIO_ENCODE_THREADS)
+
+    @property
+    def nice(self):
+        return COPY_NICE if self.mode == 'copy' else TRANSCODE_NICE
+
+    @property
+    def ext(self):
+        return TARGETS[self.target]['ext']
+
+    @property
+    def mimetype(self):
+        return TARGETS[self.target]['mimetype']
+
+    def to_dict(self):
+        return {'target': self.target, 'mode': self.mode, 'ext': self.ext,
+                'cpu_seconds': round(self.cpu_seconds, 1)}
+
+
+def codec_family(codec):
+    if codec in (None, 'none'):
+        return None
+    codec = codec.lower()
+    return _CODEC_FAMILIES.get(codec) or _CODEC_FAMILIES.get(codec.split('.')[0]) or codec.split('.')[0]
+
+
+def _has_video(f):
+    return f.get('vcodec') not in (None, 'none')
+
+
+def _has_audio(f):
+    return f.get('acodec') != 'none' and (f.get('acodec') is not None or f.get('ext') in _AUDIO_BY_EXT)
+
+
+def plan_conversion(inputs, target, duration=None, cover=False, seekable=False):
+    """Cheapest ffmpeg pipeline turning `inputs` (yt-dlp format dicts, in ffmpeg input order) into `target`.
+
+    Each stream is copied when its codec is valid in the target container
+    and encoded otherwise. Raises TranscodeError if the inputs lack a
+    stream the target needs. `cover` keeps room for an attached picture in
+    audio outputs; `seekable` (output to a file) drops MP4 fragmentation.
+    """
+    profile = TARGETS.get(target)
+    if profile is None:
+        raise TranscodeError(f"Unsupported target: {target}")
+    duration = duration or 0
+
+    args = []
+    cpu = 0.0
+    video_copy = None
+    if profile['video'] is not None:
+        index = next((i for i, f in enumerate(inputs) if _has_video(f)), None)
+        if index is None:
+            raise TranscodeError("No video stream to convert")
+        f = inputs[index]
+        args += ['-map', f'{index}:v:0']
+        video_copy = codec_family(f.get('vcodec')) in profile['video']
+        if video_copy:
+            args += ['-c:v', 'copy']
+            cpu += COPY_COST * duration
+        else:
+            args += ['-c:v'] + profile['video_encoder']
+            pixels = (f.get('width') or 1920) * (f.get('height') or 1080)
+            cpu += VIDEO_ENCODE_COST_1080P * pixels / (1920 * 1080) * duration
+
+    # Audio alag input se ho toh wahi lo, warna video wale muxed format se
+    index = next((i for i, f in reversed(list(enumerate(inputs))) if _has_audio(f)), None)
+    if index is None:
+        raise TranscodeError("No audio stream to convert")
+    f = inputs[index]
+    args += ['-map', f'{index}:a:0']
+    audio_copy = (codec_family(f.get('acodec')) or _AUDIO_BY_EXT.get(f.get('ext'))) in profile['audio']
+    if audio_copy:
+        args += ['-c:a', 'copy']
+        cpu += COPY_COST * duration
+    else:
+        args += ['-c:a'] + profile['audio_encoder']
+        cpu += AUDIO_ENCODE_COST * duration
+    if profile['video'] is None and not cover:
+        args += ['-vn']
+    if video_copy is False:
+        args += ['-threads', str(VIDEO_ENCODE_THREADS)]
+    elif not audio_copy:
+        args += ['-threads', str(AUDIO_ENCODE_THREADS)]
+
+    fmt = profile['format']
+    if seekable and fmt[-len(FRAGMENTED_MP4):] == FRAGMENTED_MP4:
+        fmt = fmt[:-len(FRAGMENTED_MP4)]
+    return ConversionPlan(target, args + fmt, video_copy, audio_copy, cpu)
+
+
+def remux_plan(target, duration=None):
+    """Copies the input's video and audio into `target` unchanged; only the container changes."""
+    profile = TARGETS[target]
+    if profile['video'] is None:
+        args = ['-map', '0:a:0', '-c', 'copy', '-vn']
+    else:
+        args = ['-map', '0:v:0?', '-map', '0:a:0?', '-c', 'copy']
+    return ConversionPlan(target, args + profile['format'], True if profile['video'] else None, True,
+                          2 * COPY_COST * (duration or 0))
+
+
+# Audio tags. Text tags pipe pe bhi chal jaate hain, lekin cover art nahi: MP4
+# ka `covr` moov me hota hai jo fragmented output me nahi ban sakta, aur mp3
+# muxer APIC ke baad ID3 header ka size seek karke bharta hai. Isliye cover
+# wala output seedha seekable file me likha jaata hai.
+COVER_TARGETS = ('m4a', 'mp3')
+COVER_COPY_EXTS = ('jpg', 'jpeg', 'png')
+
+
+def audio_tag_args(tags, cover_index=None, cover_ext=None):
+    """Output args writing text tags, plus the image at input `cover_index` as the attached cover."""
+    args = []
+    if cover_index is not None:
+        codec = 'copy' if cover_ext in COVER_COPY_EXTS else 'mjpeg'
+        args += ['-map', f'{cover_index}:v:0', '-c:v', codec, '-disposition:v:0', 'attached_pic']
+    for key, value in tags.items():
+        if value:
+            args += ['-metadata', f'{key}={value}']
+    return args
+
+
+# Parallel chunked transcoding. Lambi audio (2 ghante ka podcast) ek ffmpeg
+# process me ek hi core use karti hai. Source ko N segments me kaat ke har
+# segment alag process me encode hota hai, phir outputs bina re-encode ke
+# jod diye jaate hain. Seams gapless hain (dekho gapless.py): segment encoder
+# ke frame grid pe sample-exact shuru hota hai, dono taraf kuch frames extra
+# encode hote hain aur jodte waqt frame index pe kaata jaata hai. Video
+# (keyframes) abhi is mode me nahi hai.
+PARALLEL_MIN_DURATION = int(os.environ.get('PARALLEL_TRANSCODE_MIN_SECONDS', 600))
+PARALLEL_MAX_WORKERS = int(os.environ.get('PARALLEL_TRANSCODE_MAX_WORKERS', 4))
+# Segments ko random access chahiye, toh source pehle poora temp file me spool hota hai
+# aur pehla byte encode ke baad hi niklta hai. Isliye parallel sirf tab jab source ka
+# size pata ho, is cap ke andar ho, aur temp me iske PARALLEL_SPACE_FACTOR guna jagah
+# khali ho (source + segment outputs + joined file); warna ek process wala raasta.
+PARALLEL_MAX_SOURCE_BYTES = int(os.environ.get('PARALLEL_TRANSCODE_MAX_SOURCE_MB', 512)) * 1024 * 1024
+PARALLEL_SPACE_FACTOR = 3
+# Seam ke dono taraf extra frames, taaki encoder ki state (psychoacoustic model,
+# bit reservoir) wahan tak single encode jaisi ho jaaye
+SEGMENT_OVERLAP_FRAMES = 8
+# Seek ke baad decoder ko itne seconds pehle se chalne do; sample-exact kaat atrim karta hai
+SEGMENT_SEEK_MARGIN = 2.0
+# Seek ki pts galti naapne ke liye seam pe itne seconds decode hote hain (inme se sabse tez
+# awaaz wala SEGMENT_ALIGN_SPAN milaate hain), aur galti kitni tak ho sakti hai
+SEGMENT_ALIGN_WINDOW = 2.0
+SEGMENT_ALIGN_SPAN = 0.25
+SEGMENT_ALIGN_REACH = 0.01
+
+# target -> (segment muxer args, segment ext, frame kind). mp3 ka LAME tag priming/padding batata hai.
+SEGMENT_FORMATS = {
+    'mp3': (['-f', 'mp3', '-write_xing', '1', '-id3v2_version', '0'], 'mp3', 'mp3'),
+    'm4a': (['-f', 'adts'], 'aac', 'adts'),
+}
+
+
+def source_size(f, duration):
+    """Bytes the format will spool to, from its filesize or its bitrate; None if unknown."""
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = f['tbr'] * 1000 / 8 * duration
+    return int(size) if size else None
+
+
+def parallel_workers(plan, inputs, duration, capacity=FFMPEG_CAPACITY):
+    """Worker count for a segmented transcode of `plan`, or 0 when one process is the better fit."""
+    if (plan.target not in SEGMENT_FORMATS or plan.audio_copy or len(inputs) != 1
+            or not duration or duration < PARALLEL_MIN_DURATION):
+        return 0
+    size = source_size(inputs[0], duration)
+    if not size or size > PARALLEL_MAX_SOURCE_BYTES:
+        return 0
+    try:
+        free = shutil.disk_usage(tempfile.gettempdir()).free
+    except OSError:
+        return 0
+    if free < size * PARALLEL_SPACE_FACTOR:
+        logger.info(f"Only {free // (1024 * 1024)} MB free for a {size // (1024 * 1024)} MB spool, not segmenting")
+        return 0
+    workers = min(PARALLEL_MAX_WORKERS, int(capacity), int(duration // (PARALLEL_MIN_DURATION / 2)))
+    return workers if workers >= 2 else 0
+
+
+def segment_bounds(duration, workers, rate, frame):
+    """(first sample, end sample or None, takeover frame) of each segment.
+
+    Starts sit on the encoder's `frame` grid with SEGMENT_OVERLAP_FRAMES of
+    pre-roll, and each segment runs on past the next takeover point so the
+    join can pick a seam inside the overlap.
+    """
+    step = duration * rate / workers
+    cuts = [int(i * step // frame) for i in range(workers)]
+    bounds = []
+    for i, cut in enumerate(cuts):
+        start = max(0, cut - SEGMENT_OVERLAP_FRAMES) * frame
+        end = (cuts[i + 1] + 2 * SEGMENT_OVERLAP_FRAMES) * frame if i + 1 < workers else None
+        bounds.append((start, end, cut))
+    return bounds
+
+
+class ParallelTranscode:
+    """Transcodes one audio source as `workers` time segments in parallel and streams the joined result.
+
+    The source is first spooled to a temp file (segments need random
+    access), using the same parallel ranged fetch as the proxy; callers
+    gate this on parallel_workers(), which checks the source size and the
+    free temp space, and the spool stops past PARALLEL_MAX_SOURCE_BYTES
+    in case the size estimate was wrong. Once every
+    segment is encoded they are cut at frame-exact seams into one stream:
+    mp3 gets a LAME tag for the whole file (so players trim the encoder
+    delay/padding), AAC is stream-copied into fragmented m4a.
+    """
+
+    def __init__(self, source, target, duration, workers, ticket, nice=0, progress=None):
+        self.source = source
+        self.job = progress
+        self.target = target
+        self.duration = duration
+        self.workers = workers
+        self.ticket = ticket
+        ticket.claimed = True
+        self.nice = nice
+        self.procs = []
+        self.workdir = None
+        self.ok = False
+        self.closed = False
+
+    def _spool(self):
+        path = os.path.join(self.workdir, 'source')
+        body = None
+        try:
+            body = self.source()
+            with open(path, 'wb') as fh:
+                for chunk in body:
+                    fh.write(chunk)
+                    if fh.tell() > PARALLEL_MAX_SOURCE_BYTES:
+                        raise TranscodeError(f"Source is over {PARALLEL_MAX_SOURCE_BYTES} bytes, too big to segment")
+                    if self.job:
+                        self.job.update(spooled_bytes=fh.tell())
+        except (UpstreamError, OSError) as e:
+            # Source beech me toota ya disk bhar gayi
+            raise TranscodeError(f"Source spool failed: {e}")
+        finally:
+            getattr(body, 'close', lambda: None)()
+        return path
+
+    def _probe(self, src):
+        """(rate, pts of the first decoded sample, whether seeking keeps sample-exact pts)."""
+        # Decoded audio ka timebase 1/rate hota hai, toh pts = sample number. Seek ke baad pts
+        # packet ke timestamp se aata hai; container ka timebase sample se mota ho (WebM: 1 ms)
+        # toh woh rounded hota hai.
+        cmd = [FFMPEG, '-hide_banner', '-nostdin', '-copyts', '-t', '1', '-i', src,
+               '-map', '0:a:0', '-af', 'ashowinfo', '-f', 'null', '-',
+               '-map', '0:a:0', '-c', 'copy', '-frames:a', '1', '-f', 'framecrc', 'pipe:1']
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        m = re.search(rb' n:0 pts:(-?\d+) .* rate:(\d+) ', result.stderr)
+        tb = re.search(rb'#tb 0: (\d+)/(\d+)', result.stdout)
+        if result.returncode != 0 or not m or not tb:
+            raise TranscodeError("Could not probe the audio for segmenting")
+        rate = int(m.group(2))
+        return rate, int(m.group(1)), int(tb.group(2)) % (rate * int(tb.group(1))) == 0
+
+    def _decode_args(self, src, start, rate):
+        # Segment jo `start` sample se shuru hota hai, uske jaisa seek karke decode
+        cmd = [FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error', '-copyts']
+        if start:
+            cmd += ['-ss', f'{max(0.0, start / rate - SEGMENT_SEEK_MARGIN):.3f}']
+        return cmd + ['-i', src, '-map', '0:a:0', '-vn']
+
+    def _offsets(self, src, bounds, rate, delta, exact):
+        """pts minus sample number in each segment's seeked decode."""
+        if exact:
+            return [delta] * len(bounds)
+        # Har seam pe ek chhota window do tarah decode karo: pichhle segment jaisa seek karke
+        # aur is segment jaisa. Dono ka lag = dono seeks ki pts galti ka farak; segment 0
+        # seek nahi karta toh wahan se jod jod ke har segment ki galti milti hai.
+        window, reach = int(rate * SEGMENT_ALIGN_WINDOW), int(rate * SEGMENT_ALIGN_REACH)
+        procs = []
+        for i in range(1, len(bounds)):
+            at = bounds[i][0] + delta
+            for start, first, last in ((bounds[i - 1][0], at, at + window),
+                                       (bounds[i][0], at - reach, at + window + reach)):
+                cmd = self._decode_args(src, start, rate)
+                cmd += ['-af', f'atrim=start_pts={first}:end_pts={last}', '-ac', '1', '-f', 's16le', 'pipe:1']
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                _renice(proc.pid, self.nice)
+                self.procs.append(proc)
+                procs.append(proc)
+        pcm = []
+        for proc in procs:
+            out, _ = proc.communicate()
+            if proc.returncode != 0:
+                raise TranscodeError("Seam alignment decode failed")
+            pcm.append(array.array('h', out))
+        self.procs = []
+        offsets = [delta]
+        for i in range(1, len(bounds)):
+            lag = gapless.best_lag(pcm[2 * i - 2], pcm[2 * i - 1], reach, int(rate * SEGMENT_ALIGN_SPAN))
+            if lag is None:
+                # Chup pe seam: galti sunai nahi degi, pichhla offset hi chalao
+                lag = 0
+            offsets.append(offsets[-1] + lag)
+        logger.info(f"Segment pts offsets: {offsets}")
+        return offsets
+
+    def _start_segments(self, src, bounds, rate, offsets):
+        seg_args, seg_ext, _ = SEGMENT_FORMATS[self.target]
+        encoder = TARGETS[self.target]['audio_encoder']
+        paths = []
+        for i, ((start, end, _), offset) in enumerate(zip(bounds, offsets)):
+            out = os.path.join(self.workdir, f'seg{i:03d}.{seg_ext}')
+            cmd = self._decode_args(src, start, rate)
+            # -copyts se pts source ke hi rehte hain, atrim unpe sample-exact kaatta hai;
+            # end_pts pe filter EOF deta hai aur ffmpeg wahin ruk jaata hai
+            trim = []
+            if start:
+                trim.append(f'start_pts={start + offset}')
+            if end is not None:
+                trim.append(f'end_pts={end + offset}')
+            if trim:
+                cmd += ['-af', f"atrim={':'.join(trim)},asetpts=PTS-STARTPTS"]
+            cmd += ['-c:a'] + encoder
+            cmd += ['-threads', str(AUDIO_ENCODE_THREADS)] + seg_args + ['-y', out]
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            _renice(proc.pid, self.nice)
+            self.procs.append(proc)
+            paths.append(out)
+        return paths
+
+    def _wait(self, proc):
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            raise TranscodeError(f"Segment encode failed: {err.decode(errors='replace').strip()[-300:]}")
+        if self.job:
+            done = sum(1 for p in self.procs if p.returncode is not None)
+            self.job.update(position=self.duration * done / self.workers, segments_done=done)
+
+    def _join(self, paths, bounds, frame):
+        _, seg_ext, kind = SEGMENT_FORMATS[self.target]
+        path = os.path.join(self.workdir, f'joined.{seg_ext}')
+        firsts = [start // frame for start, _, _ in bounds]
+        cuts = [cut for _, _, cut in bounds]
+        try:
+            with open(path, 'wb') as fh:
+                frames = gapless.join_segments(paths, firsts, cuts, kind, fh, window=SEGMENT_OVERLAP_FRAMES)
+        except gapless.SegmentError as e:
+            raise TranscodeError(f"Segment join failed: {e}")
+        logger.info(f"Joined {len(paths)} segments into {frames} frames")
+        return path
+
+    def _stream_file(self, path):
+        with open(path, 'rb') as fh:
+            while True:
+                chunk = fh.read(READ_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def __iter__(self):
+        try:
+            self.workdir = tempfile.mkdtemp(prefix='vd-transcode-')
+            src = self._spool()
+            rate, delta, exact = self._probe(src)
+            frame = gapless.frame_samples(SEGMENT_FORMATS[self.target][2], rate)
+            if frame is None:
+                # Encoder is rate ko resample karega, toh frame grid source ke samples pe nahi baithega
+                logger.info(f"{rate} Hz can't be segmented for {self.target}, encoding in one piece")
+                self.workers, frame = 1, 1
+            bounds = segment_bounds(self.duration, self.workers, rate, frame)
+            offsets = self._offsets(src, bounds, rate, delta, exact)
+            paths = self._start_segments(src, bounds, rate, offsets)
+            if self.job:
+                self.job.update(duration=self.duration, position=0, segments=self.workers)
+            for proc in self.procs:
+                self._wait(proc)
+            joined = self._join(paths, bounds, frame)
+            if self.target == 'mp3':
+                # Copy remux: mp3 muxer hamare tag se delay/padding padh ke poori file ka LAME
+                # tag (music length, CRC ke saath) khud likh deta hai
+                out = os.path.join(self.workdir, 'out.mp3')
+                cmd = [FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', joined, '-c', 'copy']
+                result = subprocess.run(cmd + SEGMENT_FORMATS['mp3'][0] + ['-y', out], stderr=subprocess.PIPE)
+                if result.returncode != 0:
+                    raise TranscodeError(f"mp3 remux failed: {result.stderr.decode(errors='replace').strip()[-300:]}")
+                yield from self._stream_file(out)
+                self.ok = True
+                return
+            cmd = [FFMPEG, '-hide_banner', '-nostdin', '-loglevel', 'error',
+                   '-i', joined, '-c', 'copy', '-bsf:a', 'aac_adtstoasc']
+            cmd += TARGETS[self.target]['format'] + ['pipe:1']
+            joiner = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.procs.append(joiner)
+            while True:
+                chunk = joiner.stdout.read1(READ_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            if joiner.wait() != 0:
+                logger.error(f"Segment join exited with {joiner.returncode}")
+            else:
+                self.ok = True
+        except TranscodeError as e:
+            logger.error(str(e))
+        except OSError as e:
+            # Temp dir, ffmpeg start ya join file: response yahin khatam, ok False hi rehta hai
+            logger.error(f"Parallel transcode failed: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            for pipe in (proc.stdout, proc.stderr):
+                if pipe:
+                    pipe.close()
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        self.ticket.release()